@@ -4,15 +4,24 @@ import sys
 import os
 import requests
 import argparse
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urljoin, urlencode
 import re
 import json
+import gzip
 import collections
-import yaml
-from requests.auth import HTTPBasicAuth
+import asyncio
+import threading
+import time
+import calendar
+import zlib
+import atexit
+import hmac
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from requests.auth import AuthBase, HTTPBasicAuth
+from urllib3.util.retry import Retry
 from datetime import datetime
-from multiprocessing import Manager, Process, Pool, current_process
-from itertools import islice
 from functools import partial
 
 __author__ = 'Halil-Cem Guersoy (https://github.com/hcguersoy), ' \
@@ -37,8 +46,11 @@ limitations under the License.
 ------------------------------------------------------------------------------
 '''
 
+# the command line arguments, only set if cleanreg is run as a script
+args = None
 
-def parse_arguments():
+
+def create_parser():
     parser = argparse.ArgumentParser(description='Removes images on a docker registry (v2).',
                                      formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument('-v', '--verbose', action='count', default=0,
@@ -64,8 +76,19 @@ def parse_arguments():
     parser.add_argument('-re', '--regex', help="Interpret tagnames as regular expressions", default=False,
                         action='store_true', dest="regex")
     parser.add_argument('-s', '--since', help="Keep images which were created since this date.", default=None)
+    parser.add_argument('--order', help="How the images are ordered to find the ones to keep: by their creation "
+                                        "date or by the names of their tags (lexical, numeric or semver). Tags "
+                                        "which don't match the order are kept. Without [-i] and [-s] the "
+                                        "metadata is only retrieved for the tags to be deleted. "
+                                        "Default value is date.",
+                        default='date', choices=list(TAG_ORDERS), dest='order')
     parser.add_argument('-f', '--reposfile', help="A yaml file containing the list of Repositories with additional information "
-                                                  "regarding tags, dates and how many images to keep.")
+                                                  "regarding tags, dates and how many images to keep. Besides "
+                                                  "names, glob patterns like team-*/service-* and regular "
+                                                  "expressions prefixed with re: can be used as keys.")
+    parser.add_argument('--explain', help="Print which rule of [-n], [-f] or [-cf] applies to each repository "
+                                          "and exit without scanning.",
+                        default=False, action='store_true', dest='explain')
     parser.add_argument('-c', '--cacert', help="Path to a valid CA certificate file. This is needed if self signed "
                                                "TLS is used in the registry server.", default=None)
     parser.add_argument('-sv', '--skip-tls-verify', help="If set insecure TLS is allowed, so no need for a valid cert to verify.", default=False, action='store_true', dest="skip_tls_verify")
@@ -76,20 +99,256 @@ def parse_arguments():
                                                         "ATTENTION: the default is False so an image will be deleted "
                                                         "even it is referenced multiple times.",
                         default=False, action='store_true', dest='ignoretag')
+    parser.add_argument('--delete-tags', help="Delete the single tags instead of the manifests they point to, if the "
+                                              "registry server supports it. A manifest which is referenced by other "
+                                              "tags is kept then, so [-i] isn't needed.",
+                        default=False, action='store_true', dest='delete_tags')
     parser.add_argument('-u', '--basicauth-user', help="The username, if the registry is protected with basic auth",
                         dest='basicauthuser')
     parser.add_argument('-pw', '--basicauth-pw', help="The password, if the registry is protected with basic auth",
                         dest='basicauthpw')
-    parser.add_argument('-w', '--metadata-workers', help="Parallel workers to retrieve image metadata. "
+    parser.add_argument('--token-batch-size', help="Maximum amount of repositories put into one token, if the "
+                                                   "registry server uses token authentication. Default value is 10.",
+                        default=10, type=int, dest='token_batch_size')
+    parser.add_argument('-w', '--metadata-workers', help="Parallel workers per repository to retrieve image metadata. "
                                                          "Default value is 6.",
                         default=6, type=int, dest='md_workers')
+    parser.add_argument('--max-inflight', help="Maximum amount of parallel requests to the registry server over "
+                                               "all repositories. Default value is 64.",
+                        default=64, type=int, dest='max_inflight')
+    parser.add_argument('--min-inflight', help="Minimum amount of parallel requests to the registry server. The "
+                                               "amount of parallel requests starts with this value and adapts "
+                                               "between it and --max-inflight to the load of the registry server. "
+                                               "Default value is 4.",
+                        default=4, type=int, dest='min_inflight')
+    parser.add_argument('--page-size', help="Amount of entries requested per page when listing the catalog "
+                                            "and the tags of a repository. "
+                                            "Default value is 100.",
+                        default=100, type=int, dest='page_size')
+    parser.add_argument('--cache-dir', help="Directory of a persistent cache for the creation dates of image digests. "
+                                            "Only digests which aren't cached are retrieved from the registry. "
+                                            "By default no cache is used.",
+                        default=None, dest='cache_dir')
+    parser.add_argument('--cache-size', help="Maximum amount of digests kept in the cache, the least recently used "
+                                             "ones are evicted. Default value is 1000000.",
+                        default=1000000, type=int, dest='cache_size')
+    parser.add_argument('--incremental', help="Keep a snapshot of the tags of each repository in the cache directory "
+                                              "and only rescan repositories and tags which have changed since the "
+                                              "previous run. Needs [--cache-dir].",
+                        default=False, action='store_true', dest='incremental')
+    parser.add_argument('--pipeline', help="Plan and delete the images of each repository as soon as it is scanned, "
+                                           "while other repositories are still scanned. Needs [-y] and can't be "
+                                           "used together with [-i].",
+                        default=False, action='store_true', dest='pipeline')
+    parser.add_argument('--storage-root', help="Root directory of the storage of a registry using the filesystem "
+                                               "storage driver. If set, the repositories, tags and images are read "
+                                               "from the storage instead of the registry server, deletions are still "
+                                               "sent to the registry server.",
+                        default=None, dest='storage_root')
+    parser.add_argument('--storage-workers', help="Parallel workers reading the storage. Default value is 8.",
+                        default=8, type=int, dest='storage_workers')
+    parser.add_argument('--save-snapshot', help="Write the tags, creation dates and digests of all scanned "
+                                                "repositories to this file, to evaluate policies later with "
+                                                "[--from-snapshot].",
+                        default=None, dest='save_snapshot')
+    parser.add_argument('--from-snapshot', help="Evaluate the policy against a file written with [--save-snapshot] "
+                                                "instead of the registry server and report which tags would be "
+                                                "deleted. Nothing is deleted.",
+                        default=None, dest='from_snapshot')
+    parser.add_argument('--what-if', help="Reposfiles with policies which are evaluated and compared with "
+                                          "[--from-snapshot], each one instead of [-f].",
+                        default=None, nargs='+', dest='what_if')
+    parser.add_argument('--write-plan', help="Write the tags and digests to be deleted to this file, one JSON "
+                                             "object per line, and exit without deleting. The plan can be applied "
+                                             "later with [--apply-plan].",
+                        default=None, dest='write_plan')
+    parser.add_argument('--apply-plan', help="Delete the digests of a file written with [--write-plan] without "
+                                             "scanning the registry server. Each tag is checked to still point to "
+                                             "the planned digest before.",
+                        default=None, dest='apply_plan')
+    parser.add_argument('--journal', help="Append the scanned tags, completed repositories and deletions to this "
+                                          "file, to continue an interrupted run with [--resume].",
+                        default=None, dest='journal')
+    parser.add_argument('--resume', help="Continue the run recorded in [--journal]: completed repositories and "
+                                         "tags aren't scanned again, deleted manifests aren't deleted again.",
+                        default=False, action='store_true', dest='resume')
+    parser.add_argument('--serve', help="Keep running after the first cleanup and listen on this port for the "
+                                        "notifications of the registry server. Pushed and deleted tags are "
+                                        "updated in memory, the repositories are cleaned up without scanning them "
+                                        "again. Needs [-y].",
+                        default=None, type=int, dest='serve')
+    parser.add_argument('--serve-host', help="Address to listen on for notifications with [--serve]. "
+                                             "Default value is 127.0.0.1.",
+                        default='127.0.0.1', dest='serve_host')
+    parser.add_argument('--serve-token', help="Only accept notifications with the header Authorization: Bearer "
+                                              "SERVE_TOKEN with [--serve]. By default all notifications are "
+                                              "accepted.",
+                        default=None, dest='serve_token')
+    parser.add_argument('--serve-interval', help="Seconds between the cleanups of the repositories pushed to with "
+                                                 "[--serve]. With 0 a repository is cleaned up right after each "
+                                                 "push. Default value is 60.",
+                        default=60, type=float, dest='serve_interval')
+    parser.add_argument('--shard-index', help="Index of the share of the repositories scanned and cleaned up by this "
+                                              "instance, starting with 0. Default value is 0.",
+                        default=0, type=int, dest='shard_index')
+    parser.add_argument('--shard-count', help="Amount of instances which scan and clean up a share of the "
+                                              "repositories each. Default value is 1.",
+                        default=1, type=int, dest='shard_count')
+    parser.add_argument('--export-refs', help="Write the digest references of the scanned repositories to this file "
+                                              "and exit without deleting. Needs [-i].",
+                        default=None, dest='export_refs')
+    parser.add_argument('--import-refs', help="Add the digest references of the other shards, written with "
+                                              "[--export-refs], before deleting. Needs [-i].",
+                        default=None, nargs='+', dest='import_refs')
+    parser.add_argument('--delete-workers', help="Maximum amount of parallel deletions. Default value is 4.",
+                        default=4, type=int, dest='delete_workers')
+    parser.add_argument('--delete-rate', help="Maximum amount of deletions per second. By default the deletions "
+                                              "are not limited.",
+                        default=None, type=float, dest='delete_rate')
+    parser.add_argument('--max-failures', help="Amount of failed deletions which are tolerated before exiting with "
+                                               "an error. Default value is 0.",
+                        default=0, type=int, dest='max_failures')
+    parser.add_argument('--metrics-file', help="Write the wall time of each phase and metrics of the requests and "
+                                               "workers to this file at the end of the run. Written as Prometheus "
+                                               "textfile if the name ends with .prom, otherwise as JSON.",
+                        default=None, dest='metrics_file')
+    parser.add_argument('--trace-file', help="Write a line for each request to the registry server to this file.",
+                        default=None, dest='trace_file')
+    parser.add_argument('--pool-size', help="Maximum amount of pooled keep-alive connections to the registry server. "
+                                            "Default value is the value of --max-inflight.",
+                        default=None, type=int, dest='pool_size')
+    parser.add_argument('--http-retries', help="How often an idempotent request (GET, HEAD) is retried on connection "
+                                               "errors or on the status codes 429, 500, 502, 503 and 504. "
+                                               "Default value is 3.",
+                        default=3, type=int, dest='http_retries')
+    parser.add_argument('--retry-backoff', help="Backoff factor in seconds between retries, doubled on each retry. "
+                                                "Default value is 0.5.",
+                        default=0.5, type=float, dest='retry_backoff')
+    parser.add_argument('--http-timeout', help="Timeout in seconds to connect to the registry server and to wait "
+                                               "for each response, a request which times out counts as failed. "
+                                               "Default value is 30.",
+                        default=30.0, type=float, dest='http_timeout')
+    parser.add_argument('--report-connections', help="Print at the end how many requests were sent and how often "
+                                                     "a pooled connection could be reused.",
+                        default=False, action='store_true', dest='report_connections')
+    return parser
 
+
+def parse_arguments():
+    parser = create_parser()
     args = parser.parse_args()
 
     # check if keepimages is set that it is not negative
     if (args.keepimages is not None) and (args.keepimages < 0):
         parser.error("[-k] has to be a positive integer!")
 
+    if args.token_batch_size < 1:
+        parser.error("[--token-batch-size] has to be at least 1!")
+
+    if args.md_workers < 1:
+        parser.error("[-w] has to be at least 1!")
+
+    if args.max_inflight < 1:
+        parser.error("[--max-inflight] has to be at least 1!")
+
+    if args.min_inflight < 1:
+        parser.error("[--min-inflight] has to be at least 1!")
+
+    if args.min_inflight > args.max_inflight:
+        args.min_inflight = args.max_inflight
+
+    if args.page_size < 1:
+        parser.error("[--page-size] has to be at least 1!")
+
+    if args.cache_size < 1:
+        parser.error("[--cache-size] has to be at least 1!")
+
+    if args.incremental and args.cache_dir is None:
+        parser.error("[--incremental] needs [--cache-dir]!")
+
+    if args.delete_workers < 1:
+        parser.error("[--delete-workers] has to be at least 1!")
+
+    if args.delete_rate is not None and args.delete_rate <= 0:
+        parser.error("[--delete-rate] has to be greater than 0!")
+
+    if args.max_failures < 0:
+        parser.error("[--max-failures] has to be a positive integer!")
+
+    # the deletion plan of a repository must only depend on the repository itself
+    if args.pipeline and args.ignoretag:
+        parser.error("[--pipeline] and [-i] cant be used together")
+
+    if args.pipeline and not (args.assumeyes or args.quiet):
+        parser.error("[--pipeline] needs [-y]!")
+
+    if args.storage_root is not None:
+        if not os.path.isdir(os.path.join(args.storage_root, 'docker', 'registry', 'v2', 'repositories')):
+            parser.error("[--storage-root] has to contain docker/registry/v2/repositories!")
+        if args.pipeline or args.incremental:
+            parser.error("[--storage-root] cant be used together with [--pipeline] or [--incremental]")
+
+    if args.storage_workers < 1:
+        parser.error("[--storage-workers] has to be at least 1!")
+
+    if args.save_snapshot is not None and args.from_snapshot is not None:
+        parser.error("[--save-snapshot] and [--from-snapshot] cant be used together")
+
+    if args.what_if is not None and args.from_snapshot is None:
+        parser.error("[--what-if] needs [--from-snapshot]!")
+
+    if args.resume and args.journal is None:
+        parser.error("[--resume] needs [--journal]!")
+
+    if args.write_plan is not None and args.apply_plan is not None:
+        parser.error("[--write-plan] and [--apply-plan] cant be used together")
+
+    if args.write_plan is not None and args.pipeline:
+        parser.error("[--write-plan] and [--pipeline] cant be used together")
+
+    if args.serve is not None:
+        if not (args.assumeyes or args.quiet):
+            parser.error("[--serve] needs [-y]!")
+        if args.pipeline or args.storage_root is not None or args.journal is not None or \
+                args.write_plan is not None or args.apply_plan is not None or args.from_snapshot is not None:
+            parser.error("[--serve] cant be used together with [--pipeline], [--storage-root], [--journal], "
+                         "[--write-plan], [--apply-plan] or [--from-snapshot]")
+        if args.export_refs is not None or args.import_refs is not None:
+            parser.error("[--serve] cant be used together with [--export-refs] or [--import-refs]")
+
+    if args.serve_interval < 0:
+        parser.error("[--serve-interval] has to be a positive number!")
+
+    if args.shard_count < 1:
+        parser.error("[--shard-count] has to be at least 1!")
+
+    if args.shard_index < 0 or args.shard_index >= args.shard_count:
+        parser.error("[--shard-index] has to be between 0 and [--shard-count] - 1!")
+
+    if (args.export_refs is not None or args.import_refs is not None) and not args.ignoretag:
+        parser.error("[--export-refs] and [--import-refs] need [-i]!")
+
+    if args.delete_tags and (args.export_refs is not None or args.import_refs is not None):
+        parser.error("[--delete-tags] doesn't need [--export-refs] or [--import-refs]")
+
+    if args.export_refs is not None and args.import_refs is not None:
+        parser.error("[--export-refs] and [--import-refs] cant be used together")
+
+    # a shard only knows the references of its own repositories
+    if args.ignoretag and args.shard_count > 1 and args.export_refs is None and args.import_refs is None:
+        parser.error("[-i] with [--shard-count] needs [--export-refs] or [--import-refs]!")
+
+    if args.pool_size is None:
+        args.pool_size = args.max_inflight
+    elif args.pool_size < 1:
+        parser.error("[--pool-size] has to be at least 1!")
+
+    if args.http_retries < 0:
+        parser.error("[--http-retries] has to be a positive integer!")
+
+    if args.http_timeout <= 0:
+        parser.error("[--http-timeout] has to be greater than 0!")
+
     # check if date is valid
     if args.since is not None:
         if parse_date(args.since) == "":
@@ -111,11 +370,32 @@ def parse_arguments():
 
     # hackish dependent arguments
     # Either one of these parameters has to be used
-    if bool(args.reponame) is False and args.clean_full_catalog is False and bool(args.reposfile) is False:
+    if bool(args.reponame) is False and args.clean_full_catalog is False and bool(args.reposfile) is False and \
+            args.what_if is None and args.apply_plan is None:
         parser.error("[-n|-k] or [-cf|-k] or [-f] has to be used!")
     return args
 
 
+def create_config(registry, **options):
+    """
+    Creates a configuration to use cleanreg as a library, with the default values of the command line options.
+    The options are named like the attributes of the parsed command line arguments, e.g. keepimages, md_workers
+    or clean_full_catalog. Unlike the command line, the options aren't validated.
+
+    :param registry: The registry server to connect to, e.g. http://1.2.3.4:5000
+    :param options: The options which differ from the default values
+    :return: The configuration
+    """
+    config = create_parser().parse_args(['-r', registry])
+    for name, value in options.items():
+        if not hasattr(config, name):
+            raise TypeError("Unknown option {0}".format(name))
+        setattr(config, name, value)
+    if config.pool_size is None:
+        config.pool_size = config.max_inflight
+    return config
+
+
 def parse_date(date_string):
     """
     Converts a string to datetime
@@ -138,6 +418,74 @@ def parse_date(date_string):
     return date
 
 
+def parse_creation_date(date_string):
+    """
+    Converts the creation date of an image, e.g. 2022-01-01T10:00:00.123456789Z, to seconds since the epoch.
+    Fractions of seconds and the Zulu-Time marker are ignored.
+    :param date_string: the creation date as string
+    :return: the creation date as integer
+    """
+    return calendar.timegm((int(date_string[0:4]), int(date_string[5:7]), int(date_string[8:10]),
+                            int(date_string[11:13]), int(date_string[14:16]), int(date_string[17:19])))
+
+
+# used for images without the optional creation date, like images built reproducibly with the date of the epoch
+MISSING_CREATION_DATE = '1970-01-01T00:00:00Z'
+
+
+def get_created(image_config, reference):
+    """
+    Returns the creation date of an image config or of a schema1 history entry.
+    As the creation date is optional, an image without one is treated as created at the epoch, the oldest date.
+    :param image_config: the image config as dict
+    :param reference: the digest of the image or config, to name it in the warning
+    :return: the creation date as string
+    """
+    created = image_config.get('created')
+    if created is None:
+        print ("Warning: {0} has no creation date, treating it as created at {1}.".format(reference,
+                                                                                       MISSING_CREATION_DATE))
+        return MISSING_CREATION_DATE
+    return created
+
+
+SEMVER_PATTERN = re.compile(r'^v?(\d+)\.(\d+)\.(\d+)(?:-([0-9A-Za-z.-]+))?(?:\+[0-9A-Za-z.-]+)?$')
+
+
+def numeric_tag_key(tag):
+    """
+    Orders tags which are numbers, e.g. build numbers or timestamps.
+    :return: the number or None if the tag isn't a number
+    """
+    return int(tag) if tag.isdigit() else None
+
+
+def semver_tag_key(tag):
+    """
+    Orders tags which are semantic versions like 1.2.3, v1.2.3-rc.1 or 1.2.3+build.5.
+    A pre-release is older than its release, the build metadata is ignored.
+    :return: a sortable tuple or None if the tag isn't a semantic version
+    """
+    match = SEMVER_PATTERN.match(tag)
+    if match is None:
+        return None
+    major, minor, patch, prerelease = match.groups()
+    if prerelease is None:
+        release = (1,)
+    else:
+        # identifiers are compared numerically if they are numbers, numbers are older than other identifiers
+        release = (0,) + tuple((0, int(part), '') if part.isdigit() else (1, 0, part)
+                               for part in prerelease.split('.'))
+    return int(major), int(minor), int(patch), release
+
+
+# the functions returning the sort key of a tag for each order, None orders by creation date
+TAG_ORDERS = collections.OrderedDict([('date', None),
+                                      ('lexical', lambda tag: tag),
+                                      ('numeric', numeric_tag_key),
+                                      ('semver', semver_tag_key)])
+
+
 def update_progress(current, maximum, factor=2):
     if maximum == 0:
         raise Exception('Maximum amount should not be zero.')
@@ -187,12 +535,13 @@ def print_headers(headers):
         print ("  > {0}   ->  {1}".format(header_element, headers.get(header_element)))
 
 
-def is_v2_registry(verbose, regserver, cacert=None):
+def is_v2_registry(verbose, regserver, cacert=None, transport=None):
     """
     Checks if the given server is really a v2 registry.
     :param verbose: verbosity level
     :param regserver: the URL of the reg server
     :param cacert: the path to a cacert file
+    :param transport: the RegistryTransport to send the requests with, by default the one of get_transport()
     :return: True if it is really a v2 server
     """
 
@@ -200,7 +549,7 @@ def is_v2_registry(verbose, regserver, cacert=None):
         print ('Check if registry server supports v2...')
     check_url = regserver
 
-    check_result = requests.get(check_url, verify=cacert, auth=get_auth())
+    check_result = (transport or get_transport(regserver)).get(check_url, verify=cacert)
 
     if verbose > 1:
         print ("Check result code:", check_result.status_code)
@@ -233,19 +582,528 @@ def generate_request_headers(api_version=2):
     if api_version == 1:
         accept_string = 'application/vnd.docker.distribution.manifest.v1+json'
     else:
-        accept_string = 'application/vnd.docker.distribution.manifest.v2+json'
+        accept_string = 'application/vnd.docker.distribution.manifest.v2+json, ' \
+                        'application/vnd.oci.image.manifest.v1+json'
     headers = {'Accept': accept_string}
     return headers
 
 
-def get_auth():
-    if (args.basicauthuser is not None) and (args.basicauthpw is not None):
-        return HTTPBasicAuth(args.basicauthuser, args.basicauthpw)
-    else:
+class RegistryAuth(AuthBase):
+    """
+    Authenticates the requests against the registry server with basic auth or with bearer tokens.
+    If the registry server answers with a bearer challenge (WWW-Authenticate: Bearer realm=...,scope=...), a token
+    for the requested scope is retrieved from the token server, using the basic auth credentials if given.
+    Tokens are cached per scope until shortly before they expire, so following requests for the same
+    repository and action don't need a challenge anymore. Tokens for many repositories can be requested at
+    once with prefetch().
+    """
+
+    # tokens are renewed this amount of seconds before they expire
+    EXPIRY_MARGIN = 10
+
+    def __init__(self, username=None, password=None, batch_size=10):
+        self.username = username
+        self.password = password
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        # realm and service of the token server, known after the first challenge
+        self.challenge = None
+        # (repository, method) -> scope, as learned from the challenges
+        self.scopes = {}
+        # scope -> (token, expiry time)
+        self.tokens = {}
+        self.scope_locks = {}
+        self.token_requests = 0
+        self.session = requests.Session()
+
+    @staticmethod
+    def resource(url):
+        """
+        Returns the repository a request URL belongs to, _catalog for the catalog and an empty string otherwise.
+        """
+        path = urlparse(url).path
+        path = path[path.find('/v2/') + len('/v2/'):]
+        for separator in ('/manifests/', '/blobs/', '/tags/list'):
+            if separator in path:
+                return path[:path.index(separator)].rstrip('/')
+        return path.rstrip('/')
+
+    @staticmethod
+    def parse_challenge(header):
+        scheme, _, params = header.partition(' ')
+        return scheme.lower(), dict(re.findall(r'(\w+)="([^"]*)"', params))
+
+    def cached_token(self, scope):
+        with self.lock:
+            token = self.tokens.get(scope)
+        if token is not None and token[1] > time.time():
+            return token[0]
         return None
 
+    def fetch_token(self, scopes, verify=None):
+        """
+        Retrieves a token for the given scopes from the token server and caches it for each of them.
+        :return: the token or None if the token server refused it
+        """
+        params = [('service', self.challenge['service'])] if 'service' in self.challenge else []
+        params.extend(('scope', scope) for scope in scopes if scope != '')
+        auth = None
+        if self.username is not None and self.password is not None:
+            auth = HTTPBasicAuth(self.username, self.password)
+        started = time.time()
+        token_result = self.session.get(self.challenge['realm'], params=params, auth=auth, verify=verify)
+        metrics.record_request('GET', self.challenge['realm'], token_result.status_code, time.time() - started,
+                               len(token_result.content), started, 'token')
+        with self.lock:
+            self.token_requests += 1
+        if token_result.status_code != requests.codes.ok:
+            print ("A token for {0} could not be retrieved due to error: {1}".format(scopes,
+                                                                                   token_result.status_code))
+            return None
+        token_json = token_result.json()
+        token = token_json.get('token') or token_json.get('access_token')
+        expires_in = int(token_json.get('expires_in', 60))
+        expires = time.time() + max(expires_in - self.EXPIRY_MARGIN, expires_in / 2.0)
+        with self.lock:
+            for scope in scopes:
+                self.tokens[scope] = (token, expires)
+        return token
+
+    def token_for(self, scope, verify=None):
+        """
+        Returns a valid token for a scope, only one thread retrieves a token for the same scope at a time.
+        """
+        token = self.cached_token(scope)
+        if token is not None:
+            return token
+        with self.lock:
+            scope_lock = self.scope_locks.setdefault(scope, threading.Lock())
+        with scope_lock:
+            token = self.cached_token(scope)
+            if token is None:
+                token = self.fetch_token([scope], verify)
+        return token
+
+    def prefetch(self, repositories, methods, verify=None):
+        """
+        Retrieves the tokens for the given repositories and methods with as few requests to the token server as
+        possible, putting up to batch_size repository scopes into one token. Does nothing if the registry
+        server didn't send a bearer challenge yet.
+        """
+        if self.challenge is None:
+            return
+        missing = []
+        for repo in repositories:
+            for method in methods:
+                action = 'delete' if method == 'DELETE' else 'pull'
+                with self.lock:
+                    scope = self.scopes.setdefault((repo, method), 'repository:{0}:{1}'.format(repo, action))
+                if scope not in missing and self.cached_token(scope) is None:
+                    missing.append(scope)
+        for i in range(0, len(missing), self.batch_size):
+            self.fetch_token(missing[i:i + self.batch_size], verify)
+
+    def handle_401(self, response, **kwargs):
+        """
+        Answers a bearer challenge of the registry server with a token and resends the request.
+        """
+        scheme, challenge = self.parse_challenge(response.headers.get('WWW-Authenticate', ''))
+        if response.status_code != 401 or scheme != 'bearer' or 'realm' not in challenge:
+            return response
+        scope = challenge.get('scope', '')
+        with self.lock:
+            self.challenge = challenge
+            self.scopes[(self.resource(response.request.url), response.request.method)] = scope
+            # the cached token was refused, e.g. as it was revoked, so a new one is needed
+            if response.request.headers.get('Authorization', '').startswith('Bearer '):
+                self.tokens.pop(scope, None)
+        token = self.token_for(scope, kwargs.get('verify'))
+        if token is None:
+            return response
+
+        # consume the content so the connection can be reused
+        response.content
+        response.close()
+        prepared = response.request.copy()
+        prepared.headers['Authorization'] = 'Bearer {0}'.format(token)
+        retried = response.connection.send(prepared, **kwargs)
+        retried.history.append(response)
+        retried.request = prepared
+        return retried
+
+    def __call__(self, request):
+        with self.lock:
+            scope = self.scopes.get((self.resource(request.url), request.method))
+        token = self.cached_token(scope) if scope is not None else None
+        if token is not None:
+            request.headers['Authorization'] = 'Bearer {0}'.format(token)
+        elif self.challenge is None and self.username is not None and self.password is not None:
+            request = HTTPBasicAuth(self.username, self.password)(request)
+        request.register_hook('response', self.handle_401)
+        return request
+
+
+def get_auth(config):
+    return RegistryAuth(config.basicauthuser, config.basicauthpw, config.token_batch_size)
+
+
+def parse_retry_after(value):
+    """
+    Converts the value of a Retry-After header, seconds or a HTTP date, to seconds.
+    :return: the seconds to wait or None if the value is missing or invalid
+    """
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveLimiter(object):
+    """
+    Limits the amount of parallel requests with additive-increase/multiplicative-decrease.
+    The limit starts at minimum and grows by one for each window of successful requests, up to maximum.
+    It is halved on throttling responses (429, 503) and reduced by a quarter if the recent latency rises to more
+    than twice the long term average, at most once per window. A Retry-After header pauses all requests.
+    Used by the threads of the transport, so all methods are thread safe.
+    """
+
+    THROTTLING_STATUSES = (429, 503)
+    LATENCY_FACTOR = 2.0
+
+    def __init__(self, minimum, maximum):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(minimum)
+        self.active = 0
+        self.paused_until = 0.0
+        self.latency = None
+        self.base_latency = None
+        # amount of observations until the limit may be reduced again
+        self.cooldown = 0
+        self.throttled = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                wait = self.paused_until - time.time()
+                if wait <= 0 and self.active < int(self.limit):
+                    break
+                self.condition.wait(wait if wait > 0 else None)
+            self.active += 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def observe(self, status, elapsed, retry_after=None):
+        """
+        Adapts the limit to the result of a request.
+        """
+        with self.condition:
+            self.cooldown = max(self.cooldown - 1, 0)
+            if retry_after is not None and retry_after > 0:
+                self.paused_until = max(self.paused_until, time.time() + retry_after)
+            if status in self.THROTTLING_STATUSES:
+                self.throttled += 1
+                self.decrease(0.5)
+                return
+            # a short and a long term average of the latency, the long one serves as baseline
+            self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+            self.base_latency = elapsed if self.base_latency is None else 0.98 * self.base_latency + 0.02 * elapsed
+            if self.latency > self.LATENCY_FACTOR * self.base_latency:
+                self.decrease(0.75)
+                return
+            previous = int(self.limit)
+            self.limit = min(self.limit + 1.0 / self.limit, float(self.maximum))
+            if int(self.limit) > previous:
+                self.condition.notify()
+
+    def decrease(self, factor):
+        if self.cooldown == 0:
+            self.limit = max(self.limit * factor, float(self.minimum))
+            self.cooldown = int(self.limit)
+
+    def print_stats(self):
+        print ("Concurrency: final limit {0} (bounds {1} to {2}), {3} throttling responses.".format(
+            int(self.limit), self.minimum, self.maximum, self.throttled))
+
+
+class RegistryTransport(object):
+    """
+    Owns a pooled keep-alive HTTP session which is used for all calls against the registry server.
+    Idempotent requests (GET, HEAD) are retried with an exponential backoff or as long as a Retry-After
+    header tells, DELETE is never retried. With an AdaptiveLimiter the amount of parallel requests adapts
+    to the load of the registry server.
+    Every request times out after timeout seconds unless another timeout is given, so that a hung
+    connection can't block a worker forever.
+    A transport can be shared between threads but not between processes, use get_transport() to retrieve
+    the one of a registry server in the current process.
+    """
 
-def get_digest_by_tag(verbose, regserver, repository, tag, cacert=None):
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, auth=None, pool_size=10, retries=3, backoff=0.5, limiter=None, timeout=30.0):
+        self.pid = os.getpid()
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.limiter = limiter
+        # connection errors are retried by urllib3, status codes only by request() to let the limiter see them,
+        # urllib3 would otherwise retry 429 and 503 responses with a Retry-After header by itself
+        retry = Retry(total=retries, status=0, backoff_factor=backoff, status_forcelist=None,
+                      allowed_methods=frozenset(['GET', 'HEAD']), respect_retry_after_header=False,
+                      raise_on_status=False)
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.auth = auth
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            if self.limiter is not None:
+                self.limiter.acquire()
+            started = time.time()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            finally:
+                if self.limiter is not None:
+                    self.limiter.release()
+            elapsed = time.time() - started
+            metrics.record_request(method, url, response.status_code, elapsed, len(response.content), started)
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if self.limiter is not None:
+                self.limiter.observe(response.status_code, elapsed, retry_after)
+
+            if response.status_code not in self.RETRY_STATUSES or method not in ('GET', 'HEAD') or \
+                    attempt >= self.retries:
+                return response
+            if retry_after is None:
+                retry_after = self.backoff * (2 ** attempt)
+            attempt += 1
+            time.sleep(retry_after)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def stats(self):
+        """
+        Returns the amount of requests sent and connections opened by this transport.
+        Every request which didn't need a new connection reused a pooled one.
+        :return: a dict with the keys requests, connections and reused
+        """
+        sent = 0
+        opened = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                sent += pool.num_requests
+                opened += pool.num_connections
+        return {'requests': sent, 'connections': opened, 'reused': max(sent - opened, 0)}
+
+
+class Metrics(object):
+    """
+    Collects the wall time of each phase, the count, latency and transferred bytes of the requests per endpoint
+    type, method and status code and the utilisation of the workers.
+    The report can be written as JSON or as a Prometheus textfile, each request can be traced to a file.
+    """
+
+    # upper bounds of the latency histogram buckets in seconds
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = collections.OrderedDict()
+        self.requests = {}
+        self.workers = collections.OrderedDict()
+        self.trace = None
+
+    @staticmethod
+    def endpoint_type(url):
+        path = urlparse(url).path
+        if path.endswith('/_catalog'):
+            return 'catalog'
+        if path.endswith('/tags/list'):
+            return 'tags'
+        if '/manifests/' in path:
+            return 'manifest'
+        if '/blobs/' in path:
+            return 'blob'
+        return 'base'
+
+    def open_trace(self, trace_file):
+        self.trace = open(trace_file, 'w')
+
+    def record_request(self, method, url, status, elapsed, size, started, endpoint=None):
+        if endpoint is None:
+            endpoint = self.endpoint_type(url)
+        with self.lock:
+            data = self.requests.get((endpoint, method, status))
+            if data is None:
+                data = self.requests[(endpoint, method, status)] = {'count': 0, 'seconds': 0.0, 'bytes': 0,
+                                                                    'buckets': [0] * len(self.BUCKETS)}
+            data['count'] += 1
+            data['seconds'] += elapsed
+            data['bytes'] += size
+            for i, bound in enumerate(self.BUCKETS):
+                if elapsed <= bound:
+                    data['buckets'][i] += 1
+                    break
+            if self.trace is not None:
+                self.trace.write(json.dumps({'time': started, 'thread': threading.current_thread().name,
+                                             'method': method, 'url': url, 'endpoint': endpoint, 'status': status,
+                                             'seconds': round(elapsed, 6), 'bytes': size}) + '\n')
+
+    def record_phase(self, phase, started):
+        self.phases[phase] = self.phases.get(phase, 0.0) + time.time() - started
+
+    def record_workers(self, phase, workers, busy, elapsed):
+        """
+        Records how much of the time workers were busy with requests.
+        """
+        capacity = workers * elapsed
+        self.workers[phase] = {'workers': workers, 'busy_seconds': busy,
+                               'utilisation': busy / capacity if capacity > 0 else 0.0}
+
+    def report(self):
+        requests_report = []
+        for (endpoint, method, status), data in sorted(self.requests.items()):
+            histogram = collections.OrderedDict()
+            cumulated = 0
+            for bound, count in zip(self.BUCKETS, data['buckets']):
+                cumulated += count
+                histogram[str(bound)] = cumulated
+            histogram['+Inf'] = data['count']
+            requests_report.append({'endpoint': endpoint, 'method': method, 'status': status,
+                                    'count': data['count'], 'seconds': data['seconds'], 'bytes': data['bytes'],
+                                    'histogram': histogram})
+        return {'phases': self.phases, 'requests': requests_report, 'workers': self.workers}
+
+    def prometheus(self):
+        lines = ['# HELP cleanreg_phase_seconds Wall time of a phase of the run.',
+                 '# TYPE cleanreg_phase_seconds gauge']
+        for phase, seconds in self.phases.items():
+            lines.append('cleanreg_phase_seconds{{phase="{0}"}} {1}'.format(phase, seconds))
+        lines.extend(['# HELP cleanreg_request_duration_seconds Latency of the requests to the registry server.',
+                      '# TYPE cleanreg_request_duration_seconds histogram'])
+        size_lines = ['# HELP cleanreg_response_bytes_total Bytes received from the registry server.',
+                      '# TYPE cleanreg_response_bytes_total counter']
+        for data in self.report()['requests']:
+            labels = 'endpoint="{0}",method="{1}",status="{2}"'.format(data['endpoint'], data['method'],
+                                                                     data['status'])
+            for bound, count in data['histogram'].items():
+                lines.append('cleanreg_request_duration_seconds_bucket{{{0},le="{1}"}} {2}'.format(labels, bound,
+                                                                                                 count))
+            lines.append('cleanreg_request_duration_seconds_sum{{{0}}} {1}'.format(labels, data['seconds']))
+            lines.append('cleanreg_request_duration_seconds_count{{{0}}} {1}'.format(labels, data['count']))
+            size_lines.append('cleanreg_response_bytes_total{{{0}}} {1}'.format(labels, data['bytes']))
+        lines.extend(size_lines)
+        lines.extend(['# HELP cleanreg_worker_utilisation Share of the time the workers were busy with requests.',
+                      '# TYPE cleanreg_worker_utilisation gauge'])
+        for phase, data in self.workers.items():
+            lines.append('cleanreg_worker_utilisation{{phase="{0}"}} {1}'.format(phase, data['utilisation']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, metrics_file):
+        """
+        Writes the report to a file, as Prometheus textfile if the name ends with .prom otherwise as JSON.
+        The file is replaced atomically, so a collector never reads a partial report.
+        """
+        with self.lock:
+            if metrics_file.endswith('.prom'):
+                content = self.prometheus()
+            else:
+                content = json.dumps(self.report(), indent=2)
+        with open(metrics_file + '.tmp', 'w') as out:
+            out.write(content)
+        os.replace(metrics_file + '.tmp', metrics_file)
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+
+
+metrics = Metrics()
+
+
+# registry server -> transport of the current process
+_transports = {}
+
+
+def create_transport(config):
+    """
+    Creates a transport with the connection settings of a configuration.
+    :param config: the command line arguments or a configuration of create_config()
+    :return: the RegistryTransport
+    """
+    return RegistryTransport(get_auth(config), config.pool_size, config.http_retries, config.retry_backoff,
+                             AdaptiveLimiter(config.min_inflight, config.max_inflight), config.http_timeout)
+
+
+def get_transport(regserver=None):
+    """
+    Returns the transport of a registry server in the current process, configured by the command line arguments
+    or, if cleanreg is imported, by the default values of the command line options. It is created on first use and
+    again after a fork, as pooled connections can't be shared between processes.
+    A RegistryClient doesn't use it but has a transport of its own.
+    """
+    transport = _transports.get(regserver)
+    if transport is None or transport.pid != os.getpid():
+        transport = _transports[regserver] = create_transport(args if args is not None else create_config(''))
+    return transport
+
+
+def print_transport_stats(stats):
+    if stats['requests'] > 0:
+        ratio = (100.0 * stats['reused']) / stats['requests']
+    else:
+        ratio = 0.0
+    print ("Connections: {0} requests sent over {1} connections, {2} requests ({3:.1f}%) reused a pooled "
+           "connection.".format(stats['requests'], stats['connections'], stats['reused'], ratio))
+
+
+class RegistryError(Exception):
+    """
+    A request to the registry server failed. Unless it's handled, cleanreg exits with exit_code.
+    """
+
+    def __init__(self, message, exit_code=2):
+        Exception.__init__(self, message)
+        self.exit_code = exit_code
+
+
+class ConfigError(Exception):
+    """
+    The configuration, a reposfile or a file written by an earlier run is invalid. Unless it's handled, cleanreg
+    exits with exit_code.
+    """
+
+    def __init__(self, message, exit_code=1):
+        Exception.__init__(self, message)
+        self.exit_code = exit_code
+
+
+def get_digest_by_tag(verbose, regserver, repository, tag, cacert=None, known_digest=None, missing_ok=False,
+                      transport=None):
     """
     Retrieves the Digest of an image tag.
 
@@ -254,14 +1112,19 @@ def get_digest_by_tag(verbose, regserver, repository, tag, cacert=None):
     :param repository: the repositroy name
     :param tag: the tag of the image
     :param cacert: the path to a cacert file
+    :param known_digest: the digest the tag pointed to before, it is returned if the registry confirms it
+    :param missing_ok: return None instead of exiting if the tag doesn't exist
+    :param transport: the RegistryTransport to send the requests with, by default the one of get_transport()
     :return: The docker image digest
     """
     # set accept type
     req_headers = generate_request_headers()
+    if known_digest is not None:
+        req_headers['If-None-Match'] = '"{0}"'.format(known_digest)
     req_url = regserver + repository + "/manifests/" + tag
     if verbose > 1:
         print ("Will use following URL to retrieve digest:", req_url)
-    head_result = requests.head(req_url, headers=req_headers, verify=cacert, auth=get_auth())
+    head_result = (transport or get_transport(regserver)).head(req_url, headers=req_headers, verify=cacert)
 
     head_status = head_result.status_code
     if verbose > 2:
@@ -269,16 +1132,19 @@ def get_digest_by_tag(verbose, regserver, repository, tag, cacert=None):
         print ("Digest head header is:")
         print_headers(head_result.headers)
 
+    if known_digest is not None and head_status == requests.codes.not_modified:
+        return known_digest
+    if missing_ok and head_status == requests.codes.not_found:
+        return None
+
     # check the return code and exit if not OK
     if head_status != requests.codes.ok:
-        print ("The digest could not be retrieved due to error:", head_status)
         if verbose > 0:
             print (head_result)
-        sys.exit(2)
+        raise RegistryError("The digest could not be retrieved due to error: {0}".format(head_status))
     # if the header doesn't contains the digest information exit, too
     if 'Docker-Content-Digest' not in head_result.headers:
-        print ("Could not find any digest information in the header. Exiting")
-        sys.exit(3)
+        raise RegistryError("Could not find any digest information in the header. Exiting", 3)
     # everything looks fine so we continue
     cur_digest = head_result.headers['Docker-Content-Digest']
 
@@ -288,16 +1154,19 @@ def get_digest_by_tag(verbose, regserver, repository, tag, cacert=None):
     return cur_digest
 
 
-def delete_manifest(verbose, regserver, repository, cur_digest, cacert=None):
+def delete_manifest(verbose, regserver, repository, cur_digest, cacert=None, transport=None):
     """
     Deletes a manifest based on a digest.
     Be aware that a digest can be associated with multiple tags!
+    If the registry server supports it, a tag can be given instead of the digest to delete only this tag.
 
     :param verbose: verbosity level
     :param regserver: the URL of the reg server
     :param repository: the repositroy name
     :param cur_digest: the digest if the image which has to be deleted
     :param cacert: the path to a cacert file
+    :param transport: the RegistryTransport to send the requests with, by default the one of get_transport()
+    :return: the status code of the deletion
     """
     # Attention: this is needed if you are running a registry >= 2.3
     req_headers = generate_request_headers()
@@ -309,7 +1178,7 @@ def delete_manifest(verbose, regserver, repository, cur_digest, cacert=None):
     del_status_ok = 202
     if verbose > 1:
         print ("Will use following URL to delete manifest:", req_url)
-    delete_result = requests.delete(req_url, headers=req_headers, verify=cacert, auth=get_auth())
+    delete_result = (transport or get_transport(regserver)).delete(req_url, headers=req_headers, verify=cacert)
     delete_status = delete_result.status_code
     if verbose > 1:
         print ("Delete result status code is:", delete_status)
@@ -318,22 +1187,220 @@ def delete_manifest(verbose, regserver, repository, cur_digest, cacert=None):
         print_headers(delete_result.headers)
 
     if delete_status != del_status_ok:
-        print ("The manifest could not be deleted due to an error:", delete_status)
+        print ("The manifest {0} could not be deleted due to an error: {1}".format(cur_digest, delete_status))
         if verbose > 1:
             print (delete_result)
-        sys.exit(12)
+        return delete_status
 
     if verbose > 0:
         print ("Deleted manifest with digest", cur_digest)
+    return delete_status
+
+
+def supports_tag_deletion(verbose, regserver, repository, cacert=None, transport=None):
+    """
+    Checks if the registry server deletes single tags, as specified by the OCI distribution spec.
+    A tag which doesn't exist is deleted, a registry server supporting it answers that the manifest is unknown.
+    Others answer that the operation is unsupported or the digest is invalid.
+
+    :param verbose: verbosity level
+    :param regserver: the URL of the reg server
+    :param repository: an existing repository to check
+    :param cacert: the path to a cacert file
+    :param transport: the RegistryTransport to send the requests with, by default the one of get_transport()
+    :return: True if single tags can be deleted
+    """
+    req_url = regserver + repository + "/manifests/cleanreg-probe-" + os.urandom(8).hex()
+    if verbose > 1:
+        print ("Will use following URL to check the deletion of tags:", req_url)
+    probe_result = (transport or get_transport(regserver)).delete(req_url, headers=generate_request_headers(),
+                                                                  verify=cacert)
+    if verbose > 1:
+        print ("Tag deletion check result status code is:", probe_result.status_code)
+
+    if probe_result.status_code == 202:
+        return True
+    if probe_result.status_code != requests.codes.not_found:
+        return False
+    try:
+        error_codes = [error.get('code') for error in probe_result.json().get('errors', [])]
+    except ValueError:
+        return False
+    return 'MANIFEST_UNKNOWN' in error_codes
 
 
-def deletion_digests(verbose, del_tags, digests_counts, ignore):
+class DigestIndex(object):
+    """
+    Counts how often each digest is referenced by a tag over all scanned repositories and which repositories
+    reference it. Digests are stored as binary keys and repositories as numbers to keep the index compact
+    for registries with a huge amount of tags. Only digests referenced by more than SHARED_REPOS repositories
+    get an additional set of the repository ids to look them up in constant time.
+    """
+
+    SHARED_REPOS = 16
+
+    def __init__(self):
+        self.repo_ids = {}
+        self.repo_names = []
+        self.references = 0
+        # binary digest -> [amount of references, ids of the referencing repositories...]
+        self.digests = {}
+        # binary digest -> set of the ids of the referencing repositories, for shared digests only
+        self.shared = {}
+
+    @staticmethod
+    def key(digest):
+        algorithm, _, hex_digest = digest.partition(':')
+        if algorithm == 'sha256' and len(hex_digest) == 64:
+            return bytes.fromhex(hex_digest)
+        return digest.encode()
+
+    @staticmethod
+    def digest(key):
+        if len(key) == 32:
+            return 'sha256:' + key.hex()
+        return key.decode()
+
+    def repo_id(self, repo):
+        repo_id = self.repo_ids.get(repo)
+        if repo_id is None:
+            repo_id = self.repo_ids[repo] = len(self.repo_names)
+            self.repo_names.append(repo)
+        return repo_id
+
+    def append_repo_id(self, key, entry, repo_id):
+        entry.append(repo_id)
+        repo_ids = self.shared.get(key)
+        if repo_ids is not None:
+            repo_ids.add(repo_id)
+        elif len(entry) > self.SHARED_REPOS + 1:
+            self.shared[key] = set(entry[1:])
+
+    def add_repo_id(self, key, entry, repo_id):
+        """
+        Adds a repository to the ones referencing a digest, unless it's already one of them.
+        """
+        repo_ids = self.shared.get(key)
+        if repo_id not in (entry[1:] if repo_ids is None else repo_ids):
+            self.append_repo_id(key, entry, repo_id)
+
+    def remove_repo_id(self, key, entry, repo_id):
+        repo_ids = self.shared.get(key)
+        if repo_id in (entry[1:] if repo_ids is None else repo_ids):
+            del entry[entry.index(repo_id, 1)]
+            if repo_ids is not None:
+                repo_ids.discard(repo_id)
+
+    def add_repo(self, repo, tags_date_digests):
+        """
+        Adds the digests of all tags of a scanned repository.
+        """
+        repo_id = self.repo_id(repo)
+        for data in tags_date_digests.values():
+            key = self.key(data['digest'])
+            entry = self.digests.get(key)
+            if entry is None:
+                self.digests[key] = [1, repo_id]
+            else:
+                entry[0] += 1
+                # the tags of a repository are added together, so it can only be the last one added
+                if len(entry) == 1 or entry[-1] != repo_id:
+                    self.append_repo_id(key, entry, repo_id)
+        self.references += len(tags_date_digests)
+
+    def add_reference(self, repo, digest):
+        """
+        Adds the digest of a single tag, e.g. of a pushed tag.
+        """
+        repo_id = self.repo_id(repo)
+        key = self.key(digest)
+        entry = self.digests.setdefault(key, [0])
+        entry[0] += 1
+        self.add_repo_id(key, entry, repo_id)
+        self.references += 1
+
+    def remove_reference(self, repo, digest, referenced=False):
+        """
+        Removes the digest of a single tag, e.g. of a deleted tag.
+        Unless referenced is set, the repository doesn't reference the digest by another tag anymore.
+        """
+        key = self.key(digest)
+        entry = self.digests.get(key)
+        if entry is None:
+            return
+        entry[0] -= 1
+        self.references -= 1
+        if entry[0] <= 0:
+            del self.digests[key]
+            self.shared.pop(key, None)
+        elif not referenced and repo in self.repo_ids:
+            self.remove_repo_id(key, entry, self.repo_ids[repo])
+
+    def count(self, digest):
+        """
+        Returns how often a digest is referenced by a tag.
+        """
+        entry = self.digests.get(self.key(digest))
+        return 0 if entry is None else entry[0]
+
+    def repos(self, digest):
+        """
+        Returns the names of the repositories referencing a digest.
+        """
+        entry = self.digests.get(self.key(digest))
+        if entry is None:
+            return []
+        return [self.repo_names[repo_id] for repo_id in entry[1:]]
+
+    def export(self, refs_file, **info):
+        """
+        Writes the index to a JSON file together with the given information about the scan, so it can be merged
+        into the index of another instance. The file is replaced atomically.
+        """
+        content = dict(info, repos=self.repo_names, references=self.references,
+                       digests={self.digest(key): entry for key, entry in self.digests.items()})
+        with open(refs_file + '.tmp', 'w') as out:
+            json.dump(content, out)
+        os.replace(refs_file + '.tmp', refs_file)
+
+    def merge(self, content):
+        """
+        Adds the references of an exported index, the repositories of both have to be disjoint.
+        """
+        repo_ids = [self.repo_id(repo) for repo in content['repos']]
+        for digest, exported in content['digests'].items():
+            key = self.key(digest)
+            entry = self.digests.setdefault(key, [0])
+            entry[0] += exported[0]
+            for repo_id in exported[1:]:
+                self.add_repo_id(key, entry, repo_ids[repo_id])
+        self.references += content['references']
+
+    def memory_size(self):
+        """
+        Returns an estimation of the memory used by the index in bytes.
+        """
+        size = sys.getsizeof(self.digests) + sys.getsizeof(self.repo_ids) + sys.getsizeof(self.repo_names)
+        for key, entry in self.digests.items():
+            size += sys.getsizeof(key) + sys.getsizeof(entry)
+        for repo_ids in self.shared.values():
+            size += sys.getsizeof(repo_ids)
+        for repo in self.repo_ids:
+            size += sys.getsizeof(repo)
+        return size
+
+    def print_stats(self):
+        print ("Digest index: {0} digests with {1} references in {2} repos, using about {3:.1f} MB.".format(
+            len(self.digests), self.references, len(self.repo_ids), self.memory_size() / (1024.0 * 1024.0)))
+
+
+def deletion_digests(verbose, del_tags, digest_index, ignore):
     """
     High level method to retrieve digests to be deleted from a repository, based on tags.
 
     :param verbose: verbosity level
     :param del_tags The tags to be deleted of this repository
-    :param digests_counts A dict containing all digest and how often they occur
+    :param digest_index The DigestIndex of all scanned repositories, only needed if ignore is set
     :param ignore: ignore tags if their digests are referenced multiple times (occurrence > 1)
     :return The list of digests which have to be deleted
     """
@@ -341,7 +1408,7 @@ def deletion_digests(verbose, del_tags, digests_counts, ignore):
     deletion_digests = []
 
     for tag, data in del_tags.items():
-        if ignore is True and digests_counts[data['digest']] > 1:
+        if ignore is True and digest_index.count(data['digest']) > 1:
             if verbose > 0:
                 print ("Ignoring digest {0} as it is referenced multiple times!".format(data['digest']))
         else:
@@ -350,50 +1417,321 @@ def deletion_digests(verbose, del_tags, digests_counts, ignore):
     return deletion_digests
 
 
-def get_all_repos(verbose, regserver, cacert=None):
+def get_next_page_url(response, url, page, page_size):
+    """
+    Returns the URL of the next page of a paginated result.
+    The next page is announced in the Link header. If the registry doesn't send one but answered with a full
+    page, the next page is requested using the last entry.
+
+    :param response: the response of the current page
+    :param url: the URL of the current page
+    :param page: the entries of the current page
+    :param page_size: the requested amount of entries per page
+    :return: the URL of the next page or None if this was the last page
+    """
+    next_link = response.links.get('next')
+    if next_link is not None:
+        return urljoin(url, next_link['url'])
+    if len(page) == page_size:
+        return "{0}?{1}".format(url.split('?')[0], urlencode({'n': page_size, 'last': page[-1]}))
+    return None
+
+
+def in_shard(repo, shard_index, shard_count):
+    """
+    Decides if a repository belongs to a shard. The repositories are partitioned by a stable hash of their names,
+    so all instances agree on the partition independent of the order of the catalog.
+    :param repo: the name of the repository
+    :param shard_index: the index of the shard, starting with 0
+    :param shard_count: the amount of shards
+    :return: True if the repository belongs to the shard
+    """
+    return shard_count == 1 or zlib.crc32(repo.encode('utf-8')) % shard_count == shard_index
+
+
+def import_refs(verbose, digest_index, refs_files, regserver, shard_index, shard_count):
+    """
+    Merges the digest references exported by the other shards into the index of this shard.
+    Exits if the files don't cover all other shards, as the deletion of a shared digest wouldn't be safe then.
+    :param verbose: verbosity level
+    :param digest_index: the DigestIndex of the repositories of this shard
+    :param refs_files: the files written with --export-refs
+    :param regserver: the registry server
+    :param shard_index: the index of this shard
+    :param shard_count: the amount of shards
+    """
+    imported = set()
+    for refs_file in refs_files:
+        with open(refs_file) as refs:
+            content = json.load(refs)
+        if content.get('shard_count') != shard_count:
+            raise ConfigError("Exiting, {0} was exported by one of {1} shards, not {2}.".format(
+                refs_file, content.get('shard_count'), shard_count))
+        if content.get('registry') != regserver and verbose > 0:
+            print ("Warning: {0} was exported from registry {1}.".format(refs_file, content.get('registry')))
+        # the own references are the ones just scanned, so a glob matching all files can be used
+        if content['shard_index'] == shard_index or content['shard_index'] in imported:
+            if verbose > 0:
+                print ("Skipping {0} of shard {1}.".format(refs_file, content['shard_index']))
+            continue
+        digest_index.merge(content)
+        imported.add(content['shard_index'])
+        if verbose > 1:
+            print ("Imported the digest references of shard {0} from {1}.".format(content['shard_index'], refs_file))
+
+    missing = sorted(set(range(shard_count)) - imported - {shard_index})
+    if len(missing) > 0:
+        raise ConfigError("Exiting, the digest references of the shards {0} are missing.".format(missing))
+
+
+def iter_catalog(verbose, regserver, cacert=None, page_size=100, transport=None):
+    """
+    A generator yielding the names of all repositories on the registry server, following the pagination
+    of the catalog. The next page is requested when the names of the current one are consumed.
+    :param verbose: verbosity level
+    :param regserver:  The registry server
+    :param cacert: the path to a cacert file
+    :param page_size: the amount of repositories requested per page
+    :param transport: the RegistryTransport to send the requests with, by default the one of get_transport()
+    :return: A generator of repository names
+    """
+    req_url = "{0}_catalog?{1}".format(regserver, urlencode({'n': page_size}))
+    while req_url is not None:
+        if verbose > 1:
+            print ("Will use URL {0} to retrieve a list of repositories:".format(req_url))
+        repos_result = (transport or get_transport(regserver)).get(req_url, verify=cacert)
+        repos_status = repos_result.status_code
+        if verbose > 2:
+            print ("Get catalog result is:", repos_status)
+
+        # check the return code and exit if not OK
+        if repos_status != requests.codes.ok:
+            if verbose > 0:
+                print (repos_result)
+            raise RegistryError("The catalog could not be retrieved due to error: {0}".format(repos_status))
+        repos_page = repos_result.json()['repositories'] or []
+        if verbose > 1:
+            print ("Found repos: {0} ".format(repos_page))
+
+        req_url = get_next_page_url(repos_result, req_url, repos_page, page_size)
+        for repo in repos_page:
+            yield repo
+
+
+def iter_repositories(cmd_args, regserver, transport=None):
+    """
+    A generator yielding the names of all repositories, read from the storage if [--storage-root] is set,
+    otherwise from the catalog of the registry server.
+    :param cmd_args: the command line arguments
+    :param regserver: the registry server
+    :param transport: the RegistryTransport to read the catalog with, by default the one of get_transport()
+    :return: A generator of repository names
+    """
+    if cmd_args.storage_root is not None:
+        return StorageScanner(cmd_args.verbose, cmd_args.storage_root, cmd_args.storage_workers).iter_repos()
+    return iter_catalog(cmd_args.verbose, regserver, cmd_args.cacert, cmd_args.page_size, transport)
+
+
+def get_all_repos(verbose, regserver, cacert=None, page_size=100):
     """
     A method to retrieve a list of all repositories on the registry server.
     :param verbose: verbosity level
     :param regserver:  The registry server
     :param cacert: the path to a cacert file
+    :param page_size: the amount of repositories requested per page
     :return: A list with all repositories
     """
-    req_url = regserver + "_catalog"
-    if verbose > 1:
-        print ("Will use URL {0} to retrieve a list of all repositories:".format(req_url))
-    repos_result = requests.get(req_url, verify=cacert, auth=get_auth())
-    repos_status = repos_result.status_code
-    if args.verbose > 2:
-        print ("Get catalog result is:", repos_status)
+    return list(iter_catalog(verbose, regserver, cacert, page_size))
 
-    # check the return code and exit if not OK
-    if repos_status != requests.codes.ok:
-        print ("The tags could not be retrieved due to error:", repos_status)
-        if args.verbose > 0:
-            print (repos_result)
-        sys.exit(2)
-    repos_result_json = repos_result.json()
 
-    repos_all = repos_result_json['repositories']
-    if verbose > 1:
-        print ("Found repos: {0} ".format(repos_all))
+def glob_to_regex(pattern):
+    """
+    Converts a glob pattern to a regular expression: * and ? match within a path segment, ** matches any path.
+    """
+    regex = []
+    position = 0
+    while position < len(pattern):
+        if pattern.startswith('**', position):
+            regex.append('.*')
+            position += 2
+            continue
+        char = pattern[position]
+        regex.append('[^/]*' if char == '*' else '[^/]' if char == '?' else re.escape(char))
+        position += 1
+    return ''.join(regex)
+
+
+def regex_prefix(regex):
+    """
+    Returns the literal characters every match of a regular expression starts with, e.g. ci/ of ci/build-.*
+    """
+    depth = 0
+    escaped = in_class = False
+    for char in regex:
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif in_class:
+            in_class = char != ']'
+        elif char == '[':
+            in_class = True
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            # the alternatives can start differently
+            return ''
+    prefix = []
+    for char in regex[1:] if regex.startswith('^') else regex:
+        if char in '.^$*+?{}[]\\()|':
+            # the last character is optional with these quantifiers
+            if char in '*?{' and len(prefix) > 0:
+                prefix.pop()
+            break
+        prefix.append(char)
+    return ''.join(prefix)
+
+
+class PolicyMatcher(object):
+    """
+    Finds the policy of a repository by the keys of a reposfile. A key is a repository name, a glob pattern
+    (containing * or ?) or a regular expression prefixed with re:, as repository names can contain none of
+    these characters. A name takes precedence over the patterns, of the patterns the first one of the reposfile
+    matching the whole repository name applies.
+    The patterns are compiled once and indexed by the literal prefix each of their matches starts with, so for a
+    repository only the patterns with a prefix of its name are tried instead of all of them.
+    """
 
-    return repos_all
+    REGEX_PREFIX = 're:'
+
+    def __init__(self):
+        # repository name -> policy
+        self.names = {}
+        # (key, policy) of each pattern in the order of the reposfile
+        self.patterns = []
+        self.regexes = []
+        # literal prefix -> positions of the patterns with this prefix
+        self.prefixes = None
+        self.prefix_lengths = []
+
+    @classmethod
+    def is_pattern(cls, key):
+        return key.startswith(cls.REGEX_PREFIX) or '*' in key or '?' in key
+
+    def add(self, key, policy):
+        if self.is_pattern(key):
+            self.patterns.append((key, policy))
+            self.prefixes = None
+        else:
+            self.names[key] = policy
+
+    def compile(self):
+        self.regexes = []
+        self.prefixes = {}
+        for position, (key, policy) in enumerate(self.patterns):
+            if key.startswith(self.REGEX_PREFIX):
+                regex = key[len(self.REGEX_PREFIX):]
+                prefix = regex_prefix(regex)
+            else:
+                regex = glob_to_regex(key)
+                prefix = re.split(r'[*?]', key, maxsplit=1)[0]
+            try:
+                self.regexes.append(re.compile(regex))
+            except re.error as error:
+                raise ConfigError("Exiting, the regular expression {0} of the reposfile is invalid: {1}".format(
+                    key, error))
+            self.prefixes.setdefault(prefix, []).append(position)
+        self.prefix_lengths = sorted(set(len(prefix) for prefix in self.prefixes))
+
+    def match(self, repo):
+        """
+        Returns the key and the policy which apply to a repository or None, None.
+        """
+        if repo in self.names:
+            return repo, self.names[repo]
+        if len(self.patterns) == 0:
+            return None, None
+        if self.prefixes is None:
+            self.compile()
+        candidates = []
+        for length in self.prefix_lengths:
+            if length > len(repo):
+                break
+            candidates.extend(self.prefixes.get(repo[:length], ()))
+        for position in sorted(candidates):
+            if self.regexes[position].fullmatch(repo) is not None:
+                return self.patterns[position]
+        return None, None
+
+
+def read_reposfile(cmd_args):
+    """
+    Reads the policies of the reposfile.
 
+    :param cmd_args: the command line arguments
+    :return: A PolicyMatcher with the policies of the reposfile, an empty one without a reposfile
+    """
+    matcher = PolicyMatcher()
+    if not bool(cmd_args.reposfile):
+        return matcher
+    if cmd_args.verbose > 1:
+        print ("Will read repo information from file {0}".format(cmd_args.reposfile))
+    import yaml
+    with open(cmd_args.reposfile) as repoFile:
+        repos = yaml.safe_load(repoFile)
+        for repoName in repos:
+            if cmd_args.verbose > 2:
+                print ("Reading config for {0}: {1}".format(repoName, repos.get(repoName)))
+            try:
+                tagName = str(repos[repoName]['tag'])
+            except KeyError:
+                tagName = ""
+            try:
+                keep = int(repos[repoName]['keepimages'])
+            except KeyError:
+                keep = 0
+            try:
+                since = str(repos[repoName]['keepsince'])
+            except KeyError:
+                since = ""
+            try:
+                order = str(repos[repoName]['order'])
+            except KeyError:
+                order = cmd_args.order
+            if order not in TAG_ORDERS:
+                raise ConfigError("Exiting, unknown order {0} for repo {1}.".format(order, repoName))
 
-def create_repo_list(cmd_args, regserver):
+            if cmd_args.verbose > 2:
+                print ("    Parsed to:")
+                print ("    tagname: {0}, keepimages: {1}, since: {2}, order: {3}".format(tagName, keep, since,
+                                                                                        order))
+
+            matcher.add(str(repoName), (keep, tagName, since, order))
+    matcher.compile()
+    return matcher
+
+
+def create_repo_list(cmd_args, regserver, catalog=None, matcher=None, transport=None):
     """
     Builds up a dict of repositories which have to be cleaned up and which
     images have to be kept.
-    If the ignoreflag is set, a list of all repositories will be retrieved.
+    With more than one shard only the repositories of the shard of this instance are processed.
+    If the ignoreflag or the clean full catalog flag is set or the reposfile contains patterns, the repositories of
+    the catalog are streamed: the returned repositories are a generator and the dict is completed while the
+    generator is consumed.
+    Entries of the dict which are not in the catalog will not be part of the scanned repositories then.
 
     :param regserver: The registry server
     :param cmd_args: the command line arguments
+    :param catalog: the repository names to be used instead of the catalog of the registry server
+    :param matcher: the PolicyMatcher of the reposfile, read from the reposfile if not given
+    :param transport: The RegistryTransport to read the catalog with, by default the one of get_transport()
     :return: A dict in the format repositoryname : image tag to delete, amount of images to be kept, date since when
-             image will be kept and a list of the repository names
+             image will be kept, order of the images and an iterable of the repository names to be scanned
     """
     found_repos_counts = {}
-    all_registry_repos = get_all_repos(cmd_args.verbose, regserver, cmd_args.cacert)
 
     if bool(cmd_args.reponame) is True:
         if cmd_args.verbose > 1:
@@ -405,195 +1743,1038 @@ def create_repo_list(cmd_args, regserver):
         tagname = ''
         if len(splittedNames) == 2:
             tagname = splittedNames[1]
-        found_repos_counts[repo] = (cmd_args.keepimages, tagname, cmd_args.since)
+        found_repos_counts[repo] = (cmd_args.keepimages, tagname, cmd_args.since, cmd_args.order)
 
         if cmd_args.verbose > 2:
             print ("repos_counts: ", found_repos_counts)
 
-    if cmd_args.clean_full_catalog is True:
-        if cmd_args.verbose > 1:
-            print ("Importing all repos of the registries catalog, keeping {0} images per repo.".format(cmd_args.keepimages))
-        for repo in all_registry_repos:
-            splittedNames = repo.split(':')
-            repo = splittedNames[0]
-            tagname = ''
-            if len(splittedNames) == 2:
-                tagname = splittedNames[1]
-            found_repos_counts[repo] = (cmd_args.keepimages, tagname, cmd_args.since)
-
-    if bool(args.reposfile) is True:
-        if cmd_args.verbose > 1:
-            print ("Will read repo information from file {0}".format(cmd_args.reposfile))
-        with open(cmd_args.reposfile) as repoFile:
-            repos = yaml.safe_load(repoFile)
-            for repoName in repos:
-                if cmd_args.verbose > 2:
-                    print ("Reading config for {0}: {1}".format(repoName, repos.get(repoName)))
-                try:
-                    tagName = str(repos[repoName]['tag'])
-                except KeyError:
-                    tagName = ""
-                try:
-                    keep = int(repos[repoName]['keepimages'])
-                except KeyError:
-                    keep = 0
-                try:
-                    since = str(repos[repoName]['keepsince'])
-                except KeyError:
-                    since = ""
+    if matcher is None:
+        matcher = read_reposfile(cmd_args)
+    found_repos_counts.update(matcher.names)
 
-                if cmd_args.verbose > 2:
-                    print ("    Parsed to:")
-                    print ("    tagname: {0}, keepimages: {1}, since: {2}".format(tagName, keep, since))
-
-                found_repos_counts[repoName] = (keep, tagName, since)
+    for repo in list(found_repos_counts):
+        if not in_shard(repo, cmd_args.shard_index, cmd_args.shard_count):
+            del found_repos_counts[repo]
 
     if cmd_args.verbose > 1:
         print ("These repos will be processed:")
         print (found_repos_counts)
 
-    iter_found_repos_count = found_repos_counts.copy()
-    for repo in iter_found_repos_count:
+    if cmd_args.clean_full_catalog is True or cmd_args.ignoretag is True or len(matcher.patterns) > 0:
+        if cmd_args.clean_full_catalog is True and cmd_args.verbose > 1:
+            print ("Importing all repos of the registries catalog, keeping {0} images per repo.".format(cmd_args.keepimages))
+
+        def stream_catalog():
+            for catalog_repo in (catalog if catalog is not None else iter_repositories(cmd_args, regserver, transport)):
+                if not in_shard(catalog_repo, cmd_args.shard_index, cmd_args.shard_count):
+                    continue
+                # entries of the reposfile take precedence over the defaults of the command line
+                if catalog_repo not in found_repos_counts:
+                    key, policy = matcher.match(catalog_repo)
+                    if policy is not None:
+                        found_repos_counts[catalog_repo] = policy
+                    elif cmd_args.clean_full_catalog is True:
+                        found_repos_counts[catalog_repo] = (cmd_args.keepimages, '', cmd_args.since,
+                                                            cmd_args.order)
+                # with [-i] all repositories are scanned to count the references of their digests
+                if cmd_args.ignoretag is True or catalog_repo in found_repos_counts:
+                    yield catalog_repo
+
+        return found_repos_counts, stream_catalog()
+
+    all_registry_repos = set(catalog if catalog is not None else iter_repositories(cmd_args, regserver, transport))
+    for repo in list(found_repos_counts):
         if repo not in all_registry_repos:
             del found_repos_counts[repo]
             if cmd_args.verbose > 1:
                 print ("Skipping repo {0} because it is not in the catalog.".format(repo))
 
-    if cmd_args.ignoretag is True:
-        repos = all_registry_repos
-    else:
-        repos = found_repos_counts.keys()
+    return found_repos_counts, list(found_repos_counts.keys())
 
-    return found_repos_counts, repos
 
-def retrieve_metadata(tag, verbose, regserver, repo, managed_tags_date_digests,
-                      managed_digests, cacert):
+def get_manifest(verbose, regserver, repo, tag, cacert=None, transport=None):
+    """
+    Retrieves the manifest of an image tag with a single request.
+    The digest is read from the header, the creation date is only contained in the manifest if the registry
+    answers with a schema1 manifest, otherwise it has to be read from the config blob.
 
+    :param verbose: The verbosity level
+    :param regserver: The registry server
+    :param repo: The repository name
+    :param tag: The tag of the image
+    :param cacert: The path to the certificate file
+    :param transport: The RegistryTransport to send the requests with, by default the one of get_transport()
+    :return: The digest of the manifest, the digest of the config blob, the creation date and the size of the
+             image. Either the config digest or the creation date is None, the size is None for schema1 manifests
+    """
+    req_url = regserver + repo + "/manifests/" + tag
+    if verbose > 1:
+        print ("Will use following URL to retrieve manifest:", req_url)
+    manifest_result = (transport or get_transport(regserver)).get(req_url, headers=generate_request_headers(),
+                                                                  verify=cacert)
+    manifest_status = manifest_result.status_code
     if verbose > 2:
-        print ("Processing in", current_process())
+        print ("Manifest result status code is:", manifest_status)
+        print ("Manifest header is:")
+        print_headers(manifest_result.headers)
 
-    metadata_request = regserver + repo + "//manifests/" + tag
-    metadata_header = {'Accept': 'application/vnd.docker.distribution.manifest.v1+json'}
-    metadata = requests.get(metadata_request, headers=metadata_header, verify=cacert,
-                            auth=get_auth()).json()
+    # check the return code and exit if not OK
+    if manifest_status != requests.codes.ok:
+        if verbose > 0:
+            print (manifest_result)
+        raise RegistryError("The manifest could not be retrieved due to error: {0}".format(manifest_status))
+    # if the header doesn't contains the digest information exit, too
+    if 'Docker-Content-Digest' not in manifest_result.headers:
+        raise RegistryError("Could not find any digest information in the header. Exiting", 3)
+    digest = manifest_result.headers['Docker-Content-Digest']
+
+    manifest = manifest_result.json()
+    if 'config' in manifest:
+        size = manifest['config'].get('size', 0) + sum(layer.get('size', 0) for layer in manifest.get('layers', []))
+        return digest, manifest['config']['digest'], None, size
+    # the registry converted the manifest to schema1, the creation date is part of the history
+    return digest, None, get_created(json.loads(manifest['history'][0]['v1Compatibility']), digest), None
 
-    creation_date = json.loads(metadata['history'][0]['v1Compatibility'])['created']
-    digest = get_digest_by_tag(verbose, regserver, repo, tag, cacert)
-    managed_tags_date_digests[tag] = {'date': creation_date, 'digest': digest}
-    managed_digests.append(digest)
 
+def get_config_date(verbose, regserver, repo, config_digest, cacert=None, transport=None):
+    """
+    Retrieves the creation date of an image from its config blob.
+
+    :param verbose: The verbosity level
+    :param regserver: The registry server
+    :param repo: The repository name
+    :param config_digest: The digest of the config blob
+    :param cacert: The path to the certificate file
+    :param transport: The RegistryTransport to send the requests with, by default the one of get_transport()
+    :return: The creation date of the image, MISSING_CREATION_DATE if the config has none
+    """
+    req_url = regserver + repo + "/blobs/" + config_digest
+    if verbose > 1:
+        print ("Will use following URL to retrieve config:", req_url)
+    config_result = (transport or get_transport(regserver)).get(req_url, verify=cacert)
+    config_status = config_result.status_code
     if verbose > 2:
-        print ("Added {0} to tag {1} on repo {2}".format(managed_tags_date_digests[tag], tag, repo))
+        print ("Config result status code is:", config_status)
 
-    return managed_tags_date_digests, managed_digests
+    # check the return code and exit if not OK
+    if config_status != requests.codes.ok:
+        if verbose > 0:
+            print (config_result)
+        raise RegistryError("The config could not be retrieved due to error: {0}".format(config_status))
+    return get_created(config_result.json(), config_digest)
 
 
-def get_tags_dates_digests_byrepo(verbose, regserver, repo, results, digests, md_workers, cacert=None):
+def retrieve_metadata(verbose, regserver, repo, tag, cacert=None, transport=None):
     """
-        Retrieves all Tags, the creation date of the layer the tag point to and digest of the layer.
+    Retrieves the creation date and the digest of an image tag.
 
     :param verbose: The verbosity level
     :param regserver: The registry server
     :param repo: The repository name
-    :param results: A managed dict which is used to return a dict containing the tag, date and digest
-    :param digests: A managed list which contains a list of all found digests, used to check for multiple usage
-    :param md_workers: Amount of parallel workers to retrieve metadata
+    :param tag: The tag of the image
     :param cacert: The path to the certificate file
-    :return: Returns using the managed collections results and digests
+    :param transport: The RegistryTransport to send the requests with, by default the one of get_transport()
+    :return: A dict containing the creation date and the digest of the tag
+    """
+
+    if verbose > 2:
+        print ("Processing in", threading.current_thread().name)
+
+    digest, config_digest, creation_date, size = get_manifest(verbose, regserver, repo, tag, cacert, transport)
+    if creation_date is None:
+        creation_date = get_config_date(verbose, regserver, repo, config_digest, cacert, transport)
+    tag_date_digest = {'date': creation_date, 'digest': digest, 'epoch': parse_creation_date(creation_date)}
+
+    if verbose > 2:
+        print ("Added {0} to tag {1} on repo {2}".format(tag_date_digest, tag, repo))
+
+    return tag_date_digest
+
+
+def get_tags_page(verbose, regserver, repo, req_url, page_size, cacert=None, etag=None, transport=None):
     """
-    manager = Manager()
-    managed_tags_date_digests = manager.dict()
-    pool = Pool(processes=md_workers)
+    Retrieves one page of the tags of a repository.
 
-    req_url = regserver + repo + "/tags/list"
+    :param verbose: The verbosity level
+    :param regserver: The registry server
+    :param repo: The repository name
+    :param req_url: The URL of the page, None for the first one
+    :param page_size: The amount of tags requested per page
+    :param cacert: The path to the certificate file
+    :param etag: The ETag of a previous response of this page, the page is only returned if it has changed
+    :param transport: The RegistryTransport to send the requests with, by default the one of get_transport()
+    :return: The tags of the page, the URL of the next page or None if this was the last one and the ETag of
+             the page. The tags and the URL are None if the page hasn't changed
+    """
+    if req_url is None:
+        req_url = "{0}{1}/tags/list?{2}".format(regserver, repo, urlencode({'n': page_size}))
+    req_headers = {}
+    if etag is not None:
+        req_headers['If-None-Match'] = etag
     if verbose > 1:
         print ("Will use URL {0} to retrieve tags for repo {1}:".format(req_url, repo))
-    tags_result = requests.get(req_url, verify=cacert, auth=get_auth())
+    tags_result = (transport or get_transport(regserver)).get(req_url, headers=req_headers, verify=cacert)
     tags_status = tags_result.status_code
-    if args.verbose > 2:
+    if verbose > 2:
         print ("Get tags result is:", tags_status)
+    if etag is not None and tags_status == requests.codes.not_modified:
+        return None, None, etag
     # check the return code and exit if not OK
     if tags_status != requests.codes.ok:
-        print ("The tags could not be retrieved due to error:", tags_status)
-        if args.verbose > 0:
+        if verbose > 0:
             print (tags_result)
-        sys.exit(2)
-    tags_result_json = tags_result.json()
-
-    tags_all = tags_result_json['tags']
+        raise RegistryError("The tags could not be retrieved due to error: {0}".format(tags_status))
+    # a repository without tags returns null
+    tags_page = tags_result.json()['tags'] or []
     if verbose > 1:
-        print ("Found tags for repo {0}: {1} ".format(repo, tags_all))
+        print ("Found tags for repo {0}: {1} ".format(repo, tags_page))
+    next_url = get_next_page_url(tags_result, req_url, tags_page, page_size)
+    return tags_page, next_url, tags_result.headers.get('ETag')
 
-    if tags_all is None:
-        amount_tags = 0
-    else:
-        amount_tags = len(tags_all)
-    if verbose > 2:
-        print ("amount_tags : ", amount_tags)
+
+def iter_tags(verbose, regserver, repo, cacert=None, page_size=100, transport=None):
+    """
+    A generator yielding the tags of a repository, following the pagination of the tags list.
+
+    :param verbose: The verbosity level
+    :param regserver: The registry server
+    :param repo: The repository name
+    :param cacert: The path to the certificate file
+    :param page_size: The amount of tags requested per page
+    :param transport: The RegistryTransport to send the requests with, by default the one of get_transport()
+    :return: A generator of tags
+    """
+    tags_page, next_url, _ = get_tags_page(verbose, regserver, repo, None, page_size, cacert, transport=transport)
+    while True:
+        for tag in tags_page:
+            yield tag
+        if next_url is None:
+            break
+        tags_page, next_url, _ = get_tags_page(verbose, regserver, repo, next_url, page_size, cacert,
+                                               transport=transport)
+
+
+def get_tags_by_repo(verbose, regserver, repo, cacert=None, page_size=100, transport=None):
+    """
+    Retrieves the list of all tags of a repository.
+
+    :param verbose: The verbosity level
+    :param regserver: The registry server
+    :param repo: The repository name
+    :param cacert: The path to the certificate file
+    :param page_size: The amount of tags requested per page
+    :param transport: The RegistryTransport to send the requests with, by default the one of get_transport()
+    :return: The list of tags, empty if the repository has no tags
+    """
+    return list(iter_tags(verbose, regserver, repo, cacert, page_size, transport))
+
+
+class MetadataCache(object):
+    """
+    A persistent cache mapping manifest and config digests to the creation date and size of an image.
+    As digests are content addressed, the cached data never gets stale. The cache is a SQLite database
+    in the given directory, if it contains more than max_entries entries the least recently used ones are
+    evicted on close. The cache must only be used by the thread which created it.
+    """
+
+    def __init__(self, cache_dir, max_entries=1000000):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.max_entries = max_entries
+        self.now = int(time.time())
+        self.hits = 0
+        self.misses = 0
+        self.used = set()
+        import sqlite3
+        self.db = sqlite3.connect(os.path.join(cache_dir, 'metadata.sqlite'))
+        self.db.execute("CREATE TABLE IF NOT EXISTS digests (digest TEXT PRIMARY KEY, created TEXT NOT NULL, "
+                        "size INTEGER, last_used INTEGER NOT NULL)")
+
+    def get(self, digest):
+        """
+        Returns the cached creation date of a digest or None if it isn't cached.
+        """
+        row = self.db.execute("SELECT created FROM digests WHERE digest = ?", (digest,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.used.add(digest)
+        return row[0]
+
+    def put(self, digest, created, size=None):
+        self.db.execute("INSERT OR REPLACE INTO digests (digest, created, size, last_used) VALUES (?, ?, ?, ?)",
+                        (digest, created, size, self.now))
+
+    def close(self):
+        """
+        Writes the usage of the cached digests and evicts the least recently used entries.
+        """
+        self.db.executemany("UPDATE digests SET last_used = ? WHERE digest = ?",
+                            [(self.now, digest) for digest in self.used])
+        self.db.execute("DELETE FROM digests WHERE digest IN (SELECT digest FROM digests "
+                        "ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+        self.db.commit()
+        self.db.close()
+
+
+class SnapshotStore(object):
+    """
+    Stores the tags of each repository with their creation dates and digests and the ETag of the tags list
+    as found by the previous run, to rescan only what has changed since then.
+    The snapshots are kept in a SQLite database in the given directory, updates are written on close.
+    The store must only be used by the thread which created it.
+    """
+
+    def __init__(self, cache_dir, regserver):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.regserver = regserver
+        self.unchanged = 0
+        self.rescanned = 0
+        self.updates = {}
+        import sqlite3
+        self.db = sqlite3.connect(os.path.join(cache_dir, 'snapshots.sqlite'))
+        self.db.execute("CREATE TABLE IF NOT EXISTS snapshots (registry TEXT NOT NULL, repo TEXT NOT NULL, "
+                        "etag TEXT, tags TEXT NOT NULL, PRIMARY KEY (registry, repo))")
+
+    def get(self, repo):
+        """
+        Returns the ETag of the tags list and the tags of a repository found by the previous run.
+        :return: the ETag and a dict containing the tags and for each tag the creation date and digest, both
+                 are None if the repository wasn't scanned before
+        """
+        row = self.db.execute("SELECT etag, tags FROM snapshots WHERE registry = ? AND repo = ?",
+                              (self.regserver, repo)).fetchone()
+        if row is None:
+            return None, None
+        return row[0], json.loads(row[1])
+
+    def put(self, repo, etag, tags_date_digests):
+        self.updates[repo] = (etag, tags_date_digests)
+
+    def close(self):
+        self.db.executemany("INSERT OR REPLACE INTO snapshots (registry, repo, etag, tags) VALUES (?, ?, ?, ?)",
+                            [(self.regserver, repo, etag, json.dumps(tags))
+                             for repo, (etag, tags) in self.updates.items()])
+        self.db.commit()
+        self.db.close()
+
+
+class Journal(object):
+    """
+    An append-only journal of the scanned tags, the completed repositories and the confirmed deletions of a run,
+    to resume it after a crash. The records are buffered and written in batches, one JSON array per line:
+
+        ["t", repo, tag, {"date": ..., "digest": ..., "epoch": ...}]
+        ["r", repo, [tags...]]
+        ["d", repo, digest or tag]
+
+    When resuming, an incomplete last line, e.g. of a killed run, is cut off and the journal is continued.
+    """
+
+    BATCH_SIZE = 1000
+    BATCH_INTERVAL = 5.0
+
+    def __init__(self, journal_file, regserver, resume=False):
+        # repository -> {tag: metadata}
+        self.tags = {}
+        # completed repository -> tags
+        self.repos = {}
+        self.deletions = set()
+        self.buffer = []
+        self.flushed = time.time()
+        self.lock = threading.Lock()
+        if resume and os.path.exists(journal_file):
+            self.load(journal_file, regserver)
+            self.out = open(journal_file, 'a')
+        else:
+            self.out = open(journal_file, 'w')
+            self.out.write(json.dumps(['cleanreg-journal', 1, regserver]) + '\n')
+            self.out.flush()
+
+    def load(self, journal_file, regserver):
+        valid_size = 0
+        with open(journal_file, 'rb') as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                valid_size += len(line)
+                if record[0] == 't':
+                    self.tags.setdefault(record[1], {})[record[2]] = record[3]
+                elif record[0] == 'r':
+                    self.repos[record[1]] = record[2]
+                elif record[0] == 'd':
+                    self.deletions.add((record[1], record[2]))
+                elif record[0] == 'cleanreg-journal' and record[2] != regserver:
+                    raise ConfigError("Exiting, the journal {0} was written for the registry server {1}.".format(
+                        journal_file, record[2]))
+        os.truncate(journal_file, valid_size)
+        print ("Resuming with {0} completed repos, {1} scanned tags and {2} deletions of the journal.".format(
+            len(self.repos), sum(len(tags) for tags in self.tags.values()), len(self.deletions)))
+
+    def append(self, record):
+        with self.lock:
+            self.buffer.append(json.dumps(record))
+            if len(self.buffer) >= self.BATCH_SIZE or time.time() - self.flushed > self.BATCH_INTERVAL:
+                self.write_buffer()
+
+    def write_buffer(self):
+        if self.out is not None and len(self.buffer) > 0:
+            self.out.write('\n'.join(self.buffer) + '\n')
+            self.out.flush()
+            self.buffer = []
+        self.flushed = time.time()
+
+    def flush(self):
+        with self.lock:
+            self.write_buffer()
+
+    def tag(self, repo, tag):
+        """
+        Returns the metadata of a tag scanned before or None.
+        """
+        return self.tags.get(repo, {}).get(tag)
+
+    def add_tag(self, repo, tag, tag_date_digest):
+        self.tags.setdefault(repo, {})[tag] = tag_date_digest
+        self.append(['t', repo, tag, tag_date_digest])
+
+    def completed(self, repo):
+        """
+        Returns the tags of a repository completed before or None, tags without metadata get an empty dict.
+        """
+        if repo not in self.repos:
+            return None
+        repo_tags = self.tags.get(repo, {})
+        return {tag: repo_tags.get(tag, {}) for tag in self.repos[repo]}
+
+    def add_repo(self, repo, tags_date_digests):
+        self.repos[repo] = list(tags_date_digests)
+        self.append(['r', repo, self.repos[repo]])
+
+    def is_deleted(self, repo, reference):
+        return (repo, reference) in self.deletions
+
+    def add_deletion(self, repo, reference):
+        self.deletions.add((repo, reference))
+        self.append(['d', repo, reference])
+
+    def close(self):
+        if self.out is not None:
+            self.flush()
+            self.out.close()
+            self.out = None
+
+
+class DeletionExecutor(object):
+    """
+    Deletes manifests on a ScanEngine with a bounded amount of parallel deletions and an optional maximum
+    amount of deletions per second. A failed deletion doesn't stop the others, each result is recorded.
+    With tags set, single tags are deleted instead of the manifests they point to. With a Journal, the
+    deletions are recorded and the ones of a previous run are skipped.
+    """
+
+    def __init__(self, workers=4, rate=None, tags=False, journal=None):
+        self.workers = workers
+        self.rate = rate
+        self.tags = tags
+        self.journal = journal
+        self.slots = None
+        self.next_slot = 0.0
+        self.started = time.time()
+        self.deleted = 0
+        self.skipped = 0
+        self.failures = []
+
+    async def throttle(self):
+        if self.rate is None:
+            return
+        now = asyncio.get_running_loop().time()
+        wait = self.next_slot - now
+        self.next_slot = max(now, self.next_slot) + 1.0 / self.rate
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def delete(self, engine, repo, digest):
+        if self.journal is not None and self.journal.is_deleted(repo, digest):
+            self.skipped += 1
+            return
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.workers)
+        async with self.slots:
+            await self.throttle()
+            print ("Deleting ", digest)
+            try:
+                status = await engine.call(delete_manifest, engine.verbose, engine.regserver, repo, digest,
+                                           engine.cacert, transport=engine.transport)
+            except requests.RequestException as error:
+                # e.g. a timeout or a reset connection, the manifest may or may not be deleted
+                print ("The manifest {0} could not be deleted due to an error: {1}".format(digest, error))
+                status = type(error).__name__
+        if status == 202:
+            self.deleted += 1
+        elif status == requests.codes.not_found:
+            # already deleted, e.g. by a previous run
+            self.skipped += 1
+        else:
+            self.failures.append((repo, digest, status))
+            return
+        if self.journal is not None:
+            self.journal.add_deletion(repo, digest)
+
+    def print_summary(self):
+        elapsed = time.time() - self.started
+        done = self.deleted + self.skipped + len(self.failures)
+        print ("Deletion summary: {0} deleted, {1} failed, {2} skipped in {3:.1f}s ({4:.1f} deletions/s).".format(
+            self.deleted, len(self.failures), self.skipped, elapsed, done / elapsed if elapsed > 0 else 0.0))
+        for repo, digest, status in self.failures:
+            print ("  Failed: {0}@{1} with status {2}".format(repo, digest, status))
+
+
+class ScanEngine(object):
+    """
+    Runs the scan of the registry on a single event loop.
+    The blocking HTTP calls are executed on a thread pool and the amount of requests in flight is limited
+    globally over all repositories, additionally each repository uses at most md_workers of them.
+    Creation dates read from config blobs are shared over all repositories, so each config blob is
+    retrieved only once. With a MetadataCache, digests known from previous runs aren't retrieved at all.
+    With a SnapshotStore, only repositories and tags which changed since the previous run are rescanned.
+    Of the repositories for which tags_only returns True, only the tags are listed.
+    With a Journal, the scanned tags are recorded and the ones of a previous run aren't retrieved again.
+    All requests are sent with the given transport, by default with the one of get_transport().
+    """
+
+    def __init__(self, verbose, regserver, md_workers, max_inflight, cacert=None, page_size=100, cache=None,
+                 snapshots=None, deleter=None, tags_only=None, journal=None, transport=None):
+        self.verbose = verbose
+        self.regserver = regserver
+        self.transport = transport if transport is not None else get_transport(regserver)
+        self.md_workers = md_workers
+        self.max_inflight = max_inflight
+        self.cacert = cacert
+        self.page_size = page_size
+        self.cache = cache
+        self.snapshots = snapshots
+        self.deleter = deleter if deleter is not None else DeletionExecutor()
+        self.tags_only = tags_only if tags_only is not None else lambda repo: False
+        self.journal = journal
+        self.executor = ThreadPoolExecutor(max_workers=max_inflight, thread_name_prefix='cleanreg')
+        self.inflight = None
+        self.started = time.time()
+        self.busy = 0.0
+        self.config_dates = {}
+
+    async def call(self, func, *args, **kwargs):
+        """
+        Runs a blocking function doing one or more sequential requests on the thread pool,
+        occupying one slot of the global in-flight limit. A failed request raises its RegistryError.
+        """
+        if self.inflight is None:
+            self.inflight = asyncio.Semaphore(self.max_inflight)
+        async with self.inflight:
+            started = time.time()
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args, **kwargs))
+            finally:
+                self.busy += time.time() - started
+
+    async def config_date(self, repo, config_digest):
+        """
+        Returns the creation date of a config blob. Concurrent lookups of the same config blob wait for
+        the first one instead of retrieving it again.
+        """
+        if config_digest not in self.config_dates:
+            cached_date = None if self.cache is None else self.cache.get(config_digest)
+            if cached_date is not None:
+                self.config_dates[config_digest] = asyncio.get_running_loop().create_future()
+                self.config_dates[config_digest].set_result(cached_date)
+            else:
+                self.config_dates[config_digest] = asyncio.ensure_future(self.fetch_config_date(repo, config_digest))
+        return await self.config_dates[config_digest]
+
+    async def fetch_config_date(self, repo, config_digest):
+        creation_date = await self.call(get_config_date, self.verbose, self.regserver, repo, config_digest,
+                                        self.cacert, transport=self.transport)
+        if self.cache is not None:
+            self.cache.put(config_digest, creation_date)
+        return creation_date
+
+    async def retrieve_metadata(self, repo, tag, known=None):
+        """
+        Retrieves the creation date and the digest of an image tag like retrieve_metadata() does, but
+        looks up each config blob only once.
+        If a metadata cache is used or the tag is known from a previous scan, only the digest is requested
+        and the manifest is only retrieved if the digest isn't known yet.
+
+        :param repo: The repository name
+        :param tag: The tag of the image
+        :param known: The creation date and digest of the tag found by a previous scan
+        :return: A dict containing the creation date and the digest of the tag
+        """
+        if self.journal is not None:
+            journaled = self.journal.tag(repo, tag)
+            if journaled is not None:
+                return journaled
+        tag_date_digest = await self.resolve_metadata(repo, tag, known)
+        if self.journal is not None:
+            self.journal.add_tag(repo, tag, tag_date_digest)
+        return tag_date_digest
+
+    async def resolve_metadata(self, repo, tag, known=None):
+        creation_date = None
+        reference = tag
+        if self.cache is not None or known is not None:
+            known_digest = None if known is None else known['digest']
+            digest = await self.call(get_digest_by_tag, self.verbose, self.regserver, repo, tag, self.cacert,
+                                     known_digest, transport=self.transport)
+            if digest == known_digest:
+                return known
+            if self.cache is not None:
+                creation_date = self.cache.get(digest)
+            reference = digest
+        if creation_date is None:
+            digest, config_digest, creation_date, size = await self.call(get_manifest, self.verbose, self.regserver,
+                                                                         repo, reference, self.cacert,
+                                                                         transport=self.transport)
+            if creation_date is None:
+                creation_date = await self.config_date(repo, config_digest)
+            if self.cache is not None:
+                self.cache.put(digest, creation_date, size)
+        tag_date_digest = {'date': creation_date, 'digest': digest, 'epoch': parse_creation_date(creation_date)}
+
+        if self.verbose > 2:
+            print ("Added {0} to tag {1} on repo {2}".format(tag_date_digest, tag, repo))
+
+        return tag_date_digest
+
+    def close(self, wait=True):
+        self.executor.shutdown(wait=wait, cancel_futures=not wait)
+
+
+async def get_tags_dates_digests_byrepo(engine, repo):
+    """
+        Retrieves all Tags, the creation date of the layer the tag point to and digest of the layer.
+        The tags are listed page by page, the metadata of the tags of a page is retrieved while the next page
+        is requested.
+
+    :param engine: The ScanEngine to run the requests on
+    :param repo: The repository name
+    :return: A dict containing the tags of the repository and for each tag the creation date and digest, the
+             dicts of the tags are empty if the engine lists only the tags of the repository
+    """
+    verbose = engine.verbose
+    if engine.tags_only(repo):
+        if verbose > 0:
+            print ("Retrieving tags for repository ", repo)
+        tags = await engine.call(get_tags_by_repo, verbose, engine.regserver, repo, engine.cacert, engine.page_size,
+                                 transport=engine.transport)
+        return {tag: {} for tag in tags}
+    if engine.snapshots is not None:
+        return await rescan_tags_dates_digests_byrepo(engine, repo)
     if verbose > 0:
         print ("Retrieving metada for repository ", repo)
 
-    funcpart = partial(retrieve_metadata, verbose=verbose, regserver=regserver, repo=repo,
-                       managed_tags_date_digests=managed_tags_date_digests,
-                       managed_digests=digests, cacert=cacert)
-    pool.map(funcpart, tags_all)
+    tags_date_digests = {}
+    # at most one page of tags is waiting for the workers
+    pending = asyncio.Queue(maxsize=engine.page_size)
 
-    # convert managed dict to a "normal dict" and put it into the other managed dict...
-    # Feels so unpythonic, should rewrite the stuff
-    # TODO make this more pythonic
+    async def list_tags():
+        amount_tags = 0
+        next_url = None
+        while True:
+            tags_page, next_url, _ = await engine.call(get_tags_page, verbose, engine.regserver, repo, next_url,
+                                                       engine.page_size, engine.cacert, transport=engine.transport)
+            amount_tags += len(tags_page)
+            for tag in tags_page:
+                await pending.put(tag)
+            if next_url is None:
+                break
+        if verbose > 2:
+            print ("amount_tags : ", amount_tags)
+        for _ in range(engine.md_workers):
+            await pending.put(None)
+
+    async def worker():
+        while True:
+            tag = await pending.get()
+            if tag is None:
+                break
+            tags_date_digests[tag] = await engine.retrieve_metadata(repo, tag)
+
+    await asyncio.gather(list_tags(), *[worker() for _ in range(engine.md_workers)])
+    return tags_date_digests
+
+
+async def rescan_tags_dates_digests_byrepo(engine, repo):
+    """
+    Retrieves the same as get_tags_dates_digests_byrepo(), but based on the snapshot of the previous run.
+    If the registry server confirms with 304 that the tags list is unchanged the snapshot is used. Otherwise each
+    known tag is checked with a conditional HEAD, even if the tag names are the same, as a tag can be pushed again;
+    only tags which are new or point to another digest are resolved again.
+    The ETag only covers the first page of the tags list, so it's only kept and sent if all tags fit into one
+    page which isn't full, otherwise a change of a following page would go unnoticed.
+
+    :param engine: The ScanEngine to run the requests on, having a SnapshotStore
+    :param repo: The repository name
+    :return: A dict containing the tags of the repository and for each tag the creation date and digest
+    """
+    verbose = engine.verbose
+    etag, snapshot = engine.snapshots.get(repo)
+    if snapshot is None or len(snapshot) >= engine.page_size:
+        etag = None
+
+    tags_all = []
+    next_url = None
+    tags_page, next_url, new_etag = await engine.call(get_tags_page, verbose, engine.regserver, repo, next_url,
+                                                      engine.page_size, engine.cacert, etag, engine.transport)
+    if tags_page is not None:
+        if next_url is not None or len(tags_page) >= engine.page_size:
+            new_etag = None
+        while True:
+            tags_all.extend(tags_page)
+            if next_url is None:
+                break
+            tags_page, next_url, _ = await engine.call(get_tags_page, verbose, engine.regserver, repo, next_url,
+                                                       engine.page_size, engine.cacert, transport=engine.transport)
+
+    if tags_page is None:
+        if verbose > 0:
+            print ("Tags of repository {0} are unchanged since the previous run.".format(repo))
+        engine.snapshots.unchanged += 1
+        engine.snapshots.put(repo, new_etag, snapshot)
+        return snapshot
+
+    if verbose > 0:
+        print ("Retrieving metada for repository ", repo)
+    if snapshot is None:
+        snapshot = {}
     tags_date_digests = {}
-    for (k, v) in managed_tags_date_digests.items():
-        tags_date_digests[k] = v
+    pending = iter(tags_all)
 
-    results[repo] = tags_date_digests
+    async def worker():
+        for tag in pending:
+            tags_date_digests[tag] = await engine.retrieve_metadata(repo, tag, snapshot.get(tag))
 
+    await asyncio.gather(*[worker() for _ in range(engine.md_workers)])
+    engine.snapshots.rescanned += 1
+    engine.snapshots.put(repo, new_etag, tags_date_digests)
+    return tags_date_digests
 
-def get_all_tags_dates_digests(verbose, regserver, repositories, md_workers, cacert=None):
+
+async def resolve_digests(engine, repo, del_tags):
     """
-    Retrieve all tags and finally digests for all repositories.
+    Retrieves the digests of tags which were planned for deletion by their names only.
+
+    :param engine: The ScanEngine to run the requests on
+    :param repo: The repository name
+    :param del_tags: a dict of the tags to be deleted, the digest is added to the dict of each tag without one
+    """
+
+    async def resolve(tag, data):
+        data['digest'] = await engine.call(get_digest_by_tag, engine.verbose, engine.regserver, repo, tag,
+                                           engine.cacert, transport=engine.transport)
+
+    await asyncio.gather(*[resolve(tag, data) for tag, data in del_tags.items() if 'digest' not in data])
+
+
+def resolve_all_digests(verbose, regserver, repo_del_tags, cacert=None, max_inflight=64, transport=None):
+    """
+    Retrieves the digests of all tags to be deleted which were planned by their names only.
 
     :param verbose: verbosity level
     :param regserver: the URL of the reg server
-    :param repositories: the list of repositories to be cleaned up
+    :param repo_del_tags: a dict containing the tags to be deleted for each repository
     :param cacert: the path to a cacert file
-    :return: a nested dict containing all repos and for each repo the list of all tags and their digests.
+    :param max_inflight: the amount of parallel requests
+    :param transport: the RegistryTransport to send the requests with, by default the one of get_transport()
+    """
+
+    async def resolve_all():
+        await asyncio.gather(*[resolve_digests(engine, repo, del_tags) for repo, del_tags in repo_del_tags.items()])
+
+    engine = ScanEngine(verbose, regserver, 1, max_inflight, cacert, transport=transport)
+    auth = engine.transport.session.auth
+    if isinstance(auth, RegistryAuth):
+        auth.prefetch(list(repo_del_tags), ['HEAD'], cacert)
+
+    try:
+        asyncio.run(resolve_all())
+    except BaseException:
+        engine.close(wait=False)
+        raise
+    engine.close()
+
+
+async def delete_digests(engine, repo, digests):
     """
+    Deletes the manifests of the given digests of a repository with the DeletionExecutor of the engine.
+
+    :param engine: The ScanEngine to run the requests on
+    :param repo: The repository name
+    :param digests: the digests to be deleted
+    """
+    await asyncio.gather(*[engine.deleter.delete(engine, repo, digest) for digest in digests])
+
+
+def delete_all_digests(verbose, regserver, repo_del_digests, deleter, cacert=None, max_inflight=64,
+                       transport=None):
+    """
+    Deletes the manifests of the given digests of all repositories.
+
+    :param verbose: verbosity level
+    :param regserver: the URL of the reg server
+    :param repo_del_digests: a dict containing the digests to be deleted for each repository
+    :param deleter: the DeletionExecutor recording the results
+    :param cacert: the path to a cacert file
+    :param max_inflight: the amount of parallel requests
+    :param transport: the RegistryTransport to send the requests with, by default the one of get_transport()
+    """
+
+    async def delete_all():
+        await asyncio.gather(*[delete_digests(engine, repo, digests) for repo, digests in repo_del_digests.items()])
+
+    engine = ScanEngine(verbose, regserver, 1, max_inflight, cacert, deleter=deleter, transport=transport)
+    auth = engine.transport.session.auth
+    if isinstance(auth, RegistryAuth):
+        auth.prefetch(list(repo_del_digests), ['DELETE'], cacert)
+
+    try:
+        asyncio.run(delete_all())
+    except BaseException:
+        engine.close(wait=False)
+        raise
+    engine.close()
+    metrics.record_workers('delete', deleter.workers, engine.busy, time.time() - engine.started)
+
+
+async def scan_repositories(engine, repositories, plan=None):
+    """
+    Scans the given repositories concurrently, but at most max_inflight / md_workers of them at the same
+    time, so that the repositories are completed one after another in the order of the catalog instead of
+    all of them at the end.
+    If a plan function is given, it is called with the repository name and its tags, dates and digests as
+    soon as a repository is scanned and the images of the tags it returns are deleted while the next
+    repositories are scanned.
+
+    :param engine: The ScanEngine to run the requests on
+    :param repositories: the list or a generator of repositories to be scanned
+    :param plan: an optional function returning the tags to be deleted for a scanned repository
+    :return: a dict containing the tags, dates and digests for each repository and a DigestIndex of all
+             found digests
+    """
+
+    async def scan(repo):
+        tags_date_digests = None if engine.journal is None else engine.journal.completed(repo)
+        if tags_date_digests is None:
+            # waiting scans are started in the order they were created
+            async with scan_slots:
+                if engine.verbose > 0:
+                    print ("Starting scan of {0}".format(repo))
+                tags_date_digests = await get_tags_dates_digests_byrepo(engine, repo)
+            if engine.journal is not None:
+                engine.journal.add_repo(repo, tags_date_digests)
+        elif engine.verbose > 0:
+            print ("Repository {0} was completed by the previous run.".format(repo))
+        if not engine.tags_only(repo):
+            digest_index.add_repo(repo, tags_date_digests)
+        if plan is not None:
+            del_tags = plan(repo, tags_date_digests)
+            if engine.deleter.tags:
+                await delete_digests(engine, repo, list(del_tags))
+            else:
+                await resolve_digests(engine, repo, del_tags)
+                await delete_digests(engine, repo, set(data['digest'] for data in del_tags.values()))
+        return repo, tags_date_digests
+
+    scan_slots = asyncio.Semaphore(max(1, engine.max_inflight // engine.md_workers))
+    digest_index = DigestIndex()
+    scans = []
+    if hasattr(repositories, '__len__'):
+        scans = [asyncio.ensure_future(scan(repo)) for repo in repositories]
+    else:
+        # a streamed catalog: scanning of the first repositories starts while the next page is retrieved
+        repositories = iter(repositories)
+        while True:
+            repo = await engine.call(next, repositories, None)
+            if repo is None:
+                break
+            scans.append(asyncio.ensure_future(scan(repo)))
 
     result = {}
-    manager = Manager()
-    repos_tags_digest = manager.dict()
-    managed_digests = manager.list()
-    procs = []
+    for repo, tags_date_digests in await asyncio.gather(*scans):
+        result[repo] = tags_date_digests
+    return result, digest_index
+
+
+def get_all_tags_dates_digests(verbose, regserver, repositories, md_workers, cacert=None, max_inflight=64,
+                               page_size=100, cache=None, snapshots=None, plan=None, deleter=None, tags_only=None,
+                               journal=None, transport=None):
+    """
+    Retrieve all tags and finally digests for all repositories.
+
+    :param verbose: verbosity level
+    :param regserver: the URL of the reg server
+    :param repositories: the list or a generator of repositories to be cleaned up
+    :param md_workers: the amount of parallel requests per repository to retrieve metadata
+    :param cacert: the path to a cacert file
+    :param max_inflight: the amount of parallel requests over all repositories
+    :param page_size: the amount of tags requested per page
+    :param cache: an optional MetadataCache to look up the creation dates of known digests
+    :param snapshots: an optional SnapshotStore to rescan only what has changed since the previous run
+    :param plan: an optional function returning the tags to be deleted for a scanned repository, these are
+                 deleted right after the repository is scanned
+    :param deleter: the DeletionExecutor to delete the planned digests with
+    :param tags_only: an optional function returning True for the repositories of which only the tags are listed,
+                      without retrieving their metadata
+    :param journal: an optional Journal recording the scan, the repositories and tags of a previous run aren't
+                    scanned again
+    :param transport: the RegistryTransport to send the requests with, by default the one of get_transport()
+    :return: a nested dict containing all repos and for each repo the list of all tags and their digests
+             and a DigestIndex of all found digests.
+    """
 
     print ("Retrieving tags and digests. Be patient, this can take a little bit time.")
 
-    for repo in repositories:
-        if verbose > 0:
-            print ("Starting procs for {0}".format(repo))
+    engine = ScanEngine(verbose, regserver, md_workers, max_inflight, cacert, page_size, cache,
+                        snapshots, deleter, tags_only, journal, transport)
+    auth = engine.transport.session.auth
+    if isinstance(auth, RegistryAuth) and hasattr(repositories, '__len__'):
+        auth.prefetch(repositories, ['GET', 'HEAD'], cacert)
 
-        # start a process to retrieve the needed data
-        proc = Process(target=get_tags_dates_digests_byrepo, args=(verbose, regserver, repo, repos_tags_digest,
-                                                                   managed_digests, md_workers, cacert))
-        procs.append(proc)
-        proc.start()
+    try:
+        result, digest_index = asyncio.run(scan_repositories(engine, repositories, plan))
+    except BaseException:
+        # don't wait for queued requests if we are exiting anyway
+        engine.close(wait=False)
+        raise
+    engine.close()
+    metrics.record_workers('scan', max_inflight, engine.busy, time.time() - engine.started)
+    if verbose > 0:
+        print ("Retrieved {0} config blobs for {1} tags.".format(len(engine.config_dates),
+                                                                 digest_index.references))
+    return result, digest_index
 
-    for proc in procs:
-        if verbose > 1:
-            print ("Waiting for {0} to be finished.".format(proc))
-        proc.join()
 
-    for repo in repositories:
-        if verbose > 0:
-            print ("Retrieving results...")
-        result[repo] = repos_tags_digest[repo]
+class StorageScanner(object):
+    """
+    Reads the tags, digests and creation dates of the repositories directly from the storage of a registry using
+    the filesystem storage driver, without any request to the registry server:
 
-    return result, managed_digests
+        <storage root>/docker/registry/v2/repositories/<repo>/_manifests/tags/<tag>/current/link
+        <storage root>/docker/registry/v2/blobs/sha256/<first two hex digits>/<hex digest>/data
 
+    The link of a tag contains the digest of its manifest, the creation date is read from the config blob the
+    manifest references. Directories and repositories are read by a pool of threads.
+    """
 
-def get_deletiontags(verbose, tags_dates_digests, repo, tagname, keep_count, regex, since):
+    def __init__(self, verbose, storage_root, workers=8):
+        self.verbose = verbose
+        self.root = os.path.join(storage_root, 'docker', 'registry', 'v2')
+        self.workers = workers
+        # manifest and config digest -> creation date, many tags share the same image
+        self.manifest_dates = {}
+        self.config_dates = {}
+
+    def list_dirs(self, repo):
+        with os.scandir(os.path.join(self.root, 'repositories', repo)) as entries:
+            return sorted(entry.name for entry in entries if entry.is_dir())
+
+    def iter_repos(self):
+        """
+        A generator yielding the names of all repositories, the directory tree is walked level by level with
+        the directories of a level listed in parallel.
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            level = ['']
+            while len(level) > 0:
+                next_level = []
+                for name, dirs in zip(level, executor.map(self.list_dirs, level)):
+                    if '_manifests' in dirs:
+                        yield name
+                    # a repository can contain other repositories, e.g. library and library/alpine
+                    next_level.extend(name + '/' + d if name else d for d in dirs if not d.startswith('_'))
+                level = sorted(next_level)
+
+    def read_blob(self, digest):
+        algorithm, _, hex_digest = digest.partition(':')
+        with open(os.path.join(self.root, 'blobs', algorithm, hex_digest[:2], hex_digest, 'data'), 'rb') as blob:
+            return json.loads(blob.read())
+
+    def manifest_date(self, manifest):
+        """
+        Returns the creation date of the image of a manifest.
+        For a manifest list the date of the linux/amd64 image, or of the first one, is used.
+        """
+        if 'manifests' in manifest:
+            platforms = [m for m in manifest['manifests'] if m.get('platform', {}).get('architecture') == 'amd64']
+            return self.manifest_date(self.read_blob((platforms or manifest['manifests'])[0]['digest']))
+        if 'config' not in manifest:
+            # schema1, the creation date is part of the history
+            return get_created(json.loads(manifest['history'][0]['v1Compatibility']), 'A schema1 manifest')
+        config_digest = manifest['config']['digest']
+        creation_date = self.config_dates.get(config_digest)
+        if creation_date is None:
+            creation_date = self.config_dates[config_digest] = get_created(self.read_blob(config_digest),
+                                                                          config_digest)
+        return creation_date
+
+    def scan_repo(self, repo):
+        """
+        Reads the tags, dates and digests of a repository.
+        :return: the repository name and a dict containing the date and digest for each tag
+        """
+        if self.verbose > 0:
+            print ("Starting scan of {0}".format(repo))
+        tags_dir = os.path.join(self.root, 'repositories', repo, '_manifests', 'tags')
+        tags_date_digests = {}
+        try:
+            tags = sorted(os.listdir(tags_dir))
+        except FileNotFoundError:
+            tags = []
+        for tag in tags:
+            try:
+                with open(os.path.join(tags_dir, tag, 'current', 'link')) as link:
+                    digest = link.read().strip()
+                creation_date = self.manifest_dates.get(digest)
+                if creation_date is None:
+                    creation_date = self.manifest_dates[digest] = self.manifest_date(self.read_blob(digest))
+            except (OSError, ValueError, KeyError, IndexError) as error:
+                raise RegistryError("The metadata of tag {0} in repo {1} could not be read from the storage: "
+                                    "{2}".format(tag, repo, error))
+            tags_date_digests[tag] = {'date': creation_date, 'digest': digest,
+                                      'epoch': parse_creation_date(creation_date)}
+            if self.verbose > 2:
+                print ("Added {0} to tag {1} on repo {2}".format(tags_date_digests[tag], tag, repo))
+        return repo, tags_date_digests
+
+    def scan(self, repositories):
+        """
+        Reads the tags, dates and digests of all given repositories in parallel.
+        :param repositories: the list or a generator of repositories to be scanned
+        :return: a dict containing the tags, dates and digests for each repository and a DigestIndex of all
+                 found digests, the same as get_all_tags_dates_digests returns
+        """
+        print ("Reading tags and digests from the storage.")
+        result = {}
+        digest_index = DigestIndex()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for repo, tags_date_digests in executor.map(self.scan_repo, repositories):
+                result[repo] = tags_date_digests
+                digest_index.add_repo(repo, tags_date_digests)
+        if self.verbose > 0:
+            print ("Read {0} config blobs for {1} tags.".format(len(self.config_dates), digest_index.references))
+        return result, digest_index
+
+
+def get_deletiontags(verbose, tags_dates_digests, repo, tagname, keep_count, regex, since, order='date'):
     """
     Returns a dict containing a list of the tags which could be deleted due
     to name and date.
+    Unless the order is date, the tags are ordered by their names and tags which don't match the order are kept,
+    the creation dates are only needed if since is given.
 
     :param tags_dates_digests: A dict containing image tags, their corresponding digest and the layer creation date
     :param verbose: The verbosity level
@@ -602,19 +2783,29 @@ def get_deletiontags(verbose, tags_dates_digests, repo, tagname, keep_count, reg
     :param keep_count: amount of tags to be kept in repository
     :param regex: True if tagnames should be interpreted as regular expressions
     :param since: Keeps tags which were created since this date
+    :param order: How the tags are ordered, one of TAG_ORDERS
     :return: a dict of tags to be deleted, their digest and the date then they are created
     """
 
-    all_tags = collections.OrderedDict(sorted(tags_dates_digests.items(), key=lambda x: x[1]['date']))
-    deletion_tags = {}
+    # a list of (tag, data) tuples, sorted by creation date or by the name
+    tag_key = TAG_ORDERS[order]
+    if tag_key is None:
+        all_tags = sorted(tags_dates_digests.items(), key=lambda x: x[1]['epoch'])
+    else:
+        keyed_tags = []
+        for tag, data in tags_dates_digests.items():
+            key = tag_key(tag)
+            if key is not None:
+                keyed_tags.append((key, tag, data))
+            elif verbose > 1:
+                print ("Keeping tag {0} of repo {1} as it doesn't match the order {2}.".format(tag, repo, order))
+        keyed_tags.sort(key=lambda x: x[0])
+        all_tags = [(tag, data) for _, tag, data in keyed_tags]
 
     if verbose > 3:
-        print (json.dumps(all_tags, indent=2))
+        print (json.dumps(collections.OrderedDict(all_tags), indent=2))
 
-    if all_tags is None:
-        amount_tags = 0
-    else:
-        amount_tags = len(all_tags)
+    amount_tags = len(all_tags)
 
     if keep_count is None:
         keep_count = 0
@@ -622,52 +2813,647 @@ def get_deletiontags(verbose, tags_dates_digests, repo, tagname, keep_count, reg
     if verbose > 1:
         print ("Repo {0}: amount_tags : {1}; repo_count: {2}".format(repo, amount_tags, keep_count))
 
-    deletion_tags = all_tags.copy()
-    processed_tags = all_tags.copy()
+    processed_tags = all_tags
     if regex and tagname != "":
-        for tag in deletion_tags.keys():
-            if not re.match(tagname, tag):
-                del processed_tags[tag]
+        tag_pattern = re.compile(tagname)
+        processed_tags = [item for item in processed_tags if tag_pattern.match(item[0])]
     elif not regex and tagname != "":
-        processed_tags = {k: deletion_tags[k] for k in deletion_tags if tagname == k}
+        processed_tags = [item for item in processed_tags if tagname == item[0]]
 
     if since is not None and since != "":
-        deletion_tags = processed_tags.copy()
         parsed_date = parse_date(since)
-        print ("Will delete and keep images created since {0}".format(parsed_date))
-        for tag in deletion_tags.keys():
-            deletion_tag_date = deletion_tags[tag]['date']
-            if (deletion_tag_date.endswith('Z')):
-                deletion_tag_date = deletion_tag_date[:-1]
-            tag_date = datetime.strptime(deletion_tag_date.split('.')[0], '%Y-%m-%dT%H:%M:%S')
-            print ("Date: {0}".format(tag_date))
-            if tag_date >= parsed_date:
-                del processed_tags[tag]
+        since_epoch = calendar.timegm(parsed_date.timetuple())
+        if verbose > 0:
+            print ("Will delete and keep images created since {0}".format(parsed_date))
+        deletion_tags = []
+        for tag, data in processed_tags:
+            tag_epoch = data['epoch'] if 'epoch' in data else parse_creation_date(data['date'])
+            if verbose > 2:
+                print ("Date of tag {0}: {1}".format(tag, data['date']))
+            if tag_epoch < since_epoch:
+                deletion_tags.append((tag, data))
+        processed_tags = deletion_tags
 
     # considers keep_count to check if too many images are marked for deletion
     delete_count = amount_tags - keep_count
     if len(processed_tags) > delete_count:
-        deletion_tags = processed_tags.copy()
         if amount_tags <= keep_count:
             # keep all images
-            processed_tags.clear()
+            processed_tags = []
         else:
             # removes the last keep_count tags from deletion_tags
-            processed_tags = collections.OrderedDict(islice(deletion_tags.items(), delete_count))
+            processed_tags = processed_tags[:delete_count]
+        processed_tags = collections.OrderedDict(processed_tags)
         if verbose > 1:
             print ()
             print ("Deletion candidates for repo {0}".format(repo))
             print (json.dumps(processed_tags, indent=2))
     else:
+        processed_tags = collections.OrderedDict(processed_tags)
         if verbose > 0:
             print ("Skipping deletion in repo {0} because not enough images.".format(repo))
 
     return processed_tags
 
-# >>>>>>>>>>>>>>>> MAIN STUFF
+def write_plan(plan_file, repo_del_tags, repo_del_digests):
+    """
+    Writes the tags to be deleted with their creation date and digest to a file, one JSON object per line.
+    Tags whose digest isn't deleted, e.g. due to [-i], are left out. The file is replaced atomically.
 
-if __name__ == '__main__':
+    :param plan_file: the file to write
+    :param repo_del_tags: a dict containing the tags to be deleted for each repository
+    :param repo_del_digests: a dict containing the digests to be deleted for each repository
+    :return: the amount of written tags
+    """
+    amount_tags = 0
+    with open(plan_file + '.tmp', 'w') as plan:
+        for repo, del_tags in repo_del_tags.items():
+            del_digests = repo_del_digests.get(repo, set())
+            for tag, data in del_tags.items():
+                if data['digest'] in del_digests or tag in del_digests:
+                    plan.write(json.dumps({'repo': repo, 'tag': tag, 'date': data.get('date'),
+                                           'digest': data['digest']}) + '\n')
+                    amount_tags += 1
+    os.replace(plan_file + '.tmp', plan_file)
+    return amount_tags
+
+
+def read_plan(plan_file):
+    """
+    Reads a file written with write_plan().
+
+    :param plan_file: the file to read
+    :return: a dict containing the planned tags and their digests for each repository
+    """
+    repo_tag_digests = collections.OrderedDict()
+    with open(plan_file) as plan:
+        for line in plan:
+            if line.strip() == '':
+                continue
+            entry = json.loads(line)
+            repo_tag_digests.setdefault(entry['repo'], collections.OrderedDict())[entry['tag']] = entry['digest']
+    return repo_tag_digests
+
+
+async def revalidate_plan(engine, repo, tag_digests):
+    """
+    Checks with a HEAD request that each planned tag still points to the planned digest.
+
+    :param engine: The ScanEngine to run the requests on
+    :param repo: The repository name
+    :param tag_digests: a dict containing the planned digest for each tag
+    :return: the tags still pointing to their planned digest and the tags which were changed or removed
+    """
+
+    async def check(tag, digest):
+        return await engine.call(get_digest_by_tag, engine.verbose, engine.regserver, repo, tag, engine.cacert,
+                                 None, True, engine.transport) == digest
 
+    results = await asyncio.gather(*[check(tag, digest) for tag, digest in tag_digests.items()])
+    confirmed = [tag for tag, valid in zip(tag_digests, results) if valid]
+    changed = [tag for tag, valid in zip(tag_digests, results) if not valid]
+    return confirmed, changed
+
+
+def apply_plan(verbose, regserver, repo_tag_digests, deleter, cacert=None, max_inflight=64, transport=None):
+    """
+    Deletes the planned digests, or tags if the deleter deletes tags, of all repositories. A tag which was
+    removed or points to another digest since the plan was written isn't deleted, neither is its digest.
+
+    :param verbose: verbosity level
+    :param regserver: the URL of the reg server
+    :param repo_tag_digests: a dict containing the planned tags and their digests for each repository
+    :param deleter: the DeletionExecutor recording the results
+    :param cacert: the path to a cacert file
+    :param max_inflight: the amount of parallel requests
+    :param transport: the RegistryTransport to send the requests with, by default the one of get_transport()
+    :return: the amount of changed tags
+    """
+
+    async def apply_repo(repo, tag_digests):
+        confirmed, changed = await revalidate_plan(engine, repo, tag_digests)
+        for tag in changed:
+            print ("Skipping tag {0} of repo {1} as it was changed since the plan was written.".format(tag, repo))
+        if deleter.tags:
+            references = confirmed
+        else:
+            # a digest of a changed tag could still be in use
+            references = set(tag_digests[tag] for tag in confirmed) - set(tag_digests[tag] for tag in changed)
+        await delete_digests(engine, repo, references)
+        return len(changed)
+
+    async def apply_all():
+        return await asyncio.gather(*[apply_repo(repo, tag_digests)
+                                      for repo, tag_digests in repo_tag_digests.items()])
+
+    engine = ScanEngine(verbose, regserver, 1, max_inflight, cacert, deleter=deleter, transport=transport)
+    auth = engine.transport.session.auth
+    if isinstance(auth, RegistryAuth):
+        auth.prefetch(list(repo_tag_digests), ['HEAD', 'DELETE'], cacert)
+
+    try:
+        changed = asyncio.run(apply_all())
+    except BaseException:
+        engine.close(wait=False)
+        raise
+    engine.close()
+    metrics.record_workers('delete', deleter.workers, engine.busy, time.time() - engine.started)
+    return sum(changed)
+
+
+def save_snapshot(snapshot_file, regserver, repo_tags_dates_digest):
+    """
+    Writes the tags, creation dates and digests of all scanned repositories to a gzip compressed JSON file.
+    The file holds a column per field with the tags of all repositories one after another, each digest is
+    stored only once. The file is replaced atomically.
+
+    :param snapshot_file: the file to write
+    :param regserver: the registry server
+    :param repo_tags_dates_digest: a dict containing the tags, dates and digests for each repository
+    """
+    repos = []
+    tag_counts = []
+    tags = []
+    dates = []
+    epochs = []
+    digest_ids = []
+    digests = {}
+    for repo, tags_dates_digests in repo_tags_dates_digest.items():
+        repos.append(repo)
+        tag_counts.append(len(tags_dates_digests))
+        for tag, data in tags_dates_digests.items():
+            tags.append(tag)
+            dates.append(data['date'])
+            epochs.append(data['epoch'])
+            digest_ids.append(digests.setdefault(data['digest'], len(digests)))
+    content = {'version': 1, 'registry': regserver, 'repos': repos, 'tag_counts': tag_counts, 'tags': tags,
+               'dates': dates, 'epochs': epochs, 'digest_ids': digest_ids, 'digests': list(digests)}
+    with gzip.open(snapshot_file + '.tmp', 'wt', compresslevel=6) as out:
+        json.dump(content, out, separators=(',', ':'))
+    os.replace(snapshot_file + '.tmp', snapshot_file)
+
+
+def load_snapshot(snapshot_file):
+    """
+    Reads a file written with save_snapshot().
+
+    :param snapshot_file: the file to read
+    :return: the registry server and a dict containing the tags, dates and digests for each repository
+    """
+    with gzip.open(snapshot_file, 'rt') as snapshot:
+        content = json.load(snapshot)
+    if content.get('version') != 1:
+        raise ConfigError("Exiting, {0} is not a snapshot of this version of cleanreg.".format(snapshot_file))
+
+    repo_tags_dates_digest = collections.OrderedDict()
+    digests = content['digests']
+    position = 0
+    for repo, amount_tags in zip(content['repos'], content['tag_counts']):
+        tags_dates_digests = {}
+        for i in range(position, position + amount_tags):
+            tags_dates_digests[content['tags'][i]] = {'date': content['dates'][i],
+                                                      'digest': digests[content['digest_ids'][i]],
+                                                      'epoch': content['epochs'][i]}
+        repo_tags_dates_digest[repo] = tags_dates_digests
+        position += amount_tags
+    return content['registry'], repo_tags_dates_digest
+
+
+def plan_policy(cmd_args, regserver, repo_tags_dates_digest, digest_index):
+    """
+    Plans the deletion for the repositories of a snapshot like a run against the registry server would.
+
+    :param cmd_args: the command line arguments, with the reposfile of the policy
+    :param regserver: the registry server
+    :param repo_tags_dates_digest: a dict containing the tags, dates and digests for each repository
+    :param digest_index: the DigestIndex of all repositories of the snapshot
+    :return: a dict containing the tags and the digests to be deleted for each planned repository
+    """
+    repos_counts, repos = create_repo_list(cmd_args, regserver, list(repo_tags_dates_digest))
+    # completes the repos of a streamed catalog
+    for _ in repos:
+        pass
+
+    plans = collections.OrderedDict()
+    for repo, (count, tagname, since, order) in repos_counts.items():
+        if repo not in repo_tags_dates_digest:
+            continue
+        del_tags = get_deletiontags(cmd_args.verbose, repo_tags_dates_digest[repo], repo, tagname, count,
+                                    cmd_args.regex, since, order)
+        plans[repo] = (del_tags, set(deletion_digests(cmd_args.verbose, del_tags, digest_index,
+                                                      cmd_args.ignoretag)))
+    return plans
+
+
+def evaluate_policies(cmd_args, regserver):
+    """
+    Evaluates the policy of the command line, or each reposfile given with [--what-if], against a snapshot and
+    prints how many tags of each repository would be deleted and kept. Policies after the first one are compared
+    with the first one.
+
+    :param cmd_args: the command line arguments
+    :param regserver: the registry server
+    """
+    snapshot_regserver, repo_tags_dates_digest = load_snapshot(cmd_args.from_snapshot)
+    if snapshot_regserver != regserver:
+        print ("Warning: the snapshot was taken from the registry server {0}.".format(snapshot_regserver))
+    digest_index = DigestIndex()
+    for repo, tags_dates_digests in repo_tags_dates_digest.items():
+        digest_index.add_repo(repo, tags_dates_digests)
+    print ("Snapshot of {0} repos with {1} tags.".format(len(repo_tags_dates_digest), digest_index.references))
+
+    results = []
+    for policy_file in cmd_args.what_if or [cmd_args.reposfile]:
+        policy_args = argparse.Namespace(**vars(cmd_args))
+        policy_args.reposfile = policy_file
+        plans = plan_policy(policy_args, regserver, repo_tags_dates_digest, digest_index)
+        name = policy_file if policy_file is not None else 'command line'
+        results.append((name, plans))
+
+        print ()
+        print ("Policy {0}: {1} tags and {2} digests of {3} repos would be deleted.".format(
+            name, sum(len(del_tags) for del_tags, _ in plans.values()),
+            sum(len(digests) for _, digests in plans.values()), len(plans)))
+        for repo, (del_tags, digests) in plans.items():
+            amount_tags = len(repo_tags_dates_digest[repo])
+            print ("  {0}: {1} tags, {2} deleted, {3} kept, {4} digests deleted".format(
+                repo, amount_tags, len(del_tags), amount_tags - len(del_tags), len(digests)))
+
+    first_name, first_plans = results[0]
+    for name, plans in results[1:]:
+        print ()
+        print ("Policy {0} compared with {1}:".format(name, first_name))
+        differences = 0
+        for repo in sorted(set(first_plans) | set(plans)):
+            first_tags = set(first_plans[repo][0]) if repo in first_plans else set()
+            tags = set(plans[repo][0]) if repo in plans else set()
+            if first_tags != tags:
+                differences += 1
+                print ("  {0}: {1} more and {2} less tags deleted".format(repo, len(tags - first_tags),
+                                                                         len(first_tags - tags)))
+                if cmd_args.verbose > 0:
+                    print ("    more: {0}".format(sorted(tags - first_tags)))
+                    print ("    less: {0}".format(sorted(first_tags - tags)))
+        if differences == 0:
+            print ("  No differences.")
+
+
+def explain_policies(cmd_args, regserver):
+    """
+    Prints for each repository of the catalog which rule applies to it: [-n], a name or a pattern of the reposfile,
+    the defaults of [-cf], or none.
+
+    :param cmd_args: the command line arguments
+    :param regserver: the registry server
+    """
+    matcher = read_reposfile(cmd_args)
+    repos_counts, repos = create_repo_list(cmd_args, regserver, matcher=matcher)
+    for repo in repos:
+        if repo not in repos_counts:
+            print ("{0}: no rule, only scanned for the references of its digests".format(repo))
+            continue
+        if bool(cmd_args.reponame):
+            rule = "[-n]"
+        else:
+            key, policy = matcher.match(repo)
+            if key == repo:
+                rule = "reposfile entry {0}".format(key)
+            elif key is not None:
+                rule = "reposfile pattern {0}".format(key)
+            else:
+                rule = "[-cf] defaults"
+        count, tagname, since, order = repos_counts[repo]
+        print ("{0}: {1} (keepimages: {2}, tag: {3}, keepsince: {4}, order: {5})".format(
+            repo, rule, count, tagname or '-', since or '-', order))
+    print ("{0} repos have a rule.".format(len(repos_counts)))
+
+
+class RetentionServer(object):
+    """
+    Keeps the tags, creation dates and digests of a scan in memory and updates them with the notifications the
+    registry server posts on pushes and deletions. The repositories pushed to are cleaned up by their policy every
+    [--serve-interval] seconds, or right after each push with an interval of 0. A cleanup only costs the requests of
+    its deletions, the registry server isn't scanned again.
+    The requests are sent with the given transport, by default with the one of get_transport().
+    """
+
+    def __init__(self, cmd_args, regserver, repos_counts, repo_tags_dates_digest, digest_index, transport=None):
+        self.cmd_args = cmd_args
+        self.regserver = regserver
+        self.transport = transport if transport is not None else get_transport(regserver)
+        self.repos_counts = repos_counts
+        self.repo_tags_dates_digest = repo_tags_dates_digest
+        self.digest_index = digest_index
+        self.matcher = read_reposfile(cmd_args)
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        # the first cleanup covers all repositories with a policy
+        self.changed = set(repos_counts)
+        self.events = 0
+        self.cleanups = 0
+        self.deleted = 0
+        from http.server import ThreadingHTTPServer
+        self.server = ThreadingHTTPServer((cmd_args.serve_host, cmd_args.serve), self.create_handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}/'.format(*self.server.server_address[:2])
+
+    def policy(self, repo):
+        """
+        Returns the policy of a repository, repositories created after the start get the one of a matching pattern
+        of the reposfile or the default one with [-cf].
+        """
+        policy = self.repos_counts.get(repo)
+        if policy is None and in_shard(repo, self.cmd_args.shard_index, self.cmd_args.shard_count):
+            key, policy = self.matcher.match(repo)
+            if policy is None and self.cmd_args.clean_full_catalog:
+                policy = (self.cmd_args.keepimages, '', self.cmd_args.since, self.cmd_args.order)
+            if policy is not None:
+                self.repos_counts[repo] = policy
+        return policy
+
+    def set_tag(self, repo, tag, tag_date_digest):
+        self.remove_tag(repo, tag)
+        self.repo_tags_dates_digest.setdefault(repo, {})[tag] = tag_date_digest
+        self.digest_index.add_reference(repo, tag_date_digest['digest'])
+
+    def remove_tag(self, repo, tag):
+        tags = self.repo_tags_dates_digest.get(repo, {})
+        data = tags.pop(tag, None)
+        if data is not None:
+            referenced = any(other['digest'] == data['digest'] for other in tags.values())
+            self.digest_index.remove_reference(repo, data['digest'], referenced)
+
+    def remove_digest(self, repo, digest):
+        tags = self.repo_tags_dates_digest.get(repo, {})
+        for tag in [tag for tag, data in tags.items() if data['digest'] == digest]:
+            del tags[tag]
+            self.digest_index.remove_reference(repo, digest)
+
+    def handle_event(self, event):
+        """
+        Updates the tags with a single event of a notification. As notifications can't be trusted, a pushed tag is
+        only added after a HEAD confirms its digest and a deleted tag or manifest is only removed if a HEAD doesn't
+        find it anymore. A pushed digest which isn't known by another tag of the repository is resolved, too.
+        """
+        target = event.get('target', {})
+        repo = target.get('repository')
+        tag = target.get('tag')
+        digest = target.get('digest')
+        if repo is None or not in_shard(repo, self.cmd_args.shard_index, self.cmd_args.shard_count):
+            return
+        verbose = self.cmd_args.verbose
+        cacert = self.cmd_args.cacert
+        if event.get('action') == 'push' and tag:
+            try:
+                digest = get_digest_by_tag(verbose, self.regserver, repo, tag, cacert, missing_ok=True,
+                                           transport=self.transport)
+                if digest is None:
+                    print ("Skipping the push of {0}:{1}, the tag doesn't exist.".format(repo, tag))
+                    return
+                with self.lock:
+                    known = [data for data in self.repo_tags_dates_digest.get(repo, {}).values()
+                             if data['digest'] == digest]
+                if len(known) > 0:
+                    tag_date_digest = dict(known[0])
+                else:
+                    tag_date_digest = retrieve_metadata(verbose, self.regserver, repo, digest, cacert, self.transport)
+            except (RegistryError, requests.RequestException) as error:
+                print ("Skipping the push of {0}:{1}: {2}".format(repo, tag, error))
+                return
+            with self.lock:
+                self.set_tag(repo, tag, tag_date_digest)
+                self.changed.add(repo)
+            if verbose > 0:
+                print ("Pushed {0}:{1} with digest {2}.".format(repo, tag, tag_date_digest['digest']))
+            if self.cmd_args.serve_interval == 0:
+                self.wakeup.set()
+        elif event.get('action') == 'delete' and (tag or digest):
+            reference = tag or digest
+            with self.lock:
+                tags = self.repo_tags_dates_digest.get(repo, {})
+                # e.g. the notification of a deletion of the server itself
+                if reference not in tags and not any(data['digest'] == reference for data in tags.values()):
+                    return
+            try:
+                if get_digest_by_tag(verbose, self.regserver, repo, reference, cacert, missing_ok=True,
+                                     transport=self.transport) is not None:
+                    print ("Ignoring the deletion of {0} of {1}, it still exists.".format(reference, repo))
+                    return
+            except (RegistryError, requests.RequestException) as error:
+                print ("Ignoring the deletion of {0} of {1}: {2}".format(reference, repo, error))
+                return
+            with self.lock:
+                if tag:
+                    self.remove_tag(repo, tag)
+                else:
+                    self.remove_digest(repo, digest)
+            if verbose > 0:
+                print ("Deleted {0} of {1}.".format(reference, repo))
+
+    def clean_up(self):
+        """
+        Plans and deletes the images of the repositories changed since the previous cleanup.
+        """
+        cmd_args = self.cmd_args
+        repo_del_digests = {}
+        with self.lock:
+            changed, self.changed = self.changed, set()
+            for repo in sorted(changed):
+                policy = self.policy(repo)
+                if policy is None or repo not in self.repo_tags_dates_digest:
+                    continue
+                count, tagname, since, order = policy
+                del_tags = get_deletiontags(cmd_args.verbose, self.repo_tags_dates_digest[repo], repo, tagname,
+                                            count, cmd_args.regex, since, order)
+                if cmd_args.delete_tags:
+                    digests = set(del_tags)
+                else:
+                    digests = set(deletion_digests(cmd_args.verbose, del_tags, self.digest_index,
+                                                   cmd_args.ignoretag))
+                if len(digests) > 0:
+                    repo_del_digests[repo] = digests
+        if len(repo_del_digests) > 0:
+            self.delete(repo_del_digests)
+        self.cleanups += 1
+
+    def delete(self, repo_del_digests):
+        """
+        Deletes the planned digests, or tags with [--delete-tags], and removes them from the tags in memory.
+        """
+        cmd_args = self.cmd_args
+        deleter = DeletionExecutor(cmd_args.delete_workers, cmd_args.delete_rate, cmd_args.delete_tags)
+        delete_all_digests(cmd_args.verbose, self.regserver, repo_del_digests, deleter, cmd_args.cacert,
+                           cmd_args.max_inflight, self.transport)
+        failed = {(repo, digest) for repo, digest, status in deleter.failures}
+        with self.lock:
+            for repo, digests in repo_del_digests.items():
+                for reference in digests:
+                    if (repo, reference) in failed:
+                        # retried by the next cleanup
+                        self.changed.add(repo)
+                    elif cmd_args.delete_tags:
+                        self.remove_tag(repo, reference)
+                    else:
+                        self.remove_digest(repo, reference)
+        self.deleted += deleter.deleted
+        deleter.print_summary()
+
+    def create_handler(self):
+        from http.server import BaseHTTPRequestHandler
+        retention_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                if retention_server.cmd_args.verbose > 1:
+                    BaseHTTPRequestHandler.log_message(self, *args)
+
+            def respond(self, status):
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_POST(self):
+                token = retention_server.cmd_args.serve_token
+                if token is not None and not hmac.compare_digest(self.headers.get('Authorization', ''),
+                                                                 'Bearer ' + token):
+                    return self.respond(401)
+                try:
+                    envelope = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                    events = envelope['events']
+                except (ValueError, KeyError, TypeError):
+                    return self.respond(400)
+                for event in events:
+                    retention_server.handle_event(event)
+                with retention_server.lock:
+                    retention_server.events += len(events)
+                self.respond(200)
+
+        return Handler
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+
+    def run(self):
+        """
+        Receives notifications and cleans up until it's interrupted or stopped.
+        """
+        thread = threading.Thread(target=self.server.serve_forever, name='cleanreg-serve', daemon=True)
+        thread.start()
+        print ("Listening for notifications of the registry server on {0}".format(self.url))
+        try:
+            while not self.stopped:
+                self.clean_up()
+                self.wakeup.wait(self.cmd_args.serve_interval if self.cmd_args.serve_interval > 0 else None)
+                self.wakeup.clear()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+        print ("Stopped after {0} events and {1} cleanups, {2} manifests deleted.".format(self.events, self.cleanups,
+                                                                                      self.deleted))
+
+
+class RegistryClient(object):
+    """
+    Scans, plans and cleans up a registry server with a configuration of create_config(), to use cleanreg as a
+    library without its command line. Several clients can be used in the same process, also for the same registry
+    server, each one with its own transport and settings:
+
+        client = RegistryClient(create_config('http://1.2.3.4:5000', clean_full_catalog=True, keepimages=5))
+        repo_tags_dates_digest, digest_index = client.scan()
+        repo_del_tags, repo_del_digests = client.plan(repo_tags_dates_digest, digest_index)
+        deleter = client.apply(repo_del_digests)
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.regserver = config.registry + "/v2/"
+        if config.skip_tls_verify:
+            config.cacert = False
+        if config.proxy is False:
+            netloc = urlparse(config.registry).netloc
+            no_proxy = [host for host in os.environ.get('no_proxy', '').split(',') if host]
+            if netloc not in no_proxy:
+                os.environ['no_proxy'] = ','.join(no_proxy + [netloc])
+        self.transport = create_transport(config)
+        # repository -> policy of the last scan
+        self.repos_counts = {}
+
+    def is_v2_registry(self):
+        return is_v2_registry(self.config.verbose, self.regserver, self.config.cacert, self.transport)
+
+    def scan(self, repositories=None):
+        """
+        Scans the repositories which have a policy in the configuration.
+
+        :param repositories: the repository names to be used instead of the catalog of the registry server
+        :return: a dict containing the tags, dates and digests for each scanned repository and the DigestIndex
+        """
+        config = self.config
+        self.repos_counts, repos = create_repo_list(config, self.regserver, repositories, transport=self.transport)
+        repo_tags_dates_digest, digest_index = get_all_tags_dates_digests(config.verbose, self.regserver, repos,
+                                                                          config.md_workers, config.cacert,
+                                                                          config.max_inflight, config.page_size,
+                                                                          transport=self.transport)
+        for repo in [repo for repo in self.repos_counts if repo not in repo_tags_dates_digest]:
+            del self.repos_counts[repo]
+        return repo_tags_dates_digest, digest_index
+
+    def plan(self, repo_tags_dates_digest, digest_index):
+        """
+        Plans the deletion of the scanned repositories by their policies.
+
+        :param repo_tags_dates_digest: a dict containing the tags, dates and digests for each repository
+        :param digest_index: the DigestIndex of the scanned repositories
+        :return: a dict containing the tags to be deleted for each repository and a dict containing the digests
+                 to be deleted, or the tags with delete_tags set, for each repository
+        """
+        config = self.config
+        repo_del_tags = {}
+        repo_del_digests = {}
+        for repo, (count, tagname, since, order) in self.repos_counts.items():
+            if repo not in repo_tags_dates_digest:
+                continue
+            del_tags = get_deletiontags(config.verbose, repo_tags_dates_digest[repo], repo, tagname, count,
+                                        config.regex, since, order)
+            if len(del_tags) == 0:
+                continue
+            repo_del_tags[repo] = del_tags
+            if config.delete_tags:
+                repo_del_digests[repo] = set(del_tags)
+            else:
+                repo_del_digests[repo] = set(deletion_digests(config.verbose, del_tags, digest_index,
+                                                              config.ignoretag))
+        return repo_del_tags, repo_del_digests
+
+    def apply(self, repo_del_digests):
+        """
+        Deletes the planned digests, or tags with delete_tags set. Deleting tags needs a registry server which
+        supports it, see supports_tag_deletion().
+
+        :param repo_del_digests: a dict containing the digests to be deleted for each repository
+        :return: the DeletionExecutor with the deleted, skipped and failed deletions
+        """
+        config = self.config
+        deleter = DeletionExecutor(config.delete_workers, config.delete_rate, config.delete_tags)
+        delete_all_digests(config.verbose, self.regserver, repo_del_digests, deleter, config.cacert,
+                           config.max_inflight, self.transport)
+        return deleter
+
+# >>>>>>>>>>>>>>>> MAIN STUFF
+
+def main():
+    """
+    Runs cleanreg with the command line arguments.
+    """
+    global args
     args = parse_arguments()
 
     reg_server_api = args.registry + "/v2/"
@@ -680,44 +3466,199 @@ if __name__ == '__main__':
     if args.skip_tls_verify:
         args.cacert = False
 
+    if args.trace_file is not None:
+        metrics.open_trace(args.trace_file)
+    atexit.register(metrics.close)
+    if args.metrics_file is not None:
+        # registered last as it's called first, so the report is written on every exit
+        atexit.register(metrics.write, args.metrics_file)
+
+    if args.from_snapshot is not None:
+        evaluate_policies(args, reg_server_api)
+        sys.exit(0)
+
     # initially check if we've a v2 registry server
+    phase_started = time.time()
     if is_v2_registry(args.verbose, reg_server_api, args.cacert) is False:
         print ("Exiting, none V2 registry.")
         sys.exit(1)
+    metrics.record_phase('check', phase_started)
 
-    repos_counts, repos = create_repo_list(args, reg_server_api)
+    if args.explain:
+        explain_policies(args, reg_server_api)
+        sys.exit(0)
 
-    x = 0
+    if args.delete_tags:
+        if bool(args.reponame):
+            probe_repo = args.reponame.split(':')[0]
+        else:
+            probe_repo = next(iter_repositories(args, reg_server_api), None)
+        if probe_repo is not None and supports_tag_deletion(args.verbose, reg_server_api, probe_repo, args.cacert):
+            if args.ignoretag:
+                print ("Deleting single tags, [-i] isn't needed to keep shared digests.")
+                args.ignoretag = False
+        else:
+            print ("The registry server doesn't support the deletion of tags, deleting manifests by digest.")
+            args.delete_tags = False
+
+    journal = None
+    if args.journal is not None:
+        journal = Journal(args.journal, reg_server_api, args.resume)
+        atexit.register(journal.close)
+
+    if args.apply_plan is not None:
+        repo_tag_digests = read_plan(args.apply_plan)
+        amount_tags = sum(len(tag_digests) for tag_digests in repo_tag_digests.values())
+        print ("Plan {0} deletes {1} tags of {2} repos.".format(args.apply_plan, amount_tags, len(repo_tag_digests)))
+        if amount_tags == 0 or not (args.assumeyes or args.quiet or query_yes_no("Do you realy want to delete them?")):
+            print ("Aborted by user or nothing to delete.")
+            sys.exit(1)
+        deleter = DeletionExecutor(args.delete_workers, args.delete_rate, args.delete_tags, journal)
+        changed = apply_plan(args.verbose, reg_server_api, repo_tag_digests, deleter, args.cacert, args.max_inflight)
+        metrics.record_phase('delete', deleter.started)
+        print ("{0} tags were changed since the plan was written and are kept.".format(changed))
+        deleter.print_summary()
+        if len(deleter.failures) > args.max_failures:
+            print ("Exiting, {0} deletions failed.".format(len(deleter.failures)))
+            sys.exit(12)
+        print ("Finished")
+        sys.exit(0)
 
-    repo_tags_dates_digest, all_digests = get_all_tags_dates_digests(args.verbose, reg_server_api, repos,
-                                                                     args.md_workers, args.cacert)
+    repos_counts, repos = create_repo_list(args, reg_server_api)
 
-    if args.verbose > 2:
-        print ("List of all repos, tags, their creation dates and their digests:")
-        print(json.dumps(repo_tags_dates_digest, indent=2))
-        print (all_digests)
+    x = 0
 
-    diggests_occurrences = collections.Counter(all_digests)
-    digests_counts = dict(diggests_occurrences)
+    metadata_cache = None
+    if args.cache_dir is not None:
+        metadata_cache = MetadataCache(args.cache_dir, args.cache_size)
+    snapshots = None
+    if args.incremental:
+        snapshots = SnapshotStore(args.cache_dir, reg_server_api)
 
     repo_del_tags = {}
     repo_del_digests = {}
-    for repo, (count, tagname, since) in repos_counts.items():
-        x += 1
-        update_progress(x, len(repos_counts))
+    deleter = DeletionExecutor(args.delete_workers, args.delete_rate, args.delete_tags, journal)
+
+    def tags_only(repo):
+        """
+        Repositories ordered by the names of their tags are planned with their tags list alone, unless the creation
+        dates are needed for [-s], the digests of all tags for [-i] or all metadata is kept for [--serve].
+        """
+        if args.ignoretag or args.save_snapshot is not None or args.serve is not None or repo not in repos_counts:
+            return False
+        count, tagname, since, order = repos_counts[repo]
+        return order != 'date' and not since
+
+    def plan_repo(repo, tags_dates_digests):
+        """
+        Plans the deletion of a single repository, used to delete while other repositories are scanned.
+        """
+        if repo not in repos_counts:
+            return {}
+        count, tagname, since, order = repos_counts[repo]
         if args.verbose > 0:
-            print ()
             print ("Will delete repo {0} and keep at least {1} images.".format(repo, count))
-        del_tags = get_deletiontags(args.verbose, repo_tags_dates_digest[repo], repo, tagname, count, args.regex, since)
-
+        del_tags = get_deletiontags(args.verbose, tags_dates_digests, repo, tagname, count, args.regex, since, order)
         if len(del_tags) > 0:
             repo_del_tags[repo] = del_tags
-            repo_del_digests[repo] = set(deletion_digests(args.verbose, del_tags, digests_counts, args.ignoretag))
+        return del_tags
+
+    phase_started = time.time()
+    if args.storage_root is not None:
+        repo_tags_dates_digest, digest_index = StorageScanner(args.verbose, args.storage_root,
+                                                              args.storage_workers).scan(repos)
+    else:
+        repo_tags_dates_digest, digest_index = get_all_tags_dates_digests(args.verbose, reg_server_api, repos,
+                                                                          args.md_workers, args.cacert,
+                                                                          args.max_inflight, args.page_size,
+                                                                          metadata_cache, snapshots,
+                                                                          plan_repo if args.pipeline else None,
+                                                                          deleter, tags_only, journal)
+
+    metrics.record_phase('scan', phase_started)
+
+    if metadata_cache is not None:
+        metadata_cache.close()
+        print ("Metadata cache: {0} hits, {1} misses.".format(metadata_cache.hits, metadata_cache.misses))
+    if snapshots is not None:
+        snapshots.close()
+        print ("Incremental scan: {0} repos unchanged, {1} repos rescanned.".format(snapshots.unchanged,
+                                                                                 snapshots.rescanned))
+
+    # with a streamed catalog the repos list is complete now, skip entries which weren't found in it
+    for repo in [repo for repo in repos_counts if repo not in repo_tags_dates_digest]:
+        del repos_counts[repo]
+        if args.verbose > 1:
+            print ("Skipping repo {0} because it is not in the catalog.".format(repo))
+
+    if args.verbose > 2:
+        print ("List of all repos, tags, their creation dates and their digests:")
+        print(json.dumps(repo_tags_dates_digest, indent=2))
+
+    if args.save_snapshot is not None:
+        save_snapshot(args.save_snapshot, reg_server_api, repo_tags_dates_digest)
+        print ("Saved a snapshot of {0} repos to {1}.".format(len(repo_tags_dates_digest), args.save_snapshot))
+
+    if args.export_refs is not None:
+        digest_index.export(args.export_refs, registry=reg_server_api, shard_index=args.shard_index,
+                            shard_count=args.shard_count)
+        digest_index.print_stats()
+        print ("Exported the digest references of shard {0} to {1}.".format(args.shard_index, args.export_refs))
+        sys.exit(0)
+
+    if args.import_refs is not None:
+        import_refs(args.verbose, digest_index, args.import_refs, reg_server_api, args.shard_index,
+                    args.shard_count)
+
+    if args.ignoretag:
+        digest_index.print_stats()
+
+    if args.serve is not None:
+        # the first cleanup of the server plans and deletes the images of all repositories
+        RetentionServer(args, reg_server_api, repos_counts, repo_tags_dates_digest, digest_index).run()
+        get_transport(reg_server_api).limiter.print_stats()
+        sys.exit(0)
+
+    # in pipeline mode each repo was planned and cleaned up right after it was scanned
+    phase_started = time.time()
+    if args.pipeline is False:
+        for repo, (count, tagname, since, order) in repos_counts.items():
+            x += 1
+            update_progress(x, len(repos_counts))
+            if args.verbose > 0:
+                print ()
+                print ("Will delete repo {0} and keep at least {1} images.".format(repo, count))
+            del_tags = get_deletiontags(args.verbose, repo_tags_dates_digest[repo], repo, tagname, count, args.regex,
+                                        since, order)
+
+            if len(del_tags) > 0:
+                repo_del_tags[repo] = del_tags
+
+        # the digests of the tags planned by their names are only retrieved now
+        unresolved_tags = {repo: del_tags for repo, del_tags in repo_del_tags.items() if tags_only(repo)}
+        if args.storage_root is None and (not args.delete_tags or args.write_plan is not None) and \
+                len(unresolved_tags) > 0:
+            resolve_all_digests(args.verbose, reg_server_api, unresolved_tags, args.cacert, args.max_inflight)
+
+    for repo, del_tags in repo_del_tags.items():
+        if args.delete_tags:
+            # a manifest referenced by other tags isn't deleted with a single tag
+            repo_del_digests[repo] = set(del_tags)
+        else:
+            repo_del_digests[repo] = set(deletion_digests(args.verbose, del_tags, digest_index, args.ignoretag))
+
+    metrics.record_phase('plan', phase_started)
+
+    if args.write_plan is not None:
+        amount_tags = write_plan(args.write_plan, repo_del_tags, repo_del_digests)
+        print ("Wrote {0} tags of {1} repos to be deleted to {2}.".format(amount_tags, len(repo_del_digests),
+                                                                          args.write_plan))
+        sys.exit(0)
 
     answer = True
     if args.assumeyes is False and args.quiet is False and len(repo_del_digests) > 0:
         print ()
-        print ("Repos and according digests to be deleted:")
+        print ("Repos and according {0} to be deleted:".format('tags' if args.delete_tags else 'digests'))
         for repo, del_digests in repo_del_digests.items():
             print ("Repository: ", repo)
             for digest in del_digests:
@@ -725,15 +3666,36 @@ if __name__ == '__main__':
         answer = query_yes_no("Do you realy want to delete them?")
 
     if answer is True and len(repo_del_digests) > 0:
-        print ("Deleting!")
-        for repo, del_digests in repo_del_digests.items():
-            for digest in del_digests:
-                print ("Deleting ", digest)
-                delete_manifest(args.verbose, reg_server_api, repo, digest, args.cacert)
+        if args.pipeline:
+            print ("Deleted the digests of {0} repos while scanning.".format(len(repo_del_digests)))
+        else:
+            print ("Deleting!")
+            deleter.started = time.time()
+            delete_all_digests(args.verbose, reg_server_api, repo_del_digests, deleter, args.cacert,
+                               args.max_inflight)
+            metrics.record_phase('delete', deleter.started)
+        deleter.print_summary()
+        get_transport(reg_server_api).limiter.print_stats()
+        if args.report_connections:
+            print_transport_stats(get_transport(reg_server_api).stats())
+        if len(deleter.failures) > args.max_failures:
+            print ("Exiting, {0} deletions failed.".format(len(deleter.failures)))
+            sys.exit(12)
     else:
+        get_transport(reg_server_api).limiter.print_stats()
+        if args.report_connections:
+            print_transport_stats(get_transport(reg_server_api).stats())
         print ("Aborted by user or nothing to delete.")
         sys.exit(1)
 
     print ()
     print ("Finished")
     sys.exit(0)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except (RegistryError, ConfigError) as error:
+        print (error)
+        sys.exit(error.exit_code)
@@ -0,0 +1,344 @@
+# coding=utf-8
+"""
+An in-process stand-in for the Docker Registry HTTP API v2, serving generated repositories and tags.
+It supports the catalog and tags list with pagination, schema2 manifests, config blobs and deletion of manifests.
+Latency and errors (429, 503) can be injected per request. With tag_deletion single tags can be deleted. With token_auth it acts like a registry behind a token
+server, the token server is served by the same instance.
+The generated repositories can be written to a directory in the layout of the filesystem storage driver, too.
+With notify_url set, pushes and deletions are posted as notification envelopes to this URL.
+
+    registry = FakeRegistry(repos=10, tags=100, latency=0.005)
+    registry.start()
+    ... run cleanreg against registry.url ...
+    registry.stop()
+"""
+import os
+import json
+import collections
+import time
+import queue
+import random
+import hashlib
+import threading
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, urlencode
+
+MANIFEST_TYPE = 'application/vnd.docker.distribution.manifest.v2+json'
+CONFIG_TYPE = 'application/vnd.docker.container.image.v1+json'
+
+
+def sha256(data):
+    return 'sha256:' + hashlib.sha256(data).hexdigest()
+
+
+class FakeRegistry(object):
+    """
+    Generates repos repositories with tags tags each. A share of shared_ratio of the tags points to images
+    which are pushed to every repository, the other tags point to images of their own.
+    Each request is delayed by latency seconds, a share of error_rate of the requests is answered with
+    429 or 503. Pages of the catalog and tags list contain at most page_size entries.
+    With token_auth each request needs a bearer token for its scope, which is issued for token_expiry seconds.
+    With tag_deletion a DELETE of a tag deletes only this tag, otherwise it's answered as unsupported.
+    The requests of each manifest are counted in manifest_requests by method, repository and reference.
+    With notify_url each push with push() and each deletion is posted as a notification to this URL, with
+    notify_token as bearer token if it's set. Like a registry, the notifications are queued and sent in order by
+    a thread of their own, wait_notifications() waits until all of them are sent.
+    """
+
+    def __init__(self, repos=10, tags=100, latency=0.0, page_size=100, shared_ratio=0.0, error_rate=0.0,
+                 seed=42, port=0, token_auth=False, token_expiry=300, tag_deletion=False, notify_url=None,
+                 notify_token=None):
+        self.latency = latency
+        self.notify_url = notify_url
+        self.notify_token = notify_token
+        self.notifications = queue.Queue()
+        self.notifier = None
+        self.tag_deletion = tag_deletion
+        self.page_size = page_size
+        self.error_rate = error_rate
+        self.token_auth = token_auth
+        self.token_expiry = token_expiry
+        # token -> (scopes, expiry time)
+        self.tokens = {}
+        self.token_requests = 0
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.deleted = 0
+        # (method, repository, reference) -> amount of requests of this manifest
+        self.manifest_requests = collections.Counter()
+        # digest -> content, shared by all repositories like the blob store of a registry
+        self.blobs = {}
+        self.manifests = {}
+        # repository -> {tag: manifest digest}
+        self.repos = {}
+
+        shared_images = [self.create_image('shared-{0}'.format(i)) for i in range(max(1, tags // 10))]
+        for r in range(repos):
+            name = 'bench/repo-{0:05d}'.format(r)
+            self.repos[name] = {}
+            for t in range(tags):
+                if self.random.random() < shared_ratio:
+                    digest = self.random.choice(shared_images)
+                else:
+                    digest = self.create_image('{0}-{1}'.format(name, t))
+                self.repos[name]['{0:06d}'.format(t)] = digest
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self.create_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+
+    @property
+    def amount_tags(self):
+        return sum(len(tags) for tags in self.repos.values())
+
+    def create_image(self, name, created=None):
+        """
+        Creates a config blob with the given or a random creation date and a manifest referencing it.
+        :return: the digest of the manifest
+        """
+        if created is None:
+            created = 1577836800 + self.random.randint(0, 2 * 365 * 24 * 3600)
+        config = json.dumps({'created': time.strftime('%Y-%m-%dT%H:%M:%S.000000000Z', time.gmtime(created)),
+                             'config': {'Labels': {'name': name}}}).encode()
+        config_digest = sha256(config)
+        self.blobs[config_digest] = config
+        manifest = json.dumps({'schemaVersion': 2, 'mediaType': MANIFEST_TYPE,
+                               'config': {'mediaType': CONFIG_TYPE, 'size': len(config), 'digest': config_digest},
+                               'layers': []}).encode()
+        digest = sha256(manifest)
+        self.manifests[digest] = manifest
+        return digest
+
+    def write_storage(self, storage_root):
+        """
+        Writes the repositories, manifests and config blobs in the layout of the filesystem storage driver.
+        """
+        v2 = os.path.join(storage_root, 'docker', 'registry', 'v2')
+        for digest, content in list(self.blobs.items()) + list(self.manifests.items()):
+            hex_digest = digest.partition(':')[2]
+            blob_dir = os.path.join(v2, 'blobs', 'sha256', hex_digest[:2], hex_digest)
+            os.makedirs(blob_dir, exist_ok=True)
+            with open(os.path.join(blob_dir, 'data'), 'wb') as data:
+                data.write(content)
+        for name, tags in self.repos.items():
+            for tag, digest in tags.items():
+                link_dir = os.path.join(v2, 'repositories', name, '_manifests', 'tags', tag, 'current')
+                os.makedirs(link_dir, exist_ok=True)
+                with open(os.path.join(link_dir, 'link'), 'w') as link:
+                    link.write(digest)
+
+    def notify(self, action, repo, digest, tag=None):
+        """
+        Queues a notification envelope with a single event, like the notification endpoints of a registry do.
+        """
+        if self.notify_url is None:
+            return
+        with self.lock:
+            if self.notifier is None:
+                self.notifier = threading.Thread(target=self.send_notifications, name='fakeregistry-notify',
+                                                 daemon=True)
+                self.notifier.start()
+        self.notifications.put((action, repo, digest, tag))
+
+    def wait_notifications(self):
+        self.notifications.join()
+
+    def send_notifications(self):
+        while True:
+            action, repo, digest, tag = self.notifications.get()
+            try:
+                self.post_notification(action, repo, digest, tag)
+            finally:
+                self.notifications.task_done()
+
+    def post_notification(self, action, repo, digest, tag):
+        target = {'mediaType': MANIFEST_TYPE, 'repository': repo, 'digest': digest}
+        if tag is not None:
+            target['tag'] = tag
+        envelope = {'events': [{'id': os.urandom(16).hex(), 'action': action,
+                                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                                'target': target}]}
+        headers = {'Content-Type': 'application/vnd.docker.distribution.events.v1+json'}
+        if self.notify_token is not None:
+            headers['Authorization'] = 'Bearer ' + self.notify_token
+        request = urllib.request.Request(self.notify_url, json.dumps(envelope).encode(), method='POST',
+                                         headers=headers)
+        try:
+            urllib.request.urlopen(request).close()
+        except OSError:
+            # a rejected notification, or one the listener didn't answer, is dropped
+            pass
+
+    def push(self, repo, tag):
+        """
+        Pushes a new image with the given tag, created now.
+        """
+        with self.lock:
+            digest = self.create_image('{0}-{1}-{2}'.format(repo, tag, time.time()), time.time())
+            self.repos.setdefault(repo, {})[tag] = digest
+        self.notify('push', repo, digest, tag)
+        return digest
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fakeregistry', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.thread is not None:
+            self.server.shutdown()
+        self.server.server_close()
+
+    def issue_token(self, scopes):
+        with self.lock:
+            self.token_requests += 1
+            token = '{0:032x}'.format(self.random.getrandbits(128))
+            self.tokens[token] = (set(scopes), time.time() + self.token_expiry)
+        return {'token': token, 'expires_in': self.token_expiry}
+
+    def is_authorized(self, authorization, scope):
+        if not authorization.startswith('Bearer '):
+            return False
+        scopes, expiry = self.tokens.get(authorization[len('Bearer '):], (set(), 0))
+        return expiry > time.time() and (scope is None or scope in scopes)
+
+    def create_handler(self):
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def send(self, status, body=b'', headers=None):
+                self.send_response(status)
+                self.send_header('Docker-Distribution-Api-Version', 'registry/2.0')
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
+
+            def send_page(self, key, name, entries, query, path):
+                amount = min(int(query.get('n', [registry.page_size])[0]), registry.page_size)
+                last = query.get('last', [None])[0]
+                entries = sorted(entry for entry in entries if last is None or entry > last)
+                page = entries[:amount]
+                headers = {'Content-Type': 'application/json'}
+                if len(entries) > amount:
+                    headers['Link'] = '<{0}?{1}>; rel="next"'.format(path, urlencode({'n': amount, 'last': page[-1]}))
+                body = {key: page}
+                if name is not None:
+                    body['name'] = name
+                body = json.dumps(body).encode()
+                # like the registry, the ETag only covers the page itself
+                headers['Etag'] = '"{0}"'.format(sha256(body))
+                if self.headers.get('If-None-Match') == headers['Etag']:
+                    return self.send(304, headers={'Etag': headers['Etag']})
+                self.send(200, body, headers)
+
+            def authorize(self, path):
+                """
+                Checks the bearer token of the request and sends a challenge for the needed scope if it's missing.
+                """
+                if not registry.token_auth:
+                    return True
+                scope = None
+                if path == '/v2/_catalog':
+                    scope = 'registry:catalog:*'
+                elif path != '/v2/':
+                    repo = path[len('/v2/'):]
+                    for kind in ('/tags/list', '/manifests/', '/blobs/'):
+                        repo = repo.partition(kind)[0]
+                    action = 'delete' if self.command == 'DELETE' else 'pull'
+                    scope = 'repository:{0}:{1}'.format(repo.rstrip('/'), action)
+                if registry.is_authorized(self.headers.get('Authorization', ''), scope):
+                    return True
+                challenge = 'Bearer realm="{0}/token",service="fakeregistry"'.format(registry.url)
+                if scope is not None:
+                    challenge += ',scope="{0}"'.format(scope)
+                self.send(401, b'{"errors": [{"code": "UNAUTHORIZED"}]}', {'WWW-Authenticate': challenge})
+                return False
+
+            def handle_request(self):
+                with registry.lock:
+                    registry.requests += 1
+                    failing = registry.random.random() < registry.error_rate
+                    if failing:
+                        registry.errors += 1
+                if registry.latency > 0:
+                    time.sleep(registry.latency)
+                if failing:
+                    return self.send(registry.random.choice([429, 503]), headers={'Retry-After': '0'})
+
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                path = url.path
+                if path == '/token':
+                    body = registry.issue_token(query.get('scope', []))
+                    return self.send(200, json.dumps(body).encode(), {'Content-Type': 'application/json'})
+                if not self.authorize(path):
+                    return
+                if path == '/v2/':
+                    return self.send(200, b'{}')
+                if path == '/v2/_catalog':
+                    return self.send_page('repositories', None, list(registry.repos), query, path)
+
+                for kind in ('/tags/list', '/manifests/', '/blobs/'):
+                    repo, _, reference = path[len('/v2/'):].partition(kind)
+                    if reference or (kind == '/tags/list' and repo and path.endswith(kind)):
+                        break
+                else:
+                    return self.send(404)
+                tags = registry.repos.get(repo.rstrip('/'))
+                if tags is None:
+                    return self.send(404)
+
+                if kind == '/tags/list':
+                    return self.send_page('tags', repo, list(tags), query, path)
+                if kind == '/blobs/':
+                    blob = registry.blobs.get(reference)
+                    return self.send(200, blob) if blob is not None else self.send(404)
+
+                if self.command == 'DELETE' and not reference.startswith('sha256:'):
+                    if not registry.tag_deletion:
+                        return self.send(405, b'{"errors": [{"code": "UNSUPPORTED"}]}')
+                    if reference not in tags:
+                        return self.send(404, b'{"errors": [{"code": "MANIFEST_UNKNOWN"}]}')
+                    with registry.lock:
+                        digest = tags.pop(reference)
+                        registry.deleted += 1
+                    self.send(202)
+                    return registry.notify('delete', repo, digest, reference)
+                with registry.lock:
+                    registry.manifest_requests[(self.command, repo.rstrip('/'), reference)] += 1
+                digest = tags.get(reference, reference)
+                if digest not in tags.values():
+                    return self.send(404)
+                if self.command == 'DELETE':
+                    with registry.lock:
+                        for tag in [tag for tag, tag_digest in tags.items() if tag_digest == digest]:
+                            del tags[tag]
+                        registry.deleted += 1
+                    self.send(202)
+                    return registry.notify('delete', repo, digest)
+                etag = '"{0}"'.format(digest)
+                if self.headers.get('If-None-Match') == etag:
+                    return self.send(304, headers={'Docker-Content-Digest': digest, 'Etag': etag})
+                return self.send(200, registry.manifests[digest], {'Content-Type': MANIFEST_TYPE,
+                                                                   'Docker-Content-Digest': digest, 'Etag': etag})
+
+            do_GET = handle_request
+            do_HEAD = handle_request
+            do_DELETE = handle_request
+
+        return Handler
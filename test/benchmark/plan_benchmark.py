@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Measures the time get_deletiontags needs to plan the cleanup of a single repository with many tags.
+No registry server is needed, the tags are generated.
+
+    python test/benchmark/plan_benchmark.py -t 100000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+import cleanreg
+
+
+def generate_tags(amount_tags, seed=42):
+    """
+    Generates a dict of tags with creation dates over about two years and digests, like the scan returns it.
+    """
+    rnd = random.Random(seed)
+    tags = {}
+    for i in range(amount_tags):
+        created = 1577836800 + rnd.randint(0, 2 * 365 * 24 * 3600)
+        date = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(created)) + '.{0:09d}Z'.format(rnd.randint(0, 10 ** 9 - 1))
+        tags['build-{0}'.format(i)] = {'date': date,
+                                       'digest': 'sha256:{0:064x}'.format(rnd.getrandbits(256)),
+                                       'epoch': created}
+    return tags
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the deletion planning of cleanreg.')
+    parser.add_argument('-t', '--tags', help="Amount of tags in the repository. Default value is 100000.",
+                        default=100000, type=int)
+    parser.add_argument('-n', '--runs', help="Amount of runs per policy, the best one is reported. "
+                                             "Default value is 5.", default=5, type=int)
+    args = parser.parse_args()
+
+    tags = generate_tags(args.tags)
+    # (name, tagname, keep_count, regex, since)
+    policies = [('keep 10', '', 10, False, None),
+                ('keep 10, regex', 'build-1.*', 10, True, None),
+                ('keep 10, since', '', 10, False, '2021-01-01'),
+                ('keep 10, regex and since', 'build-1.*', 10, True, '2021-01-01')]
+
+    print ("Planning a repository with {0} tags, best of {1} runs:".format(args.tags, args.runs))
+    for name, tagname, keep_count, regex, since in policies:
+        best = None
+        for _ in range(args.runs):
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                started = time.perf_counter()
+                del_tags = cleanreg.get_deletiontags(0, tags, 'benchmark', tagname, keep_count, regex, since)
+                elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        print ("  {0:<28} {1:8.1f} ms, {2} tags to delete".format(name, best * 1000, len(del_tags)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Runs the scan, plan and delete phases of cleanreg against an in-process fake registry and reports the
+wall time and requests per second of each phase and the peak RSS. No Docker is needed.
+
+    python test/benchmark/registry_benchmark.py --repos 100 --tags 200 --latency 0.005 --shared-ratio 0.3
+"""
+import os
+import sys
+import time
+import argparse
+import resource
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+import cleanreg
+from fakeregistry import FakeRegistry
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmarks cleanreg against a fake registry.')
+    parser.add_argument('--repos', help="Amount of repositories. Default value is 20.", default=20, type=int)
+    parser.add_argument('--tags', help="Amount of tags per repository. Default value is 100.", default=100, type=int)
+    parser.add_argument('--latency', help="Latency of each request in seconds. Default value is 0.",
+                        default=0.0, type=float)
+    parser.add_argument('--page-size', help="Maximum page size of the registry. Default value is 100.",
+                        default=100, type=int, dest='page_size')
+    parser.add_argument('--shared-ratio', help="Share of tags pointing to images which are in every repository. "
+                                               "Default value is 0.", default=0.0, type=float, dest='shared_ratio')
+    parser.add_argument('--error-rate', help="Share of requests answered with 429 or 503. Default value is 0.",
+                        default=0.0, type=float, dest='error_rate')
+    parser.add_argument('--token-auth', help="Let the registry ask for bearer tokens.",
+                        default=False, action='store_true', dest='token_auth')
+    parser.add_argument('-k', '--keepimages', help="Amount of images to keep per repository. Default value is 10.",
+                        default=10, type=int)
+    parser.add_argument('-w', '--metadata-workers', help="Parallel requests per repository. Default value is 6.",
+                        default=6, type=int, dest='md_workers')
+    parser.add_argument('--max-inflight', help="Parallel requests over all repositories. Default value is 64.",
+                        default=64, type=int, dest='max_inflight')
+    parser.add_argument('--min-inflight', help="Parallel requests the adaptive limit starts with. Default value is 4.",
+                        default=4, type=int, dest='min_inflight')
+    parser.add_argument('--delete-workers', help="Parallel deletions. Default value is 4.",
+                        default=4, type=int, dest='delete_workers')
+    parser.add_argument('-i', '--ignore-ref-tags', help="Don't delete digests referenced multiple times.",
+                        default=False, action='store_true', dest='ignoretag')
+    parser.add_argument('-v', '--verbose', help="Show the output of cleanreg.", default=False, action='store_true')
+    return parser.parse_args()
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+
+def report(name, registry, started, requests_before):
+    elapsed = time.perf_counter() - started
+    amount = registry.requests - requests_before
+    print ("  {0:<8} {1:8.2f} s  {2:8} requests  {3:10.1f} requests/s".format(
+        name, elapsed, amount, amount / elapsed if elapsed > 0 else 0.0))
+
+
+def main():
+    bench_args = parse_arguments()
+    print ("Generating {0} repositories with {1} tags each...".format(bench_args.repos, bench_args.tags))
+    registry = FakeRegistry(bench_args.repos, bench_args.tags, bench_args.latency, bench_args.page_size,
+                            bench_args.shared_ratio, bench_args.error_rate,
+                            token_auth=bench_args.token_auth).start()
+    regserver = registry.url + '/v2/'
+    amount_tags = registry.amount_tags
+
+    client = cleanreg.RegistryClient(cleanreg.create_config(registry.url, http_retries=5, retry_backoff=0.01,
+                                                            min_inflight=bench_args.min_inflight,
+                                                            max_inflight=bench_args.max_inflight))
+    output = sys.stdout if bench_args.verbose else open(os.devnull, 'w')
+
+    print ("Benchmark against {0}:".format(registry.url))
+    started = time.perf_counter()
+    requests_before = registry.requests
+    with contextlib.redirect_stdout(output):
+        repos = cleanreg.iter_catalog(0, regserver, page_size=bench_args.page_size, transport=client.transport)
+        repo_tags_dates_digest, digest_index = cleanreg.get_all_tags_dates_digests(
+            0, regserver, repos, bench_args.md_workers, max_inflight=bench_args.max_inflight,
+            page_size=bench_args.page_size, transport=client.transport)
+    report('scan', registry, started, requests_before)
+
+    started = time.perf_counter()
+    repo_del_digests = {}
+    with contextlib.redirect_stdout(output):
+        for repo, tags_dates_digests in repo_tags_dates_digest.items():
+            del_tags = cleanreg.get_deletiontags(0, tags_dates_digests, repo, '', bench_args.keepimages, False, None)
+            digests = set(cleanreg.deletion_digests(0, del_tags, digest_index, bench_args.ignoretag))
+            if len(digests) > 0:
+                repo_del_digests[repo] = digests
+    report('plan', registry, started, registry.requests)
+
+    started = time.perf_counter()
+    requests_before = registry.requests
+    deleter = cleanreg.DeletionExecutor(bench_args.delete_workers)
+    with contextlib.redirect_stdout(output):
+        cleanreg.delete_all_digests(0, regserver, repo_del_digests, deleter, max_inflight=bench_args.max_inflight,
+                                    transport=client.transport)
+    report('delete', registry, started, requests_before)
+
+    print ("  {0} tags scanned, {1} manifests deleted, {2} failed, {3} injected errors".format(
+        amount_tags, deleter.deleted, len(deleter.failures), registry.errors))
+    if bench_args.token_auth:
+        print ("  {0} tokens issued".format(registry.token_requests))
+    limiter = client.transport.limiter
+    print ("  final concurrency limit {0}, {1} throttling responses".format(int(limiter.limit), limiter.throttled))
+    print ("  peak RSS {0:.1f} MB".format(peak_rss_mb()))
+    registry.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Measures the requests and the time cleanreg needs with --serve to clean up repositories after pushes, compared
+with the initial scan. The fake registry posts a notification for each push and deletion.
+
+    python test/benchmark/serve_benchmark.py --repos 100 --tags 100 --pushes 50
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+import cleanreg
+from fakeregistry import FakeRegistry
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks cleanreg serving notifications of a fake registry.')
+    parser.add_argument('--repos', help="Amount of repositories. Default value is 100.", default=100, type=int)
+    parser.add_argument('--tags', help="Amount of tags per repository. Default value is 100.", default=100, type=int)
+    parser.add_argument('--pushes', help="Amount of tags pushed after the first cleanup. Default value is 50.",
+                        default=50, type=int)
+    parser.add_argument('--latency', help="Latency of each request in seconds. Default value is 0.",
+                        default=0.0, type=float)
+    parser.add_argument('-k', '--keepimages', help="Amount of images to keep per repository. Default value is 10.",
+                        default=10, type=int)
+    parser.add_argument('--max-inflight', help="Parallel requests over all repositories. Default value is 64.",
+                        default=64, type=int, dest='max_inflight')
+    bench_args = parser.parse_args()
+
+    print ("Generating {0} repositories with {1} tags each...".format(bench_args.repos, bench_args.tags))
+    registry = FakeRegistry(bench_args.repos, bench_args.tags, bench_args.latency).start()
+    regserver = registry.url + '/v2/'
+    cmd_args = cleanreg.create_config(registry.url, http_retries=5, retry_backoff=0.01,
+                                      max_inflight=bench_args.max_inflight, serve=0, serve_interval=0,
+                                      clean_full_catalog=True, keepimages=bench_args.keepimages)
+    client = cleanreg.RegistryClient(cmd_args)
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        started = time.perf_counter()
+        requests_before = registry.requests
+        repos = list(cleanreg.iter_catalog(0, regserver, transport=client.transport))
+        repo_tags_dates_digest, digest_index = cleanreg.get_all_tags_dates_digests(
+            0, regserver, repos, 6, max_inflight=bench_args.max_inflight, transport=client.transport)
+        repos_counts = {repo: (bench_args.keepimages, '', None, 'date') for repo in repos}
+        server = cleanreg.RetentionServer(cmd_args, regserver, repos_counts, repo_tags_dates_digest, digest_index,
+                                          client.transport)
+        registry.notify_url = server.url
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        # the first cleanup runs right after the start
+        while server.cleanups == 0:
+            time.sleep(0.01)
+        scanned = time.perf_counter() - started
+        scan_requests = registry.requests - requests_before
+
+        started = time.perf_counter()
+        requests_before = registry.requests
+        deleted_before = registry.deleted
+        for push in range(bench_args.pushes):
+            registry.push(repos[push % len(repos)], 'pushed-{0}'.format(push))
+        # each push exceeds the images to keep of its repository by one
+        while registry.deleted - deleted_before < bench_args.pushes:
+            time.sleep(0.01)
+        served = time.perf_counter() - started
+        serve_requests = registry.requests - requests_before
+        server.stop()
+        thread.join()
+
+    print ("Serving {0}:".format(registry.url))
+    print ("  scan and first cleanup {0:8.2f} s  {1:8} requests".format(scanned, scan_requests))
+    print ("  {0} pushes and cleanups {1:8.2f} s  {2:8} requests, {3} notifications".format(
+        bench_args.pushes, served, serve_requests, server.events))
+    print ("  {0} manifests deleted".format(registry.deleted))
+    registry.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Measures how fast cleanreg reads the tags of a registry directly from the storage with --storage-root and plans
+the cleanup. The storage is generated in a temporary directory in the layout of the filesystem storage driver.
+
+    python test/benchmark/storage_benchmark.py --repos 100 --tags 1000
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+import cleanreg
+from fakeregistry import FakeRegistry
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks cleanreg reading a registry storage.')
+    parser.add_argument('--repos', help="Amount of repositories. Default value is 100.", default=100, type=int)
+    parser.add_argument('--tags', help="Amount of tags per repository. Default value is 1000.",
+                        default=1000, type=int)
+    parser.add_argument('--shared-ratio', help="Share of tags pointing to images which are in every repository. "
+                                               "Default value is 0.", default=0.0, type=float, dest='shared_ratio')
+    parser.add_argument('--storage-workers', help="Parallel workers reading the storage. Default value is 8.",
+                        default=8, type=int, dest='storage_workers')
+    parser.add_argument('-k', '--keepimages', help="Amount of images to keep per repository. Default value is 10.",
+                        default=10, type=int)
+    bench_args = parser.parse_args()
+
+    print ("Generating {0} repositories with {1} tags each...".format(bench_args.repos, bench_args.tags))
+    registry = FakeRegistry(bench_args.repos, bench_args.tags, shared_ratio=bench_args.shared_ratio)
+    storage_root = tempfile.mkdtemp(prefix='cleanreg-storage-')
+    try:
+        registry.write_storage(storage_root)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            scanner = cleanreg.StorageScanner(0, storage_root, bench_args.storage_workers)
+            started = time.perf_counter()
+            repo_tags_dates_digest, digest_index = scanner.scan(scanner.iter_repos())
+            scanned = time.perf_counter() - started
+
+            started = time.perf_counter()
+            amount_digests = 0
+            for repo, tags_dates_digests in repo_tags_dates_digest.items():
+                del_tags = cleanreg.get_deletiontags(0, tags_dates_digests, repo, '', bench_args.keepimages, False,
+                                                     None)
+                amount_digests += len(set(cleanreg.deletion_digests(0, del_tags, digest_index, True)))
+            planned = time.perf_counter() - started
+
+        print ("Storage in {0}:".format(storage_root))
+        print ("  scan {0:8.2f} s  {1:10.1f} tags/s".format(scanned, digest_index.references / scanned))
+        print ("  plan {0:8.2f} s  {1} digests to delete".format(planned, amount_digests))
+    finally:
+        registry.stop()
+        shutil.rmtree(storage_root)
+
+
+if __name__ == '__main__':
+    main()
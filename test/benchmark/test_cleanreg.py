@@ -0,0 +1,506 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Tests of cleanreg against the in-process fake registry, no Docker is needed. The command line is run as a
+separate process, the retention server and the client in process.
+
+    python -m unittest discover -s test/benchmark -p 'test_*.py'
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import threading
+import subprocess
+import contextlib
+import io
+import time
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+import cleanreg
+from fakeregistry import FakeRegistry
+
+CLEANREG = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'cleanreg.py')
+
+
+class CleanregTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='cleanreg-test-')
+        self.addCleanup(shutil.rmtree, self.workdir, True)
+
+    def start_registry(self, **options):
+        registry = FakeRegistry(**dict(dict(repos=3, tags=12, seed=7), **options)).start()
+        self.addCleanup(registry.stop)
+        return registry
+
+    def path(self, name):
+        return os.path.join(self.workdir, name)
+
+    def run_cleanreg(self, registry, *arguments):
+        """
+        Runs the command line against the registry and returns the exit code and the output.
+        """
+        result = subprocess.run([sys.executable, CLEANREG, '-r', registry.url] + list(arguments),
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True,
+                                timeout=300)
+        return result.returncode, result.stdout
+
+    def assertCleanreg(self, registry, *arguments):
+        code, output = self.run_cleanreg(registry, *arguments)
+        self.assertEqual(code, 0, output)
+        return output
+
+    @staticmethod
+    def read_plan(plan_file):
+        with open(plan_file) as plan:
+            return sorted(json.dumps(json.loads(line), sort_keys=True) for line in plan if line.strip())
+
+    @staticmethod
+    def amount_tags(registry):
+        return {repo: len(tags) for repo, tags in registry.repos.items()}
+
+
+class AuthTest(CleanregTestCase):
+
+    def test_bearer_tokens_are_cached(self):
+        registry = self.start_registry(repos=4, token_auth=True)
+        client = cleanreg.RegistryClient(cleanreg.create_config(registry.url, clean_full_catalog=True,
+                                                                keepimages=5))
+        with contextlib.redirect_stdout(io.StringIO()):
+            client.scan()
+            tokens = registry.token_requests
+            first_scan = registry.requests
+            client.scan()
+        second_scan = registry.requests - first_scan
+        self.assertGreater(tokens, 0)
+        # the second scan sends each request with a cached token, without a challenge
+        self.assertEqual(registry.token_requests, tokens)
+        self.assertLess(second_scan, first_scan - tokens)
+
+    def test_cleanup_with_bearer_tokens(self):
+        registry = self.start_registry(repos=4, token_auth=True)
+        self.assertCleanreg(registry, '-cf', '-k', '5', '-y')
+        self.assertEqual(self.amount_tags(registry), {repo: 5 for repo in registry.repos})
+        # tokens are requested per batch of repositories, not per request
+        self.assertLessEqual(registry.token_requests, 2 * len(registry.repos) + 1)
+
+
+class TransportTest(CleanregTestCase):
+
+    def test_limiter_sees_throttling_responses(self):
+        registry = self.start_registry(repos=1)
+        transport = cleanreg.create_transport(cleanreg.create_config(registry.url, min_inflight=1, max_inflight=64,
+                                                                     http_retries=2, retry_backoff=0.0))
+        for _ in range(100):
+            self.assertEqual(transport.get(registry.url + '/v2/').status_code, 200)
+        limit = transport.limiter.limit
+        self.assertGreater(limit, 2)
+
+        registry.error_rate = 1.0
+        for _ in range(5):
+            self.assertIn(transport.get(registry.url + '/v2/').status_code, (429, 503))
+        # each try of the retried requests is throttled and seen by the limiter, none by urllib3 alone
+        self.assertEqual(registry.errors, 5 * 3)
+        self.assertEqual(transport.limiter.throttled, registry.errors)
+        self.assertLess(transport.limiter.limit, limit)
+
+
+class LibraryTest(CleanregTestCase):
+
+    def test_failed_scan_raises(self):
+        registry = self.start_registry(repos=1)
+        client = cleanreg.RegistryClient(cleanreg.create_config(registry.url, clean_full_catalog=True,
+                                                                keepimages=5, http_retries=0))
+        registry.error_rate = 1.0
+        # the failed scan doesn't exit the process using the client
+        with contextlib.redirect_stdout(io.StringIO()):
+            with self.assertRaises(cleanreg.RegistryError) as raised:
+                client.scan()
+        self.assertEqual(raised.exception.exit_code, 2)
+
+    def test_invalid_reposfile_raises(self):
+        registry = self.start_registry(repos=1)
+        with open(self.path('repos.yml'), 'w') as reposfile:
+            reposfile.write("'re:repo[':\n  keepimages: 5\n")
+        with self.assertRaises(cleanreg.ConfigError):
+            cleanreg.read_reposfile(cleanreg.create_config(registry.url, reposfile=self.path('repos.yml')))
+        code, output = self.run_cleanreg(registry, '-f', self.path('repos.yml'), '-y')
+        self.assertEqual(code, 1, output)
+        self.assertIn("of the reposfile is invalid", output)
+
+
+class PolicyMatcherTest(CleanregTestCase):
+
+    def test_glob_to_regex(self):
+        self.assertEqual(cleanreg.glob_to_regex('ci/*'), 'ci/[^/]*')
+        self.assertEqual(cleanreg.glob_to_regex('ci/build-?'), 'ci/build\\-[^/]')
+        self.assertEqual(cleanreg.glob_to_regex('ci/**'), 'ci/.*')
+        self.assertEqual(cleanreg.glob_to_regex('a.b'), 'a\\.b')
+
+    def test_regex_prefix(self):
+        self.assertEqual(cleanreg.regex_prefix('ci/build-.*'), 'ci/build-')
+        self.assertEqual(cleanreg.regex_prefix('^ci/build'), 'ci/build')
+        self.assertEqual(cleanreg.regex_prefix('ci/[ab]'), 'ci/')
+        self.assertEqual(cleanreg.regex_prefix('ci\\.io/x'), 'ci')
+        # the alternatives can start differently
+        self.assertEqual(cleanreg.regex_prefix('ci/a|cd/b'), '')
+        self.assertEqual(cleanreg.regex_prefix('ci/(a|b)'), 'ci/')
+        # the quantified character isn't part of every match
+        self.assertEqual(cleanreg.regex_prefix('ab?c'), 'a')
+        self.assertEqual(cleanreg.regex_prefix('ab*c'), 'a')
+        self.assertEqual(cleanreg.regex_prefix('x{2}y'), '')
+        self.assertEqual(cleanreg.regex_prefix('ab+c'), 'ab')
+
+    def test_quantified_prefixes_match(self):
+        matcher = cleanreg.PolicyMatcher()
+        matcher.add('re:ab?c', 'optional')
+        matcher.add('re:x{2}y', 'repeated')
+        self.assertEqual(matcher.match('ac'), ('re:ab?c', 'optional'))
+        self.assertEqual(matcher.match('abc'), ('re:ab?c', 'optional'))
+        self.assertEqual(matcher.match('xxy'), ('re:x{2}y', 'repeated'))
+        self.assertEqual(matcher.match('xy'), (None, None))
+
+    def test_glob_and_regex_keys(self):
+        matcher = cleanreg.PolicyMatcher()
+        matcher.add('ci/*', 'glob')
+        matcher.add('re:dev/[0-9]+', 'regex')
+        self.assertEqual(matcher.match('ci/build'), ('ci/*', 'glob'))
+        # * matches within a path segment only and the whole name has to match
+        self.assertEqual(matcher.match('ci/build/x'), (None, None))
+        self.assertEqual(matcher.match('dev/42'), ('re:dev/[0-9]+', 'regex'))
+        self.assertEqual(matcher.match('dev/42x'), (None, None))
+        self.assertEqual(matcher.match('other'), (None, None))
+
+    def test_name_takes_precedence(self):
+        matcher = cleanreg.PolicyMatcher()
+        matcher.add('ci/*', 'glob')
+        matcher.add('ci/build', 'name')
+        self.assertEqual(matcher.match('ci/build'), ('ci/build', 'name'))
+        self.assertEqual(matcher.match('ci/test'), ('ci/*', 'glob'))
+
+    def test_first_pattern_wins(self):
+        matcher = cleanreg.PolicyMatcher()
+        matcher.add('re:.*', 'any')
+        matcher.add('ci/*', 'glob')
+        self.assertEqual(matcher.match('ci/build'), ('re:.*', 'any'))
+        matcher = cleanreg.PolicyMatcher()
+        matcher.add('ci/**', 'deep')
+        matcher.add('re:ci/build', 'regex')
+        self.assertEqual(matcher.match('ci/build'), ('ci/**', 'deep'))
+
+    def test_explain(self):
+        registry = self.start_registry(repos=3, tags=4)
+        registry.push('other/app', 'latest')
+        with open(self.path('repos.yml'), 'w') as reposfile:
+            reposfile.write("bench/repo-00001:\n  keepimages: 2\n"
+                            "'bench/*':\n  keepimages: 3\n"
+                            "'re:bench/repo-0000[0-9]':\n  keepimages: 1\n  order: semver\n")
+        output = self.assertCleanreg(registry, '-f', self.path('repos.yml'), '-cf', '-k', '5', '--explain')
+        self.assertIn("bench/repo-00000: reposfile pattern bench/* (keepimages: 3, tag: -, keepsince: -, "
+                      "order: date)", output)
+        self.assertIn("bench/repo-00001: reposfile entry bench/repo-00001 (keepimages: 2", output)
+        self.assertIn("other/app: [-cf] defaults (keepimages: 5", output)
+        self.assertIn("4 repos have a rule.", output)
+        # nothing was deleted
+        self.assertEqual(self.amount_tags(registry), {'bench/repo-00000': 4, 'bench/repo-00001': 4,
+                                                      'bench/repo-00002': 4, 'other/app': 1})
+
+
+class OrderTest(CleanregTestCase):
+    """
+    Tags ordered by their names are planned with the tags list alone, only the deleted tags are resolved to their
+    digests with a HEAD request.
+    """
+
+    def clean_up(self, order, tags, *arguments):
+        registry = self.start_registry(repos=1, tags=4)
+        # pushed out of order, so the order of the creation dates doesn't plan the same tags
+        for tag in tags:
+            registry.push('app/release', tag)
+        self.assertCleanreg(registry, '-n', 'app/release', '-k', '2', '--order', order, *arguments)
+        return registry
+
+    def assertResolved(self, registry, tags):
+        requests = {(method, reference): amount for (method, repo, reference), amount
+                    in registry.manifest_requests.items() if repo == 'app/release' and method != 'DELETE'}
+        # no manifest is retrieved, the digest of each deleted tag is requested once
+        self.assertEqual(requests, {('HEAD', tag): 1 for tag in tags})
+
+    def test_semver_order(self):
+        registry = self.clean_up('semver', ['2.0.0', '1.2.10', 'latest', '2.0.0-rc.1', '1.10.0', '1.2.3'], '-y')
+        # a pre-release is older than its release, tags which aren't versions are kept
+        self.assertEqual(sorted(registry.repos['app/release']), ['2.0.0', '2.0.0-rc.1', 'latest'])
+        self.assertResolved(registry, ['1.2.3', '1.2.10', '1.10.0'])
+
+    def test_numeric_order(self):
+        registry = self.clean_up('numeric', ['100', '9', 'latest', '20', '2', '10'], '-y')
+        self.assertEqual(sorted(registry.repos['app/release']), ['100', '20', 'latest'])
+        self.assertResolved(registry, ['2', '9', '10'])
+
+    def test_lexical_order(self):
+        registry = self.clean_up('lexical', ['100', '9', '20', '2', '10'], '-y')
+        self.assertEqual(sorted(registry.repos['app/release']), ['20', '9'])
+        self.assertResolved(registry, ['10', '100', '2'])
+
+    def test_plan_resolves_deleted_tags(self):
+        registry = self.clean_up('semver', ['1.0.0', '1.1.0', '0.9.0', '1.0.1'], '--write-plan', self.path('plan'))
+        self.assertEqual(len(registry.repos['app/release']), 4)
+        with open(self.path('plan')) as plan:
+            entries = [json.loads(line) for line in plan if line.strip()]
+        self.assertEqual(sorted(entry['tag'] for entry in entries), ['0.9.0', '1.0.0'])
+        self.assertEqual({entry['digest'] for entry in entries},
+                         {registry.repos['app/release'][tag] for tag in ('0.9.0', '1.0.0')})
+        self.assertResolved(registry, ['0.9.0', '1.0.0'])
+
+
+class StorageTest(CleanregTestCase):
+
+    def test_storage_root_plans_like_the_http_scan(self):
+        registry = self.start_registry(shared_ratio=0.3)
+        registry.write_storage(self.path('storage'))
+        self.assertCleanreg(registry, '-cf', '-k', '5', '-i', '--write-plan', self.path('http.jsonl'))
+        requests_before = registry.requests
+        self.assertCleanreg(registry, '-cf', '-k', '5', '-i', '--storage-root', self.path('storage'),
+                            '--write-plan', self.path('storage.jsonl'))
+        self.assertEqual(self.read_plan(self.path('storage.jsonl')), self.read_plan(self.path('http.jsonl')))
+        self.assertGreater(len(self.read_plan(self.path('http.jsonl'))), 0)
+        # only the check of the registry server, the tags are read from the storage
+        self.assertLessEqual(registry.requests - requests_before, 1)
+
+
+class DeleteTagsTest(CleanregTestCase):
+
+    def test_falls_back_to_digests(self):
+        registry = self.start_registry()
+        output = self.assertCleanreg(registry, '-cf', '-k', '5', '-y', '--delete-tags')
+        self.assertIn("doesn't support the deletion of tags", output)
+        self.assertEqual(self.amount_tags(registry), {repo: 5 for repo in registry.repos})
+
+    def test_deletes_single_tags(self):
+        registry = self.start_registry(shared_ratio=0.5, tag_deletion=True)
+        digests = set(digest for tags in registry.repos.values() for digest in tags.values())
+        self.assertCleanreg(registry, '-cf', '-k', '5', '-y', '--delete-tags')
+        self.assertEqual(self.amount_tags(registry), {repo: 5 for repo in registry.repos})
+        # the kept tags still point to their images, also to the shared ones
+        for tags in registry.repos.values():
+            for digest in tags.values():
+                self.assertIn(digest, digests)
+        self.assertEqual(registry.deleted, sum(12 - 5 for repo in registry.repos))
+
+
+class DeletionTagsTest(CleanregTestCase):
+
+    def test_date_order_compares_the_creation_times(self):
+        # the dates are written differently, their strings aren't in the order of the creation times
+        dates = {'oldest': '2020-01-01T09:00:00Z', 'older': '2020-01-01 10:00:00.000000000Z',
+                 'newest': '2020-01-01T11:00:00.5Z'}
+        tags_dates_digests = {tag: {'date': date, 'digest': 'sha256:' + tag,
+                                    'epoch': cleanreg.parse_creation_date(date)} for tag, date in dates.items()}
+        del_tags = cleanreg.get_deletiontags(0, tags_dates_digests, 'app', '', 1, False, '')
+        self.assertEqual(list(del_tags), ['oldest', 'older'])
+        del_tags = cleanreg.get_deletiontags(0, tags_dates_digests, 'app', '', 2, False, '')
+        self.assertEqual(list(del_tags), ['oldest'])
+
+
+class PlanTest(CleanregTestCase):
+
+    def test_apply_plan_keeps_changed_tags(self):
+        registry = self.start_registry()
+        self.assertCleanreg(registry, '-cf', '-k', '5', '--write-plan', self.path('plan.jsonl'))
+        self.assertEqual(registry.deleted, 0)
+        plan = [json.loads(line) for line in self.read_plan(self.path('plan.jsonl'))]
+        moved = plan[0]
+        new_digest = registry.push(moved['repo'], moved['tag'])
+
+        output = self.assertCleanreg(registry, '--apply-plan', self.path('plan.jsonl'), '-y')
+        self.assertIn("1 tags were changed", output)
+        self.assertEqual(registry.repos[moved['repo']].get(moved['tag']), new_digest)
+        self.assertEqual(registry.deleted, len(plan) - 1)
+        for planned in plan[1:]:
+            self.assertNotIn(planned['tag'], registry.repos[planned['repo']])
+
+
+class JournalTest(CleanregTestCase):
+
+    def test_resume_doesnt_scan_or_delete_again(self):
+        registry = self.start_registry()
+        self.assertCleanreg(registry, '-cf', '-k', '5', '-y', '--journal', self.path('journal'))
+        deleted = registry.deleted
+        self.assertEqual(deleted, 3 * (12 - 5))
+
+        requests_before = registry.requests
+        output = self.assertCleanreg(registry, '-cf', '-k', '3', '-y', '--journal', self.path('journal'),
+                                     '--resume')
+        self.assertIn("Resuming with 3 completed repos", output)
+        self.assertEqual(self.amount_tags(registry), {repo: 3 for repo in registry.repos})
+        self.assertEqual(registry.deleted - deleted, 3 * (5 - 3))
+        # the check of the registry server, the catalog and the new deletions, the tags aren't listed again
+        self.assertEqual(registry.requests - requests_before, 2 + 3 * (5 - 3))
+
+
+class IncrementalTest(CleanregTestCase):
+
+    def read_snapshot(self, repo):
+        import sqlite3
+        db = sqlite3.connect(self.path(os.path.join('cache', 'snapshots.sqlite')))
+        try:
+            return json.loads(db.execute("SELECT tags FROM snapshots WHERE repo = ?", (repo,)).fetchone()[0])
+        finally:
+            db.close()
+
+    def scan_incremental(self, registry):
+        return self.assertCleanreg(registry, '-cf', '-k', '20', '--incremental', '--cache-dir', self.path('cache'),
+                                   '--page-size', '5', '--write-plan', self.path('plan.jsonl'))
+
+    def test_unchanged_single_page(self):
+        registry = self.start_registry(repos=1, tags=3, page_size=5)
+        self.scan_incremental(registry)
+        requests_before = registry.requests
+        output = self.scan_incremental(registry)
+        self.assertIn("1 repos unchanged, 0 repos rescanned", output)
+        # the check of the registry server, the catalog and the tags list
+        self.assertEqual(registry.requests - requests_before, 3)
+
+    def test_change_on_a_following_page(self):
+        registry = self.start_registry(repos=1, tags=12, page_size=5)
+        repo = sorted(registry.repos)[0]
+        self.scan_incremental(registry)
+        self.assertEqual(len(self.read_snapshot(repo)), 12)
+        # sorted last, so only the third page of the tags list changes
+        digest = registry.push(repo, 'zzz-new')
+        output = self.scan_incremental(registry)
+        self.assertIn("0 repos unchanged, 1 repos rescanned", output)
+        snapshot = self.read_snapshot(repo)
+        self.assertEqual(set(snapshot), set(registry.repos[repo]))
+        self.assertEqual(snapshot['zzz-new']['digest'], digest)
+
+
+class ShardTest(CleanregTestCase):
+
+    def export_shards(self, registry, shard_count):
+        for shard in range(shard_count):
+            self.assertCleanreg(registry, '-cf', '-k', '5', '-i', '--shard-index', str(shard), '--shard-count',
+                                str(shard_count), '--export-refs', self.path('refs-{0}.json'.format(shard)))
+        self.assertEqual(registry.deleted, 0)
+        return [self.path('refs-{0}.json'.format(shard)) for shard in range(shard_count)]
+
+    def test_shards_delete_like_a_single_instance(self):
+        single = self.start_registry(repos=6, shared_ratio=0.4)
+        self.assertCleanreg(single, '-cf', '-k', '5', '-i', '-y')
+
+        registry = self.start_registry(repos=6, shared_ratio=0.4)
+        refs = self.export_shards(registry, 2)
+        for shard in range(2):
+            self.assertCleanreg(registry, '-cf', '-k', '5', '-i', '-y', '--shard-index', str(shard),
+                                '--shard-count', '2', '--import-refs', *refs)
+        self.assertGreater(registry.deleted, 0)
+        self.assertEqual(registry.repos, single.repos)
+
+    def test_missing_shard_doesnt_delete(self):
+        registry = self.start_registry(repos=6, shared_ratio=0.4)
+        refs = self.export_shards(registry, 3)
+        code, output = self.run_cleanreg(registry, '-cf', '-k', '5', '-i', '-y', '--shard-index', '0',
+                                         '--shard-count', '3', '--import-refs', refs[0], refs[1])
+        self.assertEqual(code, 1, output)
+        self.assertIn("are missing", output)
+        self.assertEqual(registry.deleted, 0)
+
+    def test_export_of_another_shard_count_doesnt_delete(self):
+        registry = self.start_registry(repos=6, shared_ratio=0.4)
+        refs = self.export_shards(registry, 2)
+        code, output = self.run_cleanreg(registry, '-cf', '-k', '5', '-i', '-y', '--shard-index', '0',
+                                         '--shard-count', '3', '--import-refs', *refs)
+        self.assertEqual(code, 1, output)
+        self.assertIn("shards, not 3", output)
+        self.assertEqual(registry.deleted, 0)
+
+
+class ServeTest(CleanregTestCase):
+
+    def start_server(self, registry, token=None):
+        config = cleanreg.create_config(registry.url, clean_full_catalog=True, keepimages=5, serve=0,
+                                        serve_interval=0, serve_token=token)
+        client = cleanreg.RegistryClient(config)
+        with contextlib.redirect_stdout(io.StringIO()):
+            repo_tags_dates_digest, digest_index = client.scan()
+            server = cleanreg.RetentionServer(config, client.regserver, client.repos_counts,
+                                              repo_tags_dates_digest, digest_index, client.transport)
+        registry.notify_url = server.url
+        registry.notify_token = token
+        thread = threading.Thread(target=self.serve, args=(server,), daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.stop)
+        self.wait_for(lambda: server.cleanups > 0)
+        return server
+
+    @staticmethod
+    def serve(server):
+        with contextlib.redirect_stdout(io.StringIO()):
+            server.run()
+
+    def wait_for(self, condition, timeout=30):
+        deadline = time.time() + timeout
+        while not condition():
+            self.assertLess(time.time(), deadline, "Timed out")
+            time.sleep(0.01)
+
+    def post_event(self, server, action, repo, digest, tag=None, token=None):
+        target = {'repository': repo, 'digest': digest}
+        if tag is not None:
+            target['tag'] = tag
+        headers = {} if token is None else {'Authorization': 'Bearer ' + token}
+        return requests.post(server.url, json={'events': [{'action': action, 'target': target}]},
+                             headers=headers, timeout=10)
+
+    def test_cleans_up_pushed_repositories(self):
+        registry = self.start_registry()
+        server = self.start_server(registry)
+        self.assertEqual(self.amount_tags(registry), {repo: 5 for repo in registry.repos})
+
+        repo = sorted(registry.repos)[0]
+        deleted = registry.deleted
+        digest = registry.push(repo, 'pushed')
+        self.wait_for(lambda: registry.deleted > deleted)
+        registry.wait_notifications()
+        self.assertEqual(registry.repos[repo].get('pushed'), digest)
+        self.assertEqual(len(registry.repos[repo]), 5)
+        self.assertEqual(server.repo_tags_dates_digest[repo]['pushed']['digest'], digest)
+        self.assertEqual(set(server.repo_tags_dates_digest[repo]), set(registry.repos[repo]))
+
+    def test_applies_deletions_of_others(self):
+        registry = self.start_registry()
+        server = self.start_server(registry)
+        repo = sorted(registry.repos)[1]
+        tag, digest = sorted(registry.repos[repo].items())[0]
+
+        response = requests.delete('{0}/v2/{1}/manifests/{2}'.format(registry.url, repo, digest), timeout=10)
+        self.assertEqual(response.status_code, 202)
+        registry.wait_notifications()
+        self.wait_for(lambda: tag not in server.repo_tags_dates_digest[repo])
+        self.assertEqual(server.digest_index.count(digest), 0)
+
+    def test_ignores_unconfirmed_notifications(self):
+        registry = self.start_registry()
+        server = self.start_server(registry, token='secret')
+        repo = sorted(registry.repos)[2]
+        tag, digest = sorted(registry.repos[repo].items())[0]
+        fake_digest = 'sha256:' + '0' * 64
+
+        self.assertEqual(self.post_event(server, 'push', repo, fake_digest, 'fake').status_code, 401)
+        self.assertEqual(self.post_event(server, 'push', repo, fake_digest, 'fake', 'secret').status_code, 200)
+        self.assertEqual(self.post_event(server, 'delete', repo, digest, None, 'secret').status_code, 200)
+        self.wait_for(lambda: server.events >= 2)
+        self.assertNotIn('fake', server.repo_tags_dates_digest[repo])
+        self.assertEqual(server.repo_tags_dates_digest[repo][tag]['digest'], digest)
+        self.assertEqual(registry.deleted, 3 * (12 - 5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -23,6 +23,14 @@ echo "Finished building testrunner"
 chmod -R +x ./tests
 cd ..
 
+#Run the tests against the fake registry within the testrunner container, they don't need a registry
+echo "Running the tests against the fake registry"
+docker run --rm -v $(pwd):/workspace testrunner "cd /workspace; python -m unittest discover -s test/benchmark -p 'test_*.py'"
+if [[ $? -ne 0 ]]; then
+   echo "Test failure"
+   exit 1
+fi
+
 #Run the testfiles
 sleep 5
 echo "Starting tests"